@@ -0,0 +1,232 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Generates synthetic Git repositories of a given shape for benchmarking.
+
+The generated history is linear.  Every commit changes a few lines of
+`--changes` random files; every `--huge-every`-th commit instead changes
+`--huge-files` files at once.  Files live in a tree that is `--depth`
+directories deep, with `--width` files and `--width` subdirectories per
+directory.  Every `--tag-every`-th commit is tagged (annotated tags).
+
+Author, dates and contents only depend on the shape and `--seed`, so the same
+options always produce the same commit SHAs.
+
+    python benchmarks/genrepo.py /tmp/bench-repo --commits 5000 --depth 3
+"""
+import optparse
+import os
+import random
+import stat
+
+from dulwich.objects import Blob, Commit, Tag, Tree
+from dulwich.repo import Repo
+
+#: Write a pack every this many commits, to bound the memory used.
+COMMITS_PER_PACK = 2000
+
+#: Date of the first commit; commits are an hour apart.
+START_TIME = 1262304000
+
+DEFAULTS = {
+    'commits': 1000,
+    'depth': 2,
+    'width': 8,
+    'file_size': 4096,
+    'changes': 3,
+    'tag_every': 100,
+    'huge_every': 0,
+    'huge_files': 1000,
+    'seed': 0,
+}
+
+WORDS = ('self return def class import for in if else elif while try except '
+         'finally with as yield lambda None True False value result index '
+         'count name path data item node tree blob commit repo').split()
+
+
+class Generator(object):
+    """ Writes a repo of the given shape (see `DEFAULTS`) into `path`. """
+    def __init__(self, path, **shape):
+        self.shape = dict(DEFAULTS, **shape)
+        self.random = random.Random(self.shape['seed'])
+        if not os.path.exists(path):
+            os.makedirs(path)
+        self.repo = Repo.init_bare(path)
+        self.pending = []
+        self.files = {}             # path -> list of lines
+        self.dirs = {}              # directory -> {name: (mode, sha)}
+
+    def run(self):
+        """ Generates the repo and returns the SHA of the last commit. """
+        self._create_files()
+        paths = sorted(self.files)
+        parent = None
+        for number in xrange(self.shape['commits']):
+            huge_every = self.shape['huge_every']
+            if number == 0:
+                changed = paths
+            elif huge_every and number % huge_every == 0:
+                changed = self.random.sample(
+                    paths, min(self.shape['huge_files'], len(paths)))
+            else:
+                changed = self.random.sample(
+                    paths, min(self.shape['changes'], len(paths)))
+            parent = self._commit(number, parent, changed)
+            if self.shape['tag_every'] and \
+               (number + 1) % self.shape['tag_every'] == 0:
+                self._tag(number, parent)
+            if len(self.pending) and (number + 1) % COMMITS_PER_PACK == 0:
+                self._flush()
+        self._flush()
+        if parent is not None:
+            self.repo.refs['refs/heads/master'] = parent
+        return parent
+
+    def _create_files(self):
+        width = self.shape['width']
+        directories = ['']
+        for level in xrange(self.shape['depth'] + 1):
+            subdirectories = []
+            for directory in directories:
+                for i in xrange(width):
+                    name = 'file%d.py' % i
+                    self.files[directory + name] = self._make_lines()
+                    if level < self.shape['depth']:
+                        subdirectories.append(directory + 'dir%d/' % i)
+            directories = subdirectories
+
+    def _make_lines(self):
+        lines = []
+        size = 0
+        target = self.random.randint(self.shape['file_size'] // 2,
+                                     self.shape['file_size'] * 3 // 2)
+        while size < target:
+            line = self._make_line()
+            lines.append(line)
+            size += len(line)
+        return lines
+
+    def _make_line(self):
+        indent = '    ' * self.random.randint(0, 3)
+        return indent + ' '.join(self.random.choice(WORDS) for _ in
+                                 xrange(self.random.randint(2, 10))) + '\n'
+
+    def _change(self, path):
+        lines = self.files[path]
+        for _ in xrange(self.random.randint(1, 3)):
+            pos = self.random.randint(0, len(lines))
+            if lines and self.random.random() < 0.5:
+                lines[min(pos, len(lines) - 1)] = self._make_line()
+            else:
+                lines.insert(pos, self._make_line())
+
+    def _commit(self, number, parent, changed):
+        dirty = set()
+        for path in changed:
+            if number:
+                self._change(path)
+            blob = Blob.from_string(''.join(self.files[path]))
+            self.pending.append(blob)
+            directory, name = path.rpartition('/')[::2]
+            self.dirs.setdefault(directory, {})[name] = \
+                (stat.S_IFREG | 0o644, blob.id)
+            dirty.add(directory)
+
+        for directory in list(dirty):
+            while directory:
+                directory = directory.rpartition('/')[0]
+                dirty.add(directory)
+        # Rebuild the changed trees, deepest first.
+        for directory in sorted(dirty, key=lambda d: -d.count('/') - bool(d)):
+            tree = Tree()
+            for name, (mode, sha) in self.dirs[directory].iteritems():
+                tree.add(name, mode, sha)
+            self.pending.append(tree)
+            if directory:
+                parent_dir, name = directory.rpartition('/')[::2]
+                self.dirs.setdefault(parent_dir, {})[name] = \
+                    (stat.S_IFDIR, tree.id)
+            else:
+                root = tree
+
+        commit = Commit()
+        commit.tree = root.id
+        commit.parents = [parent] if parent else []
+        commit.author = commit.committer = \
+            'Bench Mark <bench@example.com>'
+        commit.author_time = commit.commit_time = START_TIME + number * 3600
+        commit.author_timezone = commit.commit_timezone = 0
+        commit.encoding = 'UTF-8'
+        commit.message = 'Commit %d: %s\n' % (number, self._make_line())
+        self.pending.append(commit)
+        return commit.id
+
+    def _tag(self, number, sha):
+        tag = Tag()
+        tag.name = 'v%d' % (number + 1)
+        tag.object = (Commit, sha)
+        tag.tagger = 'Bench Mark <bench@example.com>'
+        tag.tag_time = START_TIME + number * 3600
+        tag.tag_timezone = 0
+        tag.message = 'Release %d\n' % (number + 1)
+        self.pending.append(tag)
+        self.repo.refs['refs/tags/' + tag.name] = tag.id
+
+    def _flush(self):
+        if self.pending:
+            self.repo.object_store.add_objects(
+                [(obj, None) for obj in self.pending])
+            self.pending = []
+
+
+def generate(path, **shape):
+    """
+    Generates a repo of the given shape (see `DEFAULTS`) at `path` and returns
+    the SHA of its last commit.
+    """
+    return Generator(path, **shape).run()
+
+
+def add_shape_options(parser):
+    parser.add_option('--commits', type='int',
+                      help='number of commits [%default]')
+    parser.add_option('--depth', type='int',
+                      help='depth of the directory tree [%default]')
+    parser.add_option('--width', type='int',
+                      help='files and subdirectories per directory '
+                           '[%default]')
+    parser.add_option('--file-size', type='int',
+                      help='average file size in bytes [%default]')
+    parser.add_option('--changes', type='int',
+                      help='files changed by a normal commit [%default]')
+    parser.add_option('--tag-every', type='int',
+                      help='tag every this many commits, 0 for no tags '
+                           '[%default]')
+    parser.add_option('--huge-every', type='int',
+                      help='make every this many commits a huge commit, 0 '
+                           'for none [%default]')
+    parser.add_option('--huge-files', type='int',
+                      help='files changed by a huge commit [%default]')
+    parser.add_option('--seed', type='int',
+                      help='random seed [%default]')
+    parser.set_defaults(**DEFAULTS)
+
+
+def get_shape(options):
+    return dict((name, getattr(options, name)) for name in DEFAULTS)
+
+
+def main():
+    parser = optparse.OptionParser('%prog [options] PATH')
+    add_shape_options(parser)
+    options, args = parser.parse_args()
+    if len(args) != 1:
+        parser.error('expected the path of the repo to create')
+    if os.path.exists(os.path.join(args[0], 'objects')):
+        parser.error('%s already is a repo' % args[0])
+    print generate(args[0], **get_shape(options))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,365 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Benchmarks klaus' views (through Django's test client) and the `FancyRepo`
+methods behind them on a synthetic repository (see `genrepo.py`) or an
+existing one.
+
+Each benchmark runs in a fresh process: the first call (reported as "cold")
+pays for opening the repo and loading its indexes, which are built on disk
+before the benchmarks start.  The following `--iterations` calls are
+reported as latency percentiles, along with the growth of the process' peak
+memory over all calls.  Django's cache is a dummy cache unless `--cache` is
+given, so the numbers measure actual work.
+
+    python benchmarks/run.py --commits 5000 --save baseline.json
+    ... change things ...
+    python benchmarks/run.py --commits 5000 --compare baseline.json
+
+Results can only be compared between runs on the same repo shape.  Unix
+only (uses `fork` and `resource`).
+"""
+import json
+import multiprocessing
+import optparse
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+import genrepo
+
+#: Format version of the saved results.
+RESULTS_VERSION = 1
+
+PERCENTILES = [50, 90, 99]
+
+
+def configure(repo_path, cache_dir, use_cache):
+    from django.conf import settings
+    settings.configure(
+        DEBUG=False,
+        SECRET_KEY='benchmark',
+        ALLOWED_HOSTS=['testserver'],
+        INSTALLED_APPS=('klaus',),
+        MIDDLEWARE_CLASSES=(),
+        ROOT_URLCONF=__name__,
+        CACHES={'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'
+            if use_cache else 'django.core.cache.backends.dummy.DummyCache',
+        }},
+        KLAUS_REPO_PATHS=[repo_path],
+        KLAUS_CACHE_DIR=cache_dir,
+        # Measure rendering in the benchmark's process.
+        KLAUS_RENDER_PROCESSES=0,
+        KLAUS_SERVER_TIMING=False,
+    )
+    try:
+        import django
+        django.setup()
+    except AttributeError:
+        # Django < 1.7
+        pass
+
+    # This module is the URLconf.
+    from django.conf.urls import include, patterns, url
+    global urlpatterns
+    urlpatterns = patterns('', url(r'^klaus/', include('klaus.urls',
+                                                        namespace='klaus')))
+
+
+class Target(object):
+    """ What to benchmark: a repo, a deep file path and commits in it. """
+    def __init__(self, repo_name, path, commit, huge_commit=None):
+        self.repo_name = repo_name
+        self.path = path
+        self.commit = commit
+        self.huge_commit = huge_commit
+
+    def get_repo(self):
+        from klaus.repo import RepoManager
+        return RepoManager.get_repo(self.repo_name)
+
+
+def get_target(repo_path, commit=None, huge_commit=None, shape=None):
+    """
+    Returns the `Target` for the repo at `repo_path`.  `commit` defaults to
+    the tip of master; `huge_commit` to the last huge commit of a generated
+    repo of shape `shape`.
+    """
+    from klaus.repo import FancyRepo, repo_name
+
+    repo = FancyRepo(repo_path)
+    commit = commit or repo.get_commit('master').id
+    if huge_commit is None and shape and shape['huge_every'] and \
+       shape['commits'] > shape['huge_every']:
+        last_huge = (shape['commits'] - 1) // shape['huge_every'] * \
+            shape['huge_every']
+        huge_commit = nth_ancestor(repo, commit,
+                                   shape['commits'] - 1 - last_huge)
+    return Target(repo_name(repo_path), find_deep_file(repo), commit,
+                  huge_commit)
+
+
+def build_indexes(target):
+    """ Builds the on-disk indexes used by the benchmarks. """
+    repo = target.get_repo()
+    repo.update_indexes()
+    repo.history('master', target.path, 1)
+
+
+def find_deep_file(repo):
+    """ Returns the path of the first file in the repo's deepest directory. """
+    tree = repo[repo.get_commit('master').tree]
+    path = []
+    while True:
+        entries = sorted(tree.iteritems())
+        subtrees = [entry for entry in entries if entry.mode & 0o40000]
+        if not subtrees:
+            return '/'.join(path + [entries[0].path])
+        path.append(subtrees[0].path)
+        tree = repo[subtrees[0].sha]
+
+
+def nth_ancestor(repo, sha, n):
+    for _ in xrange(n):
+        sha = repo[sha].parents[0]
+    return sha
+
+
+def get_benchmarks(target):
+    """ Returns a list of `(name, function)` pairs. """
+    from django.test.client import Client
+    client = Client()
+
+    def get(url):
+        def view():
+            response = client.get(url)
+            assert response.status_code == 200, (url, response.status_code)
+            if response.streaming:
+                for _ in response.streaming_content:
+                    pass
+        return view
+
+    repo_url = '/klaus/%s/' % target.repo_name
+    benchmarks = [
+        ('view:repo_list', get('/klaus/')),
+        ('view:history', get(repo_url + 'tree/master/')),
+        ('view:history_page', get(repo_url + 'tree/master/?page=10')),
+        ('view:history_path', get(repo_url + 'tree/master/%s/'
+                                  % target.path)),
+        ('view:blob', get(repo_url + 'blob/master/%s/' % target.path)),
+        ('view:raw', get(repo_url + 'raw/master/%s/' % target.path)),
+        ('view:blame', get(repo_url + 'blame/master/%s/' % target.path)),
+        ('view:commit', get(repo_url + 'commit/%s/' % target.commit)),
+    ]
+    if target.huge_commit:
+        benchmarks.append(('view:commit_huge',
+                           get(repo_url + 'commit/%s/' % target.huge_commit)))
+
+    def repo_method(name, *args):
+        def call():
+            repo = target.get_repo()
+            result = getattr(repo, name)(*args)
+            if isinstance(result, list):
+                len(result)
+            elif hasattr(result, 'data'):
+                result.data
+        return call
+
+    def commit_diff(sha):
+        def call():
+            repo = target.get_repo()
+            repo.commit_diff(repo.get_commit(sha))
+        return call
+
+    def get_blob():
+        repo = target.get_repo()
+        repo.get_blob_or_tree(repo.get_commit('master'), target.path).data
+
+    def get_blame():
+        repo = target.get_repo()
+        repo.get_blame(repo.get_commit('master'), target.path)
+
+    benchmarks.extend([
+        ('repo:get_commit_graph', repo_method('get_commit_graph')),
+        ('repo:get_branch_names', repo_method('get_branch_names')),
+        ('repo:get_tag_names', repo_method('get_tag_names')),
+        ('repo:history', repo_method('history', 'master', None, 50)),
+        ('repo:history_path', repo_method('history', 'master', target.path,
+                                          50)),
+        ('repo:get_blob_or_tree', get_blob),
+        ('repo:get_blame', get_blame),
+        ('repo:commit_diff', commit_diff(target.commit)),
+    ])
+    if target.huge_commit:
+        benchmarks.append(('repo:commit_diff_huge',
+                           commit_diff(target.huge_commit)))
+    return benchmarks
+
+
+def get_peak_memory():
+    """ Returns the peak resident memory of the process, in bytes. """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on OS X
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def run_benchmark(function, iterations):
+    """ Runs `function` and returns its result dict (see `report`). """
+    memory = get_peak_memory()
+    start = time.time()
+    function()
+    cold = time.time() - start
+
+    times = []
+    for _ in xrange(iterations):
+        start = time.time()
+        function()
+        times.append(time.time() - start)
+    times.sort()
+
+    result = {
+        'cold': cold,
+        'max': times[-1],
+        'peak_memory': get_peak_memory() - memory,
+    }
+    for percentile in PERCENTILES:
+        index = int(round(percentile / 100.0 * (len(times) - 1)))
+        result['p%d' % percentile] = times[index]
+    return result
+
+
+def run_in_child(function, *args):
+    """ Returns `function(*args)`, called in a forked process. """
+    parent, child = multiprocessing.Pipe()
+
+    def target():
+        try:
+            child.send((True, function(*args)))
+        except Exception as exc:
+            child.send((False, repr(exc)))
+    process = multiprocessing.Process(target=target)
+    process.start()
+    ok, result = parent.recv()
+    process.join()
+    if not ok:
+        raise RuntimeError(result)
+    return result
+
+
+def report(results, baseline=None, threshold=None):
+    """
+    Prints a table of `results` (and their change relative to `baseline`)
+    and returns the names of the benchmarks whose median got slower by more
+    than `threshold` (a fraction).
+    """
+    columns = ['cold'] + ['p%d' % p for p in PERCENTILES] + ['max']
+    print '%-24s %s %10s' % ('benchmark', ' '.join('%9s' % column
+                                                    for column in columns),
+                             'peak mem')
+    regressions = []
+    for name, result in results:
+        line = '%-24s %s %8.1fM' % (
+            name,
+            ' '.join('%7.1fms' % (result[column] * 1000)
+                     for column in columns),
+            result['peak_memory'] / 1024.0 / 1024)
+        old = (baseline or {}).get(name)
+        if old is not None:
+            change = result['p50'] / max(old['p50'], 1e-6) - 1
+            line += '  p50 %+.0f%%' % (change * 100)
+            # Ignore sub-millisecond noise.
+            if change > threshold and result['p50'] - old['p50'] > 0.001:
+                line += '  REGRESSION'
+                regressions.append(name)
+        print line
+    return regressions
+
+
+def main():
+    parser = optparse.OptionParser('%prog [options]')
+    parser.add_option('--repo', metavar='PATH',
+                      help='benchmark an existing repo instead of generating '
+                           'one (with the shape options below)')
+    parser.add_option('--commit', metavar='SHA',
+                      help='commit for the commit benchmarks [the tip]')
+    parser.add_option('--huge-commit', metavar='SHA',
+                      help='commit for the huge commit benchmarks [with '
+                           '--huge-every, the last huge commit]')
+    parser.add_option('--iterations', type='int', default=20,
+                      help='calls per benchmark, after the first [%default]')
+    parser.add_option('--only', metavar='SUBSTRING',
+                      help='only run benchmarks whose name contains this')
+    parser.add_option('--cache', action='store_true',
+                      help="use a local memory cache as Django's cache")
+    parser.add_option('--save', metavar='FILE',
+                      help='save the results to FILE')
+    parser.add_option('--compare', metavar='FILE',
+                      help='compare the results with those saved in FILE')
+    parser.add_option('--threshold', type='float', default=0.2,
+                      help='with --compare, exit with status 1 if any median '
+                           'got slower by more than this fraction [%default]')
+    genrepo.add_shape_options(parser)
+    options, args = parser.parse_args()
+    if args:
+        parser.error('unexpected arguments')
+
+    baseline = None
+    if options.compare:
+        with open(options.compare) as fileobj:
+            saved = json.load(fileobj)
+        if saved.get('version') != RESULTS_VERSION:
+            parser.error('%s has an unknown format' % options.compare)
+        baseline = saved['results']
+
+    tmpdir = tempfile.mkdtemp(prefix='klaus-benchmark-')
+    try:
+        shape = None
+        if options.repo:
+            repo_path = os.path.abspath(options.repo)
+        else:
+            shape = genrepo.get_shape(options)
+            repo_path = os.path.join(tmpdir, 'repo')
+            print 'Generating repo...'
+            genrepo.generate(repo_path, **shape)
+
+        configure(repo_path, os.path.join(tmpdir, 'cache'), options.cache)
+        # Keep the benchmarks' processes clean of open repos.
+        target = run_in_child(get_target, repo_path, options.commit,
+                              options.huge_commit, shape)
+        print 'Building indexes...'
+        run_in_child(build_indexes, target)
+
+        results = []
+        for name, function in get_benchmarks(target):
+            if options.only and options.only not in name:
+                continue
+            results.append((name, run_in_child(run_benchmark, function,
+                                               options.iterations)))
+    finally:
+        shutil.rmtree(tmpdir)
+
+    regressions = report(results, baseline, options.threshold)
+    if options.save:
+        with open(options.save, 'w') as fileobj:
+            json.dump({
+                'version': RESULTS_VERSION,
+                'shape': shape,
+                'repo': options.repo,
+                'iterations': options.iterations,
+                'results': dict(results),
+            }, fileobj, indent=2, sort_keys=True)
+    if regressions:
+        print '%d regression(s): %s' % (len(regressions),
+                                        ', '.join(regressions))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,267 @@
+# -*- coding: utf-8 -*-
+"""
+Streaming tar.gz and zip archives of a commit's tree, like `git archive`.
+
+Archives are generated file by file, reading blobs with `open_object`, so
+neither the archive nor (non-deltified) large files are ever held in memory.
+While an archive is sent, it is also written to the archive cache, from which
+later downloads of the same archive are served as a plain file.
+
+The archive cache is the directory `KLAUS_ARCHIVE_CACHE_DIR`, or the
+``archives`` directory in each repo's klaus cache directory (see
+`FancyRepo.cache_path`) if that is not set.  Archives are keyed by tree SHA,
+format, prefix and time stamp, so they never become stale.  Once the archives
+in the directory take up more than `KLAUS_ARCHIVE_CACHE_SIZE` bytes (default:
+1 GB; 0 disables the cache), the least recently downloaded ones are removed.
+"""
+import hashlib
+import itertools
+import os
+import stat
+import struct
+import tarfile
+import time
+import zlib
+
+from django.conf import settings
+
+from klaus.objects import open_object
+
+#: Part of the cache keys; increase on changes to the archive contents.
+ARCHIVE_VERSION = 1
+
+#: Archive formats (file name extensions) and their content types.
+FORMATS = {
+    'tar.gz': 'application/x-gzip',
+    'zip': 'application/zip',
+}
+
+DEFAULT_CACHE_SIZE = 1024 * 1024 * 1024
+
+#: Compression level for both formats; like `git archive`'s default.
+COMPRESSION_LEVEL = 6
+
+
+def generate(repo, commit, format, prefix):
+    """
+    Yields the chunks of the `format` archive of the tree of `commit`, with
+    all paths prefixed by `prefix` (e.g. ``'klaus-1.0/'``).
+    """
+    entries = iter_entries(repo, repo.get_tree(commit.tree), prefix)
+    if prefix:
+        entries = itertools.chain([(prefix, stat.S_IFDIR, None)], entries)
+    if format == 'zip':
+        return _iter_zip(repo, entries, commit.commit_time)
+    return _iter_gzip(_iter_tar(repo, entries, commit.commit_time),
+                      commit.commit_time)
+
+
+def iter_entries(repo, tree, prefix):
+    """
+    Yields `(path, mode, sha)` for all entries of `tree` (recursively, in
+    tree order), including directories, whose paths end with a slash.
+    """
+    for name, mode, sha in tree.iteritems():
+        path = prefix + name
+        if stat.S_ISDIR(mode):
+            yield path + '/', mode, sha
+            for entry in iter_entries(repo, repo.get_tree(sha), path + '/'):
+                yield entry
+        elif stat.S_ISREG(mode) or stat.S_ISLNK(mode):
+            yield path, mode, sha
+        else:
+            # Submodule; `git archive` adds an empty directory.
+            yield path + '/', stat.S_IFDIR, None
+
+
+def _iter_tar(repo, entries, mtime):
+    offset = 0
+    for path, mode, sha in entries:
+        info = tarfile.TarInfo(path.rstrip('/'))
+        info.mtime = mtime
+        info.uname = info.gname = 'root'
+        stream = None
+        if stat.S_ISDIR(mode):
+            info.type = tarfile.DIRTYPE
+            info.mode = 0o775
+        elif stat.S_ISLNK(mode):
+            info.type = tarfile.SYMTYPE
+            info.mode = 0o777
+            info.linkname = repo[sha].data
+        else:
+            stream = open_object(repo.object_store, sha)
+            info.size = stream.size
+            info.mode = 0o775 if mode & 0o111 else 0o664
+        header = info.tobuf(tarfile.GNU_FORMAT)
+        offset += len(header)
+        yield header
+        if stream is not None:
+            for chunk in stream.chunks:
+                yield chunk
+            blocks, remainder = divmod(info.size, tarfile.BLOCKSIZE)
+            if remainder:
+                blocks += 1
+                yield tarfile.NUL * (tarfile.BLOCKSIZE - remainder)
+            offset += blocks * tarfile.BLOCKSIZE
+    # End of archive marker, padded to a full record like `tarfile` does.
+    offset += 2 * tarfile.BLOCKSIZE
+    yield tarfile.NUL * (2 * tarfile.BLOCKSIZE + -offset % tarfile.RECORDSIZE)
+
+
+def _iter_gzip(chunks, mtime):
+    yield '\037\213\010\000' + struct.pack('<L', mtime) + '\000\377'
+    compressor = zlib.compressobj(COMPRESSION_LEVEL, zlib.DEFLATED,
+                                  -zlib.MAX_WBITS)
+    crc = zlib.crc32('')
+    size = 0
+    for chunk in chunks:
+        crc = zlib.crc32(chunk, crc)
+        size += len(chunk)
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush() + struct.pack('<LL', crc & 0xffffffff,
+                                           size & 0xffffffff)
+
+
+# Zip files are written with a data descriptor after each file, since the
+# CRC and compressed size are only known after compressing it.  Sizes and
+# offsets that don't fit into 32 bits are stored in ZIP64 fields.
+ZIP_LOCAL_HEADER = struct.Struct('<4s5H3L2H')
+ZIP_DATA_DESCRIPTOR = struct.Struct('<4sL2L')
+ZIP64_DATA_DESCRIPTOR = struct.Struct('<4sL2Q')
+ZIP_CENTRAL_DIRECTORY = struct.Struct('<4s6H3L5H2L')
+ZIP64_END_OF_CENTRAL_DIRECTORY = struct.Struct('<4sQ2H2L4Q')
+ZIP64_END_LOCATOR = struct.Struct('<4sLQL')
+ZIP_END_OF_CENTRAL_DIRECTORY = struct.Struct('<4s4H2LH')
+ZIP_MAX = 0xffffffff
+ZIP_STORED = 0
+ZIP_FLAG_DATA_DESCRIPTOR = 0x08
+ZIP_FLAG_UTF8 = 0x800
+
+
+def _iter_zip(repo, entries, mtime):
+    year, month, day, hour, minute, second = time.gmtime(mtime)[:6]
+    dos_date = (max(year, 1980) - 1980) << 9 | month << 5 | day
+    dos_time = hour << 11 | minute << 5 | second // 2
+    directory = []
+    offset = 0
+
+    for path, mode, sha in entries:
+        flags = 0
+        try:
+            path.decode('ascii')
+        except UnicodeDecodeError:
+            try:
+                path.decode('utf-8')
+                flags |= ZIP_FLAG_UTF8
+            except UnicodeDecodeError:
+                pass
+
+        if stat.S_ISDIR(mode):
+            chunks, size, method = None, 0, ZIP_STORED
+            attrs = (stat.S_IFDIR | 0o775) << 16 | 0x10
+        else:
+            stream = open_object(repo.object_store, sha)
+            chunks, size, method = stream.chunks, stream.size, zlib.DEFLATED
+            if stat.S_ISLNK(mode):
+                attrs = (stat.S_IFLNK | 0o777) << 16
+            else:
+                attrs = (stat.S_IFREG |
+                         (0o775 if mode & 0o111 else 0o664)) << 16
+        flags |= ZIP_FLAG_DATA_DESCRIPTOR
+        # Compressed data may be slightly larger than the original.
+        zip64 = size >= ZIP_MAX - (1 << 20)
+
+        if zip64:
+            extra = struct.pack('<2H2Q', 1, 16, size, 0)
+            header_sizes = (ZIP_MAX, ZIP_MAX)
+        else:
+            extra = ''
+            header_sizes = (0, 0)
+        header = ZIP_LOCAL_HEADER.pack(
+            'PK\003\004', 45 if zip64 else 20, flags, method, dos_time,
+            dos_date, 0, header_sizes[0], header_sizes[1], len(path),
+            len(extra)) + path + extra
+        yield header
+
+        crc = zlib.crc32('')
+        compressed_size = 0
+        data = ''
+        if chunks is not None:
+            compressor = zlib.compressobj(COMPRESSION_LEVEL, zlib.DEFLATED,
+                                          -zlib.MAX_WBITS)
+            for chunk in chunks:
+                crc = zlib.crc32(chunk, crc)
+                data = compressor.compress(chunk)
+                if data:
+                    compressed_size += len(data)
+                    yield data
+            data = compressor.flush()
+            compressed_size += len(data)
+        crc &= 0xffffffff
+        if zip64:
+            descriptor = ZIP64_DATA_DESCRIPTOR.pack(
+                'PK\007\010', crc, compressed_size, size)
+        else:
+            descriptor = ZIP_DATA_DESCRIPTOR.pack(
+                'PK\007\010', crc, compressed_size, size)
+        yield data + descriptor
+
+        directory.append((path, flags, method, crc, compressed_size, size,
+                          attrs, offset))
+        offset += len(header) + compressed_size + len(descriptor)
+
+    start = offset
+    for path, flags, method, crc, compressed_size, size, attrs, \
+            header_offset in directory:
+        # ZIP64 extra fields only contain the values that don't fit.
+        values = [value for value in [size, compressed_size, header_offset]
+                  if value >= ZIP_MAX]
+        extra = ''
+        if values:
+            extra = struct.pack('<2H%dQ' % len(values), 1, 8 * len(values),
+                                *values)
+        record = ZIP_CENTRAL_DIRECTORY.pack(
+            'PK\001\002', 3 << 8 | 45, 45 if values else 20, flags, method,
+            dos_time, dos_date, crc, min(compressed_size, ZIP_MAX),
+            min(size, ZIP_MAX), len(path), len(extra), 0, 0, 0, attrs,
+            min(header_offset, ZIP_MAX)) + path + extra
+        offset += len(record)
+        yield record
+
+    count, directory_size = len(directory), offset - start
+    end = ''
+    if count >= 0xffff or offset >= ZIP_MAX:
+        end = ZIP64_END_OF_CENTRAL_DIRECTORY.pack(
+            'PK\006\006', ZIP64_END_OF_CENTRAL_DIRECTORY.size - 12, 3 << 8 | 45,
+            45, 0, 0, count, count, directory_size, start)
+        end += ZIP64_END_LOCATOR.pack('PK\006\007', 0, offset, 1)
+    yield end + ZIP_END_OF_CENTRAL_DIRECTORY.pack(
+        'PK\005\006', 0, 0, min(count, 0xffff), min(count, 0xffff),
+        min(directory_size, ZIP_MAX), min(start, ZIP_MAX), 0)
+
+
+def get_cache_size():
+    return getattr(settings, 'KLAUS_ARCHIVE_CACHE_SIZE', DEFAULT_CACHE_SIZE)
+
+
+def get_cache_dir(repo):
+    """ Returns the archive cache directory for `repo`, or None. """
+    if not get_cache_size():
+        return None
+    return getattr(settings, 'KLAUS_ARCHIVE_CACHE_DIR', None) or \
+        repo.cache_path('archives')
+
+
+def get_cache_path(repo, commit, format, prefix):
+    """
+    Returns the path of the `generate(repo, commit, format, prefix)`
+    archive in the archive cache, or None if the cache is disabled.
+    """
+    cache_dir = get_cache_dir(repo)
+    if cache_dir is None:
+        return None
+    key = hashlib.sha1(repr((ARCHIVE_VERSION, commit.tree, format, prefix,
+                             commit.commit_time))).hexdigest()
+    return os.path.join(cache_dir, '%s.%s' % (key, format))
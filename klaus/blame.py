@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+"""
+Blame: the commit that last changed each line of a file, like `git blame`.
+
+The blame of a file in a commit is derived from its blames in the commit's
+parents and the diffs against them: lines that are also in a parent's version
+of the file keep the commit the parent's blame gives them (the first parent's
+wins), all others are attributed to the commit itself.  Only the commits that
+changed the file (those `CommitGraph.walk` yields for its path) need to be
+looked at; every other commit has the same blame as the last of them.
+
+Blames are cached per (commit that changed the file, path) in Django's cache
+framework (see `klaus.cache`), so after a new commit, blaming the file takes
+one diff against the previous version's cached blame.  A blame is stored as
+the list of commits involved and an array with the index of each line's
+commit in that list.
+
+Renames are not followed: the lines of a renamed file are attributed to the
+commit that renamed it.
+"""
+import difflib
+import marshal
+import zlib
+from array import array
+
+from django.conf import settings
+
+from klaus import cache, timing
+
+#: Part of the cache keys; increase on changes to the blame computation.
+BLAME_CACHE_VERSION = 1
+
+#: Marks lines whose commit isn't known yet.
+_UNKNOWN = -1
+
+
+class Blame(object):
+    """
+    The blame of a file: `lines[i]` is the index in `commits` of the SHA of
+    the commit that last changed line `i` (counting from 0).
+    """
+    def __init__(self, commits, lines):
+        self.commits = commits
+        self.lines = lines
+
+    def __len__(self):
+        return len(self.lines)
+
+    def runs(self, start=0, stop=None):
+        """
+        Yields `(sha, start, stop)` for each run of consecutive lines between
+        `start` and `stop` that were last changed by commit `sha`.
+        """
+        if stop is None or stop > len(self.lines):
+            stop = len(self.lines)
+        run_start = start
+        for i in xrange(start + 1, stop + 1):
+            if i == stop or self.lines[i] != self.lines[run_start]:
+                yield self.commits[self.lines[run_start]], run_start, i
+                run_start = i
+
+    def pack(self):
+        return zlib.compress(marshal.dumps((tuple(self.commits),
+                                            self.lines.tostring())))
+
+    @classmethod
+    def unpack(cls, data):
+        commits, lines = marshal.loads(zlib.decompress(data))
+        return cls(list(commits), array('i', lines))
+
+
+def get_blame(repo, commit, path):
+    """
+    Returns the `Blame` of the file at `path` in `commit`.  Raises `KeyError`
+    if there is no such file.
+    """
+    if repo.get_path_entry(commit.tree, path) is None:
+        raise KeyError(path)
+    graph = repo.get_commit_graph()
+    path_index = repo.get_path_index()
+
+    def last_change(sha):
+        pos = next(graph.walk(sha, path, path_index), None)
+        return graph.shas[pos]
+
+    with timing.timed('blame'):
+        return _Blamer(repo, path, last_change).blame(last_change(commit.id))
+
+
+class _Blamer(object):
+    """
+    Computes the blame of the file at `path` in a commit that changed it,
+    after those in the commits that changed it before, using (and filling)
+    the cache.  `last_change(sha)` must return the SHA of the last commit up
+    to `sha` that changed the file.
+    """
+    def __init__(self, repo, path, last_change):
+        self.repo = repo
+        self.path = path
+        self.last_change = last_change
+        self.blames = {}            # sha -> Blame
+        self.parents = {}           # sha -> [SHAs of the parents' versions]
+        self.users = {}             # sha -> number of blames still needing it
+
+    def blame(self, sha):
+        # Find the versions that are not cached, and those they depend on.
+        order = []                  # parents before children
+        seen = set()
+        stack = [(sha, False)]
+        while stack:
+            version, expanded = stack.pop()
+            if expanded:
+                order.append(version)
+            elif version not in seen:
+                seen.add(version)
+                blame = self._get_cached(version)
+                if blame is not None:
+                    self.blames[version] = blame
+                else:
+                    stack.append((version, True))
+                    stack.extend((parent, False)
+                                 for parent in self._get_parents(version))
+
+        for version in order:
+            parents = self.parents[version]
+            blame = self.blames[version] = self._compute(version, parents)
+            self._set_cached(version, blame)
+            for parent in parents:
+                self._release(parent)
+        return self.blames[sha]
+
+    def _get_parents(self, sha):
+        """
+        Returns the SHAs of the last commits that changed the file up to each
+        of the parents of commit `sha` that have the file.
+        """
+        parents = self.parents[sha] = []
+        for parent in self.repo[sha].parents:
+            if self._get_entry(parent) is not None:
+                parents.append(self.last_change(parent))
+        for parent in parents:
+            self.users[parent] = self.users.get(parent, 0) + 1
+        return parents
+
+    def _release(self, sha):
+        """ Forgets the blame of `sha` once no other blame needs it. """
+        self.users[sha] -= 1
+        if not self.users[sha]:
+            del self.users[sha]
+            self.blames.pop(sha, None)
+
+    def _compute(self, sha, parents):
+        timing.count('blame-steps')
+        lines = self._get_lines(sha)
+        owners = array('i', [_UNKNOWN]) * len(lines)
+        commits = [sha]
+        for parent in parents:
+            parent_blame = self.blames[parent]
+            indexes = {}            # index in parent_blame -> index in commits
+            matcher = difflib.SequenceMatcher(None, self._get_lines(parent),
+                                              lines, autojunk=False)
+            for parent_start, start, size in matcher.get_matching_blocks():
+                for i in xrange(size):
+                    if owners[start + i] != _UNKNOWN:
+                        continue
+                    index = parent_blame.lines[parent_start + i]
+                    if index not in indexes:
+                        indexes[index] = len(commits)
+                        commits.append(parent_blame.commits[index])
+                    owners[start + i] = indexes[index]
+        for i, owner in enumerate(owners):
+            if owner == _UNKNOWN:
+                owners[i] = 0
+        return Blame(commits, owners)
+
+    def _get_entry(self, sha):
+        return self.repo.get_path_entry(self.repo[sha].tree, self.path)
+
+    def _get_lines(self, sha):
+        return split_lines(self.repo[self._get_entry(sha)[1]].data)
+
+    def _cache_key(self, sha):
+        return cache.make_key('blame', sha, self.path, BLAME_CACHE_VERSION)
+
+    def _get_cached(self, sha):
+        data = cache.get(self._cache_key(sha))
+        return Blame.unpack(data) if data is not None else None
+
+    def _set_cached(self, sha, blame):
+        data = blame.pack()
+        if len(data) <= getattr(settings, 'KLAUS_CACHE_MAX_SIZE',
+                                cache.DEFAULT_MAX_SIZE):
+            cache.set(self._cache_key(sha), data)
+
+
+def split_lines(data):
+    """
+    Splits `data` into lines the way Git counts them.
+
+    >>> split_lines('a\\r\\nb\\n\\nc')
+    ['a\\r', 'b', '', 'c']
+    """
+    lines = data.split('\n')
+    if lines[-1] == '':
+        lines.pop()
+    return lines
@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+"""
+Helpers for caching derived data (rendered blobs, diffs, ...) in Django's
+cache framework.
+
+klaus uses the cache named by the `KLAUS_CACHE` setting (``'default'`` if not
+given), so it is a good idea to give klaus its own, size-bounded cache, e.g.::
+
+    CACHES = {
+        'default': {...},
+        'klaus': {
+            'BACKEND': 'django.core.cache.backends.memcached.MemcachedCache',
+            'LOCATION': '127.0.0.1:11211',
+        },
+    }
+    KLAUS_CACHE = 'klaus'
+
+All keys are derived from Git object SHAs, so entries never become stale;
+`KLAUS_CACHE_TIMEOUT` only controls how long unused entries are kept.
+"""
+import hashlib
+
+from django.conf import settings
+
+try:
+    from django.core.cache import caches
+except ImportError:
+    # Django < 1.7
+    from django.core.cache import get_cache
+else:
+    get_cache = caches.__getitem__
+
+
+#: Don't cache values larger than this many bytes (memcached refuses
+#: items larger than 1 MB anyway).
+DEFAULT_MAX_SIZE = 1024 * 1024
+
+DEFAULT_TIMEOUT = 7 * 24 * 60 * 60
+
+
+def get_klaus_cache():
+    return get_cache(getattr(settings, 'KLAUS_CACHE', 'default'))
+
+
+def make_key(*parts):
+    """
+    Returns a cache key for `parts`, which must have a stable `repr`.
+
+    >>> make_key('blob', 'e69de29bb2d1d6434b8b29ae775ad8c2e48c5391')
+    'klaus:blob:...'
+    """
+    return 'klaus:%s:%s' % (parts[0], hashlib.sha1(repr(parts)).hexdigest())
+
+
+def get_or_create(key, create, size=len):
+    """
+    Returns the value cached under `key`. On misses, calls `create()` and
+    caches the result, unless its `size` is larger than
+    `KLAUS_CACHE_MAX_SIZE`. Pass ``size=None`` for values of negligible size.
+    """
+    value = get(key)
+    if value is None:
+        value = create()
+        max_size = getattr(settings, 'KLAUS_CACHE_MAX_SIZE', DEFAULT_MAX_SIZE)
+        if size is None or size(value) <= max_size:
+            set(key, value)
+    return value
+
+
+def get(key):
+    """ Returns the value cached under `key`, or None. """
+    return get_klaus_cache().get(key)
+
+
+def set(key, value):
+    """ Caches `value` under `key` for `KLAUS_CACHE_TIMEOUT` seconds. """
+    get_klaus_cache().set(key, value, getattr(settings, 'KLAUS_CACHE_TIMEOUT',
+                                              DEFAULT_TIMEOUT))
@@ -0,0 +1,329 @@
+# -*- coding: utf-8 -*-
+"""
+Code search over the files on each repository's default branch.
+
+Each repository has a `CodeIndex`, a trigram index: for every sequence of
+three bytes (lowercased) that occurs in any file, the list of files that
+contain it.  A search for a string only has to read the files that contain all
+of the string's trigrams, which usually are very few.
+
+The index is stored in the repo's klaus cache directory (see
+`FancyRepo.cache_path`).  When the default branch moves, only the files that
+changed (according to a tree diff between the indexed and the current commit)
+are re-indexed.
+
+Indexes are built and updated by a background thread, never while serving a
+search: searches read the indexes as last saved, and queue the repos whose
+index is missing or may be out of date (and repos that change after they have
+been searched) for an update.  Repos without an index yet are left out of the
+results.  Searches don't check the repos for changes themselves; they rely on
+the last known state tokens (see `RepoManager.get_known_state`), which are
+kept up to date by the watcher (`KLAUS_WATCH_INTERVAL`) or else rechecked in
+the background every `RECHECK_INTERVAL` seconds.
+
+Loaded indexes are kept in memory (at most `KLAUS_SEARCH_CACHE_SIZE` of them,
+if set), with their posting lists packed into strings the way they are
+stored; repos are only opened to read the files that may match, without
+pushing other repos out of the open repos.
+"""
+import marshal
+import os
+import stat
+import sys
+import time
+import zlib
+from array import array
+
+from django.conf import settings
+
+from klaus import timing
+from klaus.objects import probe_object
+from klaus.objectstore import SynchronizedLRUCache
+from klaus.repo import RepoManager
+from klaus.updater import IndexUpdater
+from klaus.utils import atomic_write, force_unicode, trigrams
+
+#: Queries must be at least this long to use the index.
+MIN_QUERY_LENGTH = 3
+
+#: Without a watcher, check searched repos for changes this often (seconds).
+RECHECK_INTERVAL = 60
+
+
+class CodeIndex(object):
+    """
+    The trigram index of the files at the tip of a repo's default branch,
+    stored at `path`.
+
+    Files are identified by numbers, which are never reused: files that
+    changed are removed (their number is kept in the posting lists but
+    ignored) and added under a new number.  Once more than half of the numbers
+    belong to removed files, the index is rebuilt.
+    """
+    FORMAT_VERSION = 1
+    FILENAME = 'code-index'
+
+    def __init__(self, path):
+        self.path = path
+        self._clear()
+        self._load()
+
+    def _clear(self):
+        self.commit = None          # SHA of the indexed commit
+        self.tree = None            # SHA of its tree
+        self.paths = []             # file number -> path, None if removed
+        self.shas = []              # file number -> blob SHA
+        # trigram -> array of file numbers, or a string of their bytes as
+        # long as they are only read
+        self.postings = {}
+        self.numbers = {}           # path -> file number
+        self.removed = 0
+
+    def _load(self):
+        try:
+            with open(self.path, 'rb') as fileobj:
+                data = marshal.loads(zlib.decompress(fileobj.read()))
+        except (IOError, EOFError, ValueError, TypeError, zlib.error):
+            return
+
+        if not isinstance(data, tuple) or not data or \
+           data[0] != self.FORMAT_VERSION:
+            # Outdated or corrupt; rebuild from scratch.
+            return
+
+        _, self.commit, self.tree, paths, shas, self.postings = data
+        self.paths = list(paths)
+        self.shas = list(shas)
+        for number, path in enumerate(self.paths):
+            if path is None:
+                self.removed += 1
+            else:
+                self.numbers[path] = number
+
+    def save(self):
+        data = (
+            self.FORMAT_VERSION,
+            self.commit,
+            self.tree,
+            tuple(self.paths),
+            tuple(self.shas),
+            dict((trigram, _pack(numbers))
+                 for trigram, numbers in self.postings.iteritems()),
+        )
+        atomic_write(self.path, zlib.compress(marshal.dumps(data)))
+
+    def update(self, repo):
+        """
+        Brings the index up to date with `repo`'s default branch and saves it
+        if anything changed.
+        """
+        branch = repo.get_default_branch()
+        commit = repo.get_commit(branch) if branch is not None else None
+        if commit is None:
+            if self.commit is None:
+                return False
+            self._clear()
+        elif commit.id == self.commit:
+            return False
+        else:
+            if self.removed > len(self.numbers):
+                self._clear()
+            changes = repo.object_store.tree_changes(self.tree, commit.tree)
+            for (oldpath, newpath), (_, newmode), (_, newsha) in changes:
+                if oldpath is not None:
+                    self._remove(oldpath)
+                if newpath is not None and stat.S_ISREG(newmode):
+                    self._add(repo, newpath, newsha)
+            self.commit, self.tree = commit.id, commit.tree
+
+        self.save()
+        return True
+
+    def _add(self, repo, path, sha):
+        max_size = getattr(settings, 'KLAUS_SEARCH_MAX_FILE_SIZE', 1024 * 1024)
+        try:
+            info = probe_object(repo.object_store, sha)
+        except KeyError:
+            return
+        if info.size > max_size or info.is_binary is not False:
+            return
+
+        number = len(self.paths)
+        self.paths.append(path)
+        self.shas.append(sha)
+        self.numbers[path] = number
+        for trigram in trigrams(repo[sha].as_raw_string().lower()):
+            numbers = self.postings.get(trigram)
+            if numbers is None:
+                numbers = self.postings[trigram] = array('i')
+            elif isinstance(numbers, str):
+                numbers = self.postings[trigram] = _unpack(numbers)
+            numbers.append(number)
+
+    def _remove(self, path):
+        number = self.numbers.pop(path, None)
+        if number is not None:
+            self.paths[number] = None
+            self.removed += 1
+
+    def candidates(self, query):
+        """
+        Returns the sorted `(path, sha)` pairs of the files that may contain
+        `query` (a lowercased byte string of at least `MIN_QUERY_LENGTH`
+        bytes): those that contain all of its trigrams.
+        """
+        postings = []
+        for trigram in trigrams(query):
+            numbers = self.postings.get(trigram)
+            if numbers is None:
+                return []
+            postings.append(_unpack(numbers))
+        postings.sort(key=len)
+
+        numbers = set(postings[0])
+        for other in postings[1:]:
+            numbers.intersection_update(other)
+            if not numbers:
+                break
+        return sorted((self.paths[number], self.shas[number])
+                      for number in numbers
+                      if self.paths[number] is not None)
+
+
+def _pack(numbers):
+    if isinstance(numbers, str):
+        return numbers
+    return numbers.tostring()
+
+
+def _unpack(numbers):
+    if isinstance(numbers, str):
+        return array('i', numbers)
+    return numbers
+
+
+def grep(repo, files, query, max_lines):
+    """
+    Yields `(path, lines)` for those of `files` (`(path, sha)` pairs of
+    `repo`) that contain `query`, a lowercased byte string, ignoring case;
+    `lines` is a list of `(line number, line)` tuples of the matching lines.
+    At most `max_lines` lines are returned in total.
+    """
+    for path, sha in files:
+        if max_lines <= 0:
+            break
+        lines = []
+        data = repo[sha].as_raw_string()
+        for lineno, line in enumerate(data.splitlines(), 1):
+            if query in line.lower():
+                lines.append((lineno, force_unicode(line)))
+                if len(lines) == max_lines:
+                    break
+        if lines:
+            max_lines -= len(lines)
+            yield path, lines
+
+
+# name -> (identity of the index file, CodeIndex)
+_indexes = SynchronizedLRUCache(
+    getattr(settings, 'KLAUS_SEARCH_CACHE_SIZE', None) or sys.maxint)
+# name -> state token of the repo when its index was last updated
+_indexed_states = {}
+# name -> time of the last update (and check for changes) of its index
+_checked_at = {}
+
+
+def get_index(repo_name):
+    """
+    Returns the saved `CodeIndex` of the repo called `repo_name`, or None if
+    there is none yet.  Queues an update of the index unless it is known to be
+    up to date.
+    """
+    state = RepoManager.get_known_state(repo_name)
+    if state is None or _indexed_states.get(repo_name) != state or \
+       not getattr(settings, 'KLAUS_WATCH_INTERVAL', 0) and \
+       time.time() - _checked_at.get(repo_name, 0) > RECHECK_INTERVAL:
+        schedule_update(repo_name)
+
+    path = RepoManager.cache_path(repo_name, CodeIndex.FILENAME)
+    try:
+        st = os.stat(path)
+    except OSError:
+        if _indexed_states.get(repo_name) is None:
+            return None
+        # Indexed, but there is nothing to index (e.g. an empty repo)
+        return CodeIndex(path)
+    identity = (st.st_ino, st.st_mtime, st.st_size)
+
+    cached = _indexes.get(repo_name)
+    if cached is not None and cached[0] == identity:
+        return cached[1]
+    with timing.timed('load-code_index'):
+        index = CodeIndex(path)
+    _indexes.add(repo_name, (identity, index))
+    return index
+
+
+def update_index(repo_name):
+    """
+    Brings the index of the repo called `repo_name` up to date (see
+    `CodeIndex.update`).
+    """
+    _checked_at[repo_name] = time.time()
+    state = RepoManager.get_state(repo_name)
+    path = RepoManager.cache_path(repo_name, CodeIndex.FILENAME)
+    with RepoManager.borrow_repo(repo_name) as repo:
+        CodeIndex(path).update(repo)
+    _indexed_states[repo_name] = state
+
+
+_updater = IndexUpdater('klaus-code-indexer')
+
+
+def schedule_update(repo_name):
+    """ Queues an update of the index of the repo called `repo_name`. """
+    _updater.schedule(repo_name, update_index, repo_name)
+
+
+def search(repo_names, query, max_lines):
+    """
+    Searches the default branch of each of the repos called `repo_names` for
+    `query`, a unicode string, ignoring case.  Returns a list of dicts with
+    keys `repo` (the repo's name), `commit` (the SHA of the commit searched),
+    `path` and `lines` (see `grep`), with at most `max_lines` lines in total,
+    and the names of the repos that could not be searched because they have
+    not been indexed yet.
+    """
+    query = query.encode('utf-8').lower()
+    results = []
+    unindexed = []
+    for name in repo_names:
+        if max_lines <= 0:
+            break
+        index = get_index(name)
+        if index is None:
+            unindexed.append(name)
+            continue
+        with timing.timed('search'):
+            files = index.candidates(query)
+            if not files:
+                continue
+            with RepoManager.borrow_repo(name) as repo:
+                found = list(grep(repo, files, query, max_lines))
+        for path, lines in found:
+            results.append({
+                'repo': name,
+                'commit': index.commit,
+                'path': force_unicode(path),
+                'lines': lines,
+            })
+            max_lines -= len(lines)
+    return results, unindexed
+
+
+def _schedule_indexed(repo_name, state):
+    if repo_name in _indexed_states:
+        schedule_update(repo_name)
+
+
+RepoManager.add_invalidation_callback(_schedule_indexed)
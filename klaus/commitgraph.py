@@ -0,0 +1,310 @@
+# -*- coding: utf-8 -*-
+"""
+A persistent, incrementally updated index of a repository's commit graph.
+
+For each commit the index stores its tree, its parents, its commit time and
+two generation numbers: the topological level (the length of the longest path
+to a root commit) and the corrected commit time, which is the commit time
+bumped so that every commit is newer than all of its parents (this is what
+Git calls "generation number v2").  Walking the graph ordered by corrected
+commit time visits children strictly before their parents, which is what
+makes the walk in `CommitGraph.walk` work without a "seen" set.
+
+Commits are stored at integer positions, parents always before their
+children, so the index can be extended by appending new commits whenever refs
+move.
+"""
+import binascii
+import heapq
+import marshal
+from array import array
+
+import dulwich.objects
+
+from klaus.pathindex import MAX_PARENTS
+from klaus.utils import save_cache_file
+
+
+class CommitGraph(object):
+    """
+    The commit graph of `repo`, stored in the repo's klaus cache directory
+    (see `FancyRepo.cache_path`).
+    """
+    FORMAT_VERSION = 1
+    FILENAME = 'commit-graph'
+
+    def __init__(self, repo):
+        self.repo = repo
+        self.path = repo.cache_path(self.FILENAME)
+        self._clear()
+        self._load()
+
+    def __len__(self):
+        return len(self.shas)
+
+    def __contains__(self, sha):
+        return sha in self.positions
+
+    def _clear(self):
+        self.shas = []              # position -> commit SHA
+        self.trees = []             # position -> tree SHA
+        self.positions = {}         # commit SHA -> position
+        self.commit_times = array('l')
+        self.levels = array('l')
+        self.corrected_times = array('l')
+        # The parents' positions of commit `n` are
+        # `_parents[_parent_offsets[n]:_parent_offsets[n + 1]]`
+        self._parent_offsets = array('l', [0])
+        self._parents = array('l')
+        self.tips = frozenset()
+
+    def _load(self):
+        try:
+            with open(self.path, 'rb') as fileobj:
+                data = marshal.load(fileobj)
+        except (IOError, EOFError, ValueError, TypeError):
+            return
+
+        if not isinstance(data, tuple) or not data or \
+           data[0] != self.FORMAT_VERSION:
+            # Outdated or corrupt; rebuild from scratch.
+            return
+
+        _, shas, trees, commit_times, levels, corrected_times, \
+            parent_offsets, parents, tips = data
+        self.shas = _split_shas(shas)
+        self.trees = _split_shas(trees)
+        self.positions = dict((sha, pos) for pos, sha in enumerate(self.shas))
+        self.commit_times.fromstring(commit_times)
+        self.levels.fromstring(levels)
+        self.corrected_times.fromstring(corrected_times)
+        self._parent_offsets = array('l')
+        self._parent_offsets.fromstring(parent_offsets)
+        self._parents.fromstring(parents)
+        self.tips = frozenset(_split_shas(tips))
+
+    def save(self):
+        data = (
+            self.FORMAT_VERSION,
+            _join_shas(self.shas),
+            _join_shas(self.trees),
+            self.commit_times.tostring(),
+            self.levels.tostring(),
+            self.corrected_times.tostring(),
+            self._parent_offsets.tostring(),
+            self._parents.tostring(),
+            _join_shas(self.tips),
+        )
+        save_cache_file(self.path, marshal.dumps(data))
+
+    def update(self):
+        """
+        Indexes all commits reachable from the repo's refs that are not in the
+        index yet and saves the index if anything changed.
+        """
+        tips = set()
+        for refname, sha in self.repo.get_refs().iteritems():
+            try:
+                obj = self.repo[sha]
+                while isinstance(obj, dulwich.objects.Tag):
+                    obj = self.repo[obj.object[1]]
+            except KeyError:
+                # Broken ref
+                continue
+            if isinstance(obj, dulwich.objects.Commit):
+                tips.add(obj.id)
+
+        if tips == self.tips:
+            return False
+
+        for sha in tips:
+            self.add(sha)
+        self.tips = frozenset(tips)
+        self.save()
+        return True
+
+    def add(self, sha):
+        """
+        Indexes commit `sha` and all of its ancestors, unless already indexed.
+        Returns the position of `sha`.
+        """
+        pending = {}
+        missing = set()
+        stack = [sha]
+        while stack:
+            current = stack[-1]
+            if current in self.positions or current in missing:
+                stack.pop()
+                continue
+
+            if current not in pending:
+                try:
+                    commit = self.repo[current]
+                except KeyError:
+                    # Parent missing from the object store, as in
+                    # shallow clones.
+                    missing.add(current)
+                    stack.pop()
+                    continue
+                pending[current] = (commit.tree, commit.parents,
+                                    commit.commit_time)
+
+            tree, parents, commit_time = pending[current]
+            unindexed = [parent for parent in parents
+                         if parent not in self.positions and
+                         parent not in missing]
+            if unindexed:
+                stack.extend(unindexed)
+                continue
+
+            stack.pop()
+            del pending[current]
+            self._append(current, tree, commit_time,
+                         [self.positions[parent] for parent in parents
+                          if parent not in missing])
+
+        return self.positions[sha]
+
+    def _append(self, sha, tree, commit_time, parents):
+        level = 1
+        corrected_time = commit_time
+        for parent in parents:
+            level = max(level, self.levels[parent] + 1)
+            corrected_time = max(corrected_time,
+                                 self.corrected_times[parent] + 1)
+
+        self.positions[sha] = len(self.shas)
+        self.shas.append(sha)
+        self.trees.append(tree)
+        self.commit_times.append(commit_time)
+        self.levels.append(level)
+        self.corrected_times.append(corrected_time)
+        self._parents.extend(parents)
+        self._parent_offsets.append(len(self._parents))
+
+    def parents(self, pos):
+        """ Returns the positions of the parents of the commit at `pos`. """
+        return self._parents[self._parent_offsets[pos]:
+                             self._parent_offsets[pos + 1]]
+
+    def walk(self, sha, path=None, path_index=None):
+        """
+        Returns an iterator over the positions of all commits reachable from
+        commit `sha`, newest first.
+
+        If `path` is given, history is simplified the way `git log -- path`
+        does it: only commits that changed `path` compared to all of their
+        parents are yielded, and merges that did not change `path` compared to
+        one of their parents are only followed along that parent.
+
+        Pass the repo's `PathIndex` as `path_index` to look up which commits
+        changed `path` there instead of in the commits' trees (which are still
+        read for the commits the index doesn't cover yet).
+
+        The iterator is a `GraphWalk`, which can be suspended and resumed
+        later on with `resume`.
+        """
+        if sha not in self.positions:
+            # Not reachable from any ref (yet).
+            with self.repo._lock:
+                self.add(sha)
+                self.save()
+        return self.resume([sha], path, path_index)
+
+    def resume(self, frontier, path=None, path_index=None):
+        """
+        Continues a walk from its `GraphWalk.frontier`, which must only
+        contain indexed commits.
+        """
+        return GraphWalk(self, [self.positions[sha] for sha in frontier], path,
+                         path_index)
+
+
+class GraphWalk(object):
+    """
+    Iterates over the positions of the commits of a `CommitGraph`, see
+    `CommitGraph.walk`.
+
+    The state of the walk between two commits is its `frontier`, the commits
+    that are to be visited next.  It is usually small (one commit per line of
+    development that is "open" at that point), so it can be used as a cursor
+    to continue the walk from, instead of walking (and skipping) all commits
+    before it.
+    """
+    def __init__(self, graph, positions, path=None, path_index=None):
+        self.graph = graph
+        self.path = path
+        self.path_index = path_index
+        if path and path_index:
+            self._indexed, self._unindexed, self._changes = \
+                path_index.snapshot(path)
+        else:
+            self._indexed, self._unindexed, self._changes = 0, (), None
+        self._heap = [(-graph.corrected_times[pos], graph.shas[pos], pos)
+                      for pos in set(positions)]
+        heapq.heapify(self._heap)
+        self._last = None
+        self._entries = {}
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        graph, heap = self.graph, self._heap
+        while heap:
+            _, sha, pos = heapq.heappop(heap)
+            if pos == self._last:
+                # Pushed by more than one child.
+                continue
+            self._last = pos
+
+            parents = graph.parents(pos)
+            visit = True
+            if self._changes is not None and pos < self._indexed \
+               and pos not in self._unindexed:
+                change = pos * MAX_PARENTS
+                treesame = [parent for i, parent in enumerate(parents)
+                            if change + i not in self._changes]
+                if treesame:
+                    parents = treesame[:1]
+                    visit = False
+                else:
+                    visit = bool(parents) or change in self._changes
+            elif self.path:
+                entry = self._get_entry(pos)
+                del self._entries[pos]
+                treesame = [parent for parent in parents
+                            if self._get_entry(parent) == entry]
+                if treesame:
+                    parents = treesame[:1]
+                    visit = False
+                else:
+                    visit = bool(parents) or entry is not None
+
+            for parent in parents:
+                heapq.heappush(heap, (-graph.corrected_times[parent],
+                                      graph.shas[parent], parent))
+            if visit:
+                return pos
+        raise StopIteration
+
+    @property
+    def frontier(self):
+        """ The SHAs of the commits to visit next, newest first. """
+        return [sha for _, sha in sorted(set(
+            (key, sha) for key, sha, pos in self._heap if pos != self._last))]
+
+    def _get_entry(self, pos):
+        if pos not in self._entries:
+            self._entries[pos] = self.graph.repo.get_path_entry(
+                self.graph.trees[pos], self.path)
+        return self._entries[pos]
+
+
+def _join_shas(shas):
+    return binascii.unhexlify(''.join(shas))
+
+
+def _split_shas(data):
+    data = binascii.hexlify(data)
+    return [data[i:i+40] for i in xrange(0, len(data), 40)]
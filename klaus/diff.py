@@ -11,10 +11,13 @@
 import re
 from cgi import escape
 
+from klaus import timing
+
 
 def prepare_udiff(udiff, **kwargs):
     """Prepare an udiff for a template."""
-    return DiffRenderer(udiff).prepare(**kwargs)
+    with timing.timed('udiff'):
+        return DiffRenderer(udiff).prepare(**kwargs)
 
 
 class DiffRenderer(object):
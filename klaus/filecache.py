@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+"""
+Directories of cached files (archives, packs) that are filled while the files
+are sent to a client and that are kept below a size by removing the least
+recently used files.
+"""
+import os
+import tempfile
+import time
+
+#: Don't update the access time of cached files more often than this.
+TOUCH_INTERVAL = 60 * 60
+
+
+def open_cached(path):
+    """
+    Returns the cached file at `path`, opened for reading, or None if there
+    is no such file.
+    """
+    try:
+        fileobj = open(path, 'rb')
+    except IOError:
+        return None
+    try:
+        if time.time() - os.fstat(fileobj.fileno()).st_mtime > TOUCH_INTERVAL:
+            # The modification time tracks the last use, for `evict`.
+            os.utime(path, None)
+    except OSError:
+        pass
+    return fileobj
+
+
+def write_through(chunks, path, max_size):
+    """
+    Returns an iterator over `chunks` that writes them to the cache file
+    `path` on the way (see `CacheWriter`).  If the cache file can't be
+    created, `chunks` is returned as it is, so that errors don't happen while
+    a response is being sent.
+    """
+    cache_dir = os.path.dirname(path)
+    if not os.path.isdir(cache_dir):
+        try:
+            os.makedirs(cache_dir)
+        except OSError:
+            # Somebody else was faster, or we can't write there.
+            pass
+    try:
+        fd, tmp_path = tempfile.mkstemp(dir=cache_dir, prefix='.tmp-')
+    except OSError:
+        return chunks
+    return CacheWriter(chunks, os.fdopen(fd, 'wb'), tmp_path, path, max_size)
+
+
+class CacheWriter(object):
+    """
+    Iterates over `chunks` while writing them to `fileobj`, a temporary file
+    at `tmp_path`.  Once all chunks were consumed, the file is moved to
+    `path` and the cache directory is shrunk to `max_size` bytes; if
+    iteration stops early (or writing fails), the file is removed.
+    """
+    def __init__(self, chunks, fileobj, tmp_path, path, max_size):
+        self.chunks = chunks
+        self.fileobj = fileobj
+        self.tmp_path = tmp_path
+        self.path = path
+        self.max_size = max_size
+
+    def __iter__(self):
+        try:
+            for chunk in self.chunks:
+                if self.fileobj is not None:
+                    try:
+                        self.fileobj.write(chunk)
+                    except IOError:
+                        # E.g. the disk is full; send the rest uncached.
+                        self._discard()
+                yield chunk
+            if self.fileobj is not None:
+                self.fileobj.close()
+                self.fileobj = None
+                os.chmod(self.tmp_path, 0o644)
+                os.rename(self.tmp_path, self.path)
+                evict(os.path.dirname(self.path), self.max_size)
+        finally:
+            self.close()
+
+    def close(self):
+        """ Stops iteration, removing the file unless it was cached. """
+        self._discard()
+        close = getattr(self.chunks, 'close', None)
+        if close is not None:
+            close()
+
+    def _discard(self):
+        if self.fileobj is not None:
+            self.fileobj.close()
+            self.fileobj = None
+            try:
+                os.unlink(self.tmp_path)
+            except OSError:
+                pass
+
+
+def evict(cache_dir, max_size):
+    """
+    Removes the least recently used files from `cache_dir` until the rest
+    take up at most `max_size` bytes.
+    """
+    files = []
+    for name in os.listdir(cache_dir):
+        if name.startswith('.tmp-'):
+            continue
+        path = os.path.join(cache_dir, name)
+        try:
+            st = os.stat(path)
+        except OSError:
+            continue
+        files.append((st.st_mtime, st.st_size, path))
+
+    total = sum(size for _, size, _ in files)
+    for _, size, path in sorted(files):
+        if total <= max_size:
+            break
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+        total -= size
@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+"""
+Fast lookup of Pygments lexers.
+
+`pygments.lexers.get_lexer_for_filename` matches the filename against the
+filename patterns of every lexer on each call, and `guess_lexer` runs every
+lexer's `analyse_text` over the whole file.  Here, the patterns are indexed
+once at import time and the matching lexers are memoized per filename;
+`analyse_text` (to pick one of several matching lexers, and for guesses) only
+looks at the first `GUESS_LEXER_CHARS` characters, and guesses are cached per
+blob SHA.
+"""
+import fnmatch
+import os
+import re
+
+import pygments
+from pygments.lexers import find_lexer_class, guess_lexer
+from pygments.lexers._mapping import LEXERS
+from pygments.plugin import find_plugin_lexers
+
+from klaus import cache
+from klaus.objectstore import SynchronizedLRUCache
+
+#: Guess the lexer of files with an unknown name from this many characters.
+GUESS_LEXER_CHARS = 10000
+
+
+class LexerIndex(object):
+    """
+    The filename patterns of all lexers, indexed by the part that is matched
+    literally.  `find` picks one of the lexers whose patterns match a filename
+    by their priority, a bonus for patterns without wildcards and, if the
+    file's contents are given, what their `analyse_text` makes of them.
+    """
+    def __init__(self):
+        self.names = {}             # 'Makefile' -> [(lexer, pattern)]
+        self.suffixes = {}          # '.py' -> [(lexer, pattern)]
+        self.patterns = []          # [(regex, lexer, pattern)]
+        self._found = SynchronizedLRUCache(1000)
+
+        for _, name, _, patterns, _ in LEXERS.itervalues():
+            for pattern in patterns:
+                self.add(name, pattern)
+        for cls in find_plugin_lexers():
+            for pattern in cls.filenames:
+                self.add(cls, pattern)
+
+    def add(self, lexer, pattern):
+        """ Adds `lexer`, a lexer class or the name of a builtin lexer. """
+        if not _has_wildcards(pattern):
+            self.names.setdefault(pattern, []).append((lexer, pattern))
+        elif pattern.startswith('*') and not _has_wildcards(pattern[1:]):
+            self.suffixes.setdefault(pattern[1:], []).append((lexer, pattern))
+        else:
+            regex = re.compile(fnmatch.translate(pattern))
+            self.patterns.append((regex, lexer, pattern))
+
+    def find(self, filename, code=None):
+        """
+        Returns the lexer class for `filename` with contents `code`, or None
+        if no lexer's patterns match it.
+        """
+        matches = self.matches(filename)
+        if not matches:
+            return None
+        if len(matches) == 1:
+            return matches[0][0]
+        if code:
+            code = code[:GUESS_LEXER_CHARS]
+        return max(matches, key=lambda match: _rating(match, code))[0]
+
+    def matches(self, filename):
+        """
+        Returns the `(lexer class, pattern)` pairs of the lexers whose
+        patterns match `filename`.
+        """
+        filename = os.path.basename(filename)
+        try:
+            return self._found[filename]
+        except KeyError:
+            pass
+
+        matches = list(self.names.get(filename, []))
+        for pos in xrange(len(filename) + 1):
+            matches.extend(self.suffixes.get(filename[pos:], []))
+        matches.extend((lexer, pattern)
+                       for regex, lexer, pattern in self.patterns
+                       if regex.match(filename))
+        matches = [(_load(lexer), pattern) for lexer, pattern in matches]
+        self._found.add(filename, matches)
+        return matches
+
+
+def get_lexer(filename, code, sha=None, **options):
+    """
+    Returns a lexer for file `filename` with contents `code`, initialized with
+    `options`: By `filename` if possible, otherwise guessed from `code`.
+    Pass the blob's `sha` to cache the guess.
+    """
+    cls = lexer_index.find(filename, code) if filename else None
+    if cls is None:
+        cls = guess_lexer_class(code, sha)
+    return cls(**options)
+
+
+def guess_lexer_class(code, sha=None):
+    """
+    Returns the class of the lexer that `guess_lexer` picks for the start of
+    `code`, cached by `sha` if given.
+    """
+    guess = lambda: guess_lexer(code[:GUESS_LEXER_CHARS]).name
+    if sha is None:
+        name = guess()
+    else:
+        name = cache.get_or_create(
+            cache.make_key('guess_lexer', sha, pygments.__version__),
+            guess, size=None)
+    return find_lexer_class(name)
+
+
+def _has_wildcards(pattern):
+    return any(char in pattern for char in '*?[')
+
+
+def _load(lexer):
+    if isinstance(lexer, basestring):
+        return find_lexer_class(lexer)
+    return lexer
+
+
+def _rating(match, code):
+    # Like in `pygments.lexers.find_lexer_class_for_filename`
+    cls, pattern = match
+    rating = cls.priority
+    if '*' not in pattern:
+        rating += 0.5
+    if code:
+        rating += cls.analyse_text(code)
+    return rating, cls.__name__
+
+
+lexer_index = LexerIndex()
@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+import os
+
+from django.core.management.base import BaseCommand, CommandError
+
+from klaus.repo import RepoManager, RepoException, is_repo, mark_dirty
+
+
+class Command(BaseCommand):
+    """
+    Marks repositories as changed, so that all klaus processes refresh their
+    data about them.  Meant to be called from a ``post-receive`` hook::
+
+        django-admin.py klaus_mark_dirty --settings=mysite.settings
+
+    which marks the repo the hook runs in (``$GIT_DIR``).
+    """
+    args = '[<repo name or path> ...]'
+    help = 'Marks repositories as changed (default: the one in $GIT_DIR).'
+
+    def handle(self, *repos, **options):
+        if not repos:
+            repos = [os.environ.get('GIT_DIR', os.curdir)]
+        for repo in repos:
+            if is_repo(repo):
+                path = os.path.abspath(repo)
+                if os.path.basename(path) == '.git':
+                    path = os.path.dirname(path)
+                mark_dirty(path)
+            else:
+                try:
+                    RepoManager.mark_dirty(repo)
+                except RepoException as exc:
+                    raise CommandError(exc)
@@ -0,0 +1,210 @@
+# -*- coding: utf-8 -*-
+"""
+A persistent, incrementally updated index of commit messages and authors, for
+filtering history by message or author substring.
+
+Like `klaus.codesearch`, this is a trigram index: for every sequence of three
+bytes (lowercased) in any commit message (or author), the positions in the
+`CommitGraph` of the commits that contain it.  Only commits that contain all
+trigrams of a query string have to be read to check if they actually match.
+
+The index is extended in a background thread (see
+`FancyRepo.get_message_index`); commits it doesn't cover yet are read to match
+them.
+"""
+import calendar
+import collections
+import datetime
+import marshal
+import threading
+import zlib
+from array import array
+
+from klaus.utils import save_cache_file, trigrams
+
+
+class CommitQuery(collections.namedtuple('CommitQuery', [
+        'message', 'author', 'since', 'until'])):
+    """
+    Matches commits whose message and author contain the `message` and
+    `author` strings (ignoring case) and whose commit time (a Unix timestamp)
+    is in the range from `since` to `until` (exclusive).  Any of these may be
+    None to not filter by it.
+    """
+    __slots__ = ()
+
+    @classmethod
+    def from_strings(cls, message=None, author=None, since=None, until=None):
+        """
+        Returns a query for the given strings (as entered into the history
+        filter form); `since` and `until` are dates (YYYY-MM-DD), both
+        inclusive.  Empty and malformed parameters are ignored.
+        """
+        since, until = _parse_date(since), _parse_date(until)
+        if until is not None:
+            until += 24 * 60 * 60
+        return cls(message or None, author or None, since, until)
+
+    def __nonzero__(self):
+        return any(value is not None for value in self)
+
+
+class MessageIndex(object):
+    """
+    The message and author index of `repo`, stored in the repo's klaus cache
+    directory (see `FancyRepo.cache_path`), covering the commits of its
+    `CommitGraph`.
+    """
+    FORMAT_VERSION = 1
+    FILENAME = 'message-index'
+
+    def __init__(self, repo):
+        self.repo = repo
+        self.path = repo.cache_path(self.FILENAME)
+        # Held while the index is cleared or newly indexed commits are made
+        # visible to `matcher`
+        self._lock = threading.Lock()
+        self._clear()
+        self._load()
+
+    def _clear(self):
+        self.count = 0              # number of indexed graph positions
+        self.last_sha = None        # SHA of the last indexed commit
+        self.messages = {}          # trigram -> array of positions
+        self.authors = {}           # trigram -> array of positions
+
+    def _load(self):
+        try:
+            with open(self.path, 'rb') as fileobj:
+                data = marshal.loads(zlib.decompress(fileobj.read()))
+        except (IOError, EOFError, ValueError, TypeError, zlib.error):
+            return
+
+        if not isinstance(data, tuple) or not data or \
+           data[0] != self.FORMAT_VERSION:
+            # Outdated or corrupt; rebuild from scratch.
+            return
+
+        _, self.count, self.last_sha, messages, authors = data
+        for postings, packed in [(self.messages, messages),
+                                 (self.authors, authors)]:
+            for trigram, positions in packed.iteritems():
+                postings[trigram] = array('i', positions)
+
+    def save(self):
+        data = (
+            self.FORMAT_VERSION,
+            self.count,
+            self.last_sha,
+            dict((trigram, positions.tostring())
+                 for trigram, positions in self.messages.iteritems()),
+            dict((trigram, positions.tostring())
+                 for trigram, positions in self.authors.iteritems()),
+        )
+        save_cache_file(self.path, zlib.compress(marshal.dumps(data)))
+
+    def update(self, graph):
+        """
+        Indexes all commits of `graph` that are not in the index yet and saves
+        the index if anything changed.
+        """
+        if self.count and (self.count > len(graph) or
+                           graph.shas[self.count - 1] != self.last_sha):
+            # The graph was rebuilt; positions have changed.
+            with self._lock:
+                self._clear()
+        # The graph may grow while we're at it.
+        count = len(graph)
+        if self.count == count:
+            return False
+
+        for pos in xrange(self.count, count):
+            commit = self.repo[graph.shas[pos]]
+            _add(self.messages, commit.message, pos)
+            _add(self.authors, commit.author, pos)
+        with self._lock:
+            self.count = count
+            self.last_sha = graph.shas[count - 1]
+        self.save()
+        return True
+
+    def matcher(self, graph, query):
+        """
+        Returns a function that takes a position in `graph` and returns True
+        if the commit at that position matches `CommitQuery` `query` (see
+        `commit_matcher`).
+        """
+        with self._lock:
+            count, messages, authors = self.count, self.messages, self.authors
+        candidates = None
+        for postings, string in [(messages, query.message),
+                                 (authors, query.author)]:
+            if string is not None:
+                candidates = _candidates(postings, string, candidates)
+        return commit_matcher(self.repo, graph, query, count, candidates)
+
+
+def commit_matcher(repo, graph, query, count=0, candidates=None):
+    """
+    Returns a function that takes a position in `graph` and returns True if
+    the commit at that position matches `CommitQuery` `query`.  Commits at
+    positions below `count` that are not in `candidates` (unless it is None)
+    are known not to match; the others are read from `repo` to check them.
+    """
+    message = _lower(query.message)
+    author = _lower(query.author)
+
+    def match(pos):
+        commit_time = graph.commit_times[pos]
+        if query.since is not None and commit_time < query.since or \
+           query.until is not None and commit_time >= query.until:
+            return False
+        if candidates is not None and pos < count and pos not in candidates:
+            return False
+        if message is None and author is None:
+            return True
+        commit = repo[graph.shas[pos]]
+        return (message is None or message in commit.message.lower()) and \
+            (author is None or author in commit.author.lower())
+    return match
+
+
+def _add(postings, string, pos):
+    for trigram in trigrams(string.lower()):
+        positions = postings.get(trigram)
+        if positions is None:
+            positions = postings[trigram] = array('i')
+        positions.append(pos)
+
+
+def _candidates(postings, string, candidates=None):
+    """
+    Returns the set of positions in `postings` that have all trigrams of
+    `string`, intersected with `candidates` if that is not None.  Strings
+    shorter than three bytes don't narrow down the candidates.
+    """
+    for positions in sorted((postings.get(trigram, ())
+                             for trigram in trigrams(_lower(string))),
+                            key=len):
+        if candidates is None:
+            candidates = set(positions)
+        else:
+            candidates.intersection_update(positions)
+    return candidates
+
+
+def _lower(string):
+    if string is None:
+        return None
+    if isinstance(string, unicode):
+        string = string.encode('utf-8')
+    return string.lower()
+
+
+def _parse_date(string):
+    """ Returns the Unix timestamp of date `string` (UTC), or None. """
+    try:
+        date = datetime.datetime.strptime(string or '', '%Y-%m-%d')
+    except ValueError:
+        return None
+    return calendar.timegm(date.timetuple())
@@ -0,0 +1,332 @@
+# -*- coding: utf-8 -*-
+"""
+Low-level access to Git objects that doesn't load whole objects into memory.
+
+Dulwich always inflates objects completely.  For loose objects and for
+objects stored as-is (not deltified) in packs, `open_object` instead reads the
+object's header and inflates its content chunk by chunk.  Deltified objects
+still have to be resolved by Dulwich.
+
+`probe_object` answers "how large is it and is it binary?" from the object
+header and the first few bytes of content only; for deltified objects the size
+is read from the delta header, so not even the delta has to be resolved.
+"""
+import binascii
+import collections
+import errno
+import os
+import zlib
+
+from dulwich.objects import Blob, FixedSha, hex_to_filename, object_class
+from dulwich.pack import DELTA_TYPES, OFS_DELTA, REF_DELTA
+
+from klaus import timing
+
+#: Number of compressed bytes to read at a time.
+BUFSIZE = 64 * 1024
+
+#: Like Git, only look at this many bytes to decide if an object is binary.
+PROBE_SIZE = 8000
+
+#: Deltified objects larger than this are not resolved by `probe_object`.
+MAX_RESOLVE_SIZE = 1024 * 1024
+
+
+class ObjectStream(object):
+    """
+    A Git object's type and size, plus an iterator over its (uncompressed)
+    content, `chunks`.  The iterator may only be consumed once.
+    """
+    def __init__(self, type_num, size, chunks):
+        self.type_num = type_num
+        self.size = size
+        self.chunks = chunks
+
+    def iter_range(self, start, stop):
+        """ Yields the content from byte `start` to byte `stop` (exclusive). """
+        pos = 0
+        for chunk in self.chunks:
+            end = pos + len(chunk)
+            if end > start:
+                yield chunk[max(start - pos, 0):stop - pos]
+            pos = end
+            if pos >= stop:
+                break
+
+    def close(self):
+        """ Releases the object's file if `chunks` was not consumed. """
+        close = getattr(self.chunks, 'close', None)
+        if close is not None:
+            close()
+
+
+class ObjectInfo(collections.namedtuple('ObjectInfo',
+                                        ['type_num', 'size', 'prefix'])):
+    """
+    An object's type and size and the first `PROBE_SIZE` bytes of its
+    content, `prefix`.  `prefix` is None for large deltified objects.
+    """
+    __slots__ = ()
+
+    @property
+    def is_binary(self):
+        """ True, False, or None if unknown because `prefix` is None. """
+        if self.prefix is None:
+            return None
+        return '\0' in self.prefix
+
+
+class LazyBlob(Blob):
+    """
+    A blob that is only read from `object_store` when its content is accessed,
+    so that code that only needs its SHA or `info` doesn't inflate it.
+    """
+    def __init__(self, object_store, sha):
+        super(LazyBlob, self).__init__()
+        self._object_store = object_store
+        self._sha = FixedSha(sha)
+        self._needs_parsing = True
+        self._info = None
+
+    def _ensure_parsed(self):
+        if self._needs_parsing:
+            self._chunked_text = self._object_store[self.id].chunked
+            self._needs_parsing = False
+
+    # Dulwich >= 0.10 parses objects right away and doesn't call
+    # `_ensure_parsed` itself.
+    def as_raw_chunks(self):
+        self._ensure_parsed()
+        return super(LazyBlob, self).as_raw_chunks()
+
+    chunked = property(as_raw_chunks, Blob.chunked.fset)
+
+    def raw_length(self):
+        return self.info.size
+
+    @property
+    def info(self):
+        """ The blob's `ObjectInfo`, see `probe_object`. """
+        if self._info is None:
+            self._info = probe_object(self._object_store, self.id)
+        return self._info
+
+
+def probe_object(object_store, sha, max_resolve_size=MAX_RESOLVE_SIZE):
+    """
+    Returns an `ObjectInfo` for the object `sha` in `object_store`, reading
+    only the object's header and the first `PROBE_SIZE` bytes of content.
+
+    Deltified objects can't be read partially; they are resolved only if they
+    are not larger than `max_resolve_size`, otherwise their `prefix` is None.
+    Raises `KeyError` if there is no such object.
+    """
+    stream = _open_loose_object(object_store, sha)
+    if stream is None:
+        location = _find_packed_object(object_store, sha)
+        if location is not None:
+            stream = _open_pack_entry(*location)
+            if stream is None:
+                # Deltified
+                type_num, size = _read_delta_info(object_store, *location)
+                if size > max_resolve_size:
+                    return ObjectInfo(type_num, size, None)
+    if stream is None:
+        stream = open_object(object_store, sha)
+
+    try:
+        prefix = ''.join(stream.iter_range(0, PROBE_SIZE))
+    finally:
+        stream.close()
+    return ObjectInfo(stream.type_num, stream.size, prefix)
+
+
+def open_object(object_store, sha):
+    """
+    Returns an `ObjectStream` for the object `sha` in `object_store`.
+    Raises `KeyError` if there is no such object.
+    """
+    stream = _open_loose_object(object_store, sha)
+    if stream is None:
+        location = _find_packed_object(object_store, sha)
+        if location is not None:
+            stream = _open_pack_entry(*location)
+    if stream is None:
+        # Deltified object, or not a disk object store.
+        obj = object_store[sha]
+        stream = ObjectStream(obj.type_num, obj.raw_length(),
+                              iter(obj.as_raw_chunks()))
+    return stream
+
+
+def _open_loose_object(object_store, sha):
+    if not hasattr(object_store, 'path'):
+        return None
+    try:
+        fileobj = open(hex_to_filename(object_store.path, sha), 'rb')
+    except IOError as exc:
+        if exc.errno == errno.ENOENT:
+            return None
+        raise
+
+    decompressor = zlib.decompressobj()
+    data = ''
+    while '\0' not in data:
+        compressed = fileobj.read(512)
+        if not compressed:
+            fileobj.close()
+            raise KeyError(sha)
+        data += decompressor.decompress(compressed)
+
+    header, data = data.split('\0', 1)
+    type_name, size = header.split(' ', 1)
+    return ObjectStream(object_class(type_name).type_num, int(size),
+                        _inflate(fileobj, decompressor, data))
+
+
+def _find_packed_object(object_store, sha):
+    """
+    Returns the path of the pack that contains object `sha` and the object's
+    offset in it, or None.
+    """
+    if not hasattr(object_store, 'pack_dir'):
+        return None
+    for pack in object_store.packs:
+        try:
+            offset = pack.index.object_index(sha)
+        except KeyError:
+            continue
+        return os.path.join(object_store.pack_dir, pack.data.filename), offset
+    return None
+
+
+def _open_pack_entry(pack_path, offset):
+    """ Returns an `ObjectStream`, or None for deltified objects. """
+    fileobj = open(pack_path, 'rb')
+    fileobj.seek(offset)
+    type_num, size = _read_pack_object_header(fileobj)
+    if type_num in DELTA_TYPES:
+        fileobj.close()
+        return None
+    return ObjectStream(type_num, size, _inflate(fileobj, zlib.decompressobj()))
+
+
+def _read_delta_info(object_store, pack_path, offset):
+    """
+    Returns the type and size of the deltified object at `offset` in the pack
+    at `pack_path`.  The size is stored in the header of the (compressed)
+    delta, the type is the type of the object at the end of the delta chain.
+    """
+    size = None
+    with open(pack_path, 'rb') as fileobj:
+        while True:
+            fileobj.seek(offset)
+            type_num, _ = _read_pack_object_header(fileobj)
+            if type_num not in DELTA_TYPES:
+                return type_num, size
+            if type_num == OFS_DELTA:
+                base_offset = offset - _read_base_offset(fileobj)
+            else:
+                base_sha = binascii.hexlify(fileobj.read(20))
+            if size is None:
+                size = _read_delta_target_size(fileobj)
+            if type_num == REF_DELTA:
+                break
+            offset = base_offset
+
+    # The base of a REF_DELTA may be anywhere in the object store.
+    stream = _open_loose_object(object_store, base_sha)
+    if stream is not None:
+        stream.close()
+        return stream.type_num, size
+    location = _find_packed_object(object_store, base_sha)
+    if location is None:
+        raise KeyError(base_sha)
+    type_num, _ = _read_delta_info(object_store, *location)
+    return type_num, size
+
+
+def _read_base_offset(fileobj):
+    """ Reads the (negative, relative) base offset of an OFS_DELTA entry. """
+    byte = ord(fileobj.read(1))
+    offset = byte & 0x7f
+    while byte & 0x80:
+        byte = ord(fileobj.read(1))
+        offset = ((offset + 1) << 7) | (byte & 0x7f)
+    return offset
+
+
+def _read_delta_target_size(fileobj):
+    """
+    Inflates the start of the delta at the current position of `fileobj` and
+    returns the size of the delta's target object (the delta header is the
+    base object's size followed by the target object's size).
+    """
+    decompressor = zlib.decompressobj()
+    data = ''
+    while True:
+        compressed = fileobj.read(512)
+        data += decompressor.decompress(compressed)
+        try:
+            _, pos = _decode_size(data, 0)
+            return _decode_size(data, pos)[0]
+        except IndexError:
+            if not compressed:
+                raise ValueError("Truncated delta")
+
+
+def _decode_size(data, pos):
+    """
+    Decodes the variable-length size in delta headers at `data[pos:]` and
+    returns it and the position after it.
+    """
+    size = shift = 0
+    while True:
+        byte = ord(data[pos])
+        pos += 1
+        size |= (byte & 0x7f) << shift
+        shift += 7
+        if not byte & 0x80:
+            return size, pos
+
+
+def _read_pack_object_header(fileobj):
+    """
+    Reads the type and size of the pack entry at the current position of
+    `fileobj` (see Documentation/technical/pack-format.txt in Git).
+    """
+    byte = ord(fileobj.read(1))
+    type_num = (byte >> 4) & 0x07
+    size = byte & 0x0f
+    shift = 4
+    while byte & 0x80:
+        byte = ord(fileobj.read(1))
+        size += (byte & 0x7f) << shift
+        shift += 7
+    return type_num, size
+
+
+def _inflate(fileobj, decompressor, data=''):
+    """
+    Yields `data` followed by the inflated rest of the zlib stream at the
+    current position of `fileobj`.
+    """
+    timing.count('streamed-objects')
+    try:
+        if data:
+            timing.count('inflated-bytes', len(data))
+            yield data
+        while not decompressor.unused_data:
+            compressed = fileobj.read(BUFSIZE)
+            if not compressed:
+                break
+            data = decompressor.decompress(compressed)
+            if data:
+                timing.count('inflated-bytes', len(data))
+                yield data
+        data = decompressor.flush()
+        if data:
+            timing.count('inflated-bytes', len(data))
+            yield data
+    finally:
+        fileobj.close()
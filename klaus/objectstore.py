@@ -0,0 +1,339 @@
+# -*- coding: utf-8 -*-
+"""
+A thread-safe object store whose packs are shared by all repos of a process.
+
+Dulwich's `DiskObjectStore` is not meant to be used from multiple threads:
+`PackData` seeks and reads a file object shared by all callers, and its cache
+of resolved deltas is a plain LRU cache.  It also only notices new packs (e.g.
+after a push or `git gc`) if the modification time of `objects/pack` changed
+since the last scan, which may be within the same second.
+
+`SharedObjectStore` instead reads packs through `SharedPack`s: the pack and
+its index are mapped into memory once per process (and file), reads don't
+share any position, and the delta cache is synchronized.  When an object is
+not found, the pack directory is scanned again, so objects in new packs are
+found right away.
+
+Shared packs are reference counted: a pack is unmapped once no open store
+uses it anymore, i.e. when the last repo using it is closed (see
+`KLAUS_MAX_OPEN_REPOS`) or after it was removed from disk.
+"""
+import errno
+import mmap
+import os
+import threading
+import time
+
+from dulwich.errors import ChecksumMismatch
+from dulwich.lru_cache import LRUCache, LRUSizeCache
+from dulwich.object_store import DiskObjectStore
+from dulwich.pack import Pack, PackData, load_pack_index, unpack_object
+try:
+    from dulwich.pack import PackFileDisappeared
+except ImportError:
+    # dulwich < 0.10 lets the `ValueError` of the closed map through.
+    class PackFileDisappeared(Exception):
+        pass
+
+from klaus import timing
+
+#: Check if the pack directory changed at most every this many seconds
+#: (packs are also looked for when an object is not found).
+PACK_RESCAN_INTERVAL = 5
+
+#: Size of the cache of resolved delta bases, per pack.
+DELTA_CACHE_SIZE = 20 * 1024 * 1024
+
+
+class _SynchronizedCacheMixin(object):
+    def __getitem__(self, key):
+        with self._lock:
+            return super(_SynchronizedCacheMixin, self).__getitem__(key)
+
+    def get(self, key, default=None):
+        with self._lock:
+            return super(_SynchronizedCacheMixin, self).get(key, default)
+
+    def add(self, key, value, cleanup=None):
+        with self._lock:
+            return super(_SynchronizedCacheMixin, self).add(key, value,
+                                                            cleanup)
+
+    def clear(self):
+        with self._lock:
+            return super(_SynchronizedCacheMixin, self).clear()
+
+
+class SynchronizedLRUCache(_SynchronizedCacheMixin, LRUCache):
+    """ An `LRUCache` that can be used from multiple threads. """
+    def __init__(self, *args, **kwargs):
+        self._lock = threading.RLock()
+        LRUCache.__init__(self, *args, **kwargs)
+
+
+class SynchronizedLRUSizeCache(_SynchronizedCacheMixin, LRUSizeCache):
+    """ An `LRUSizeCache` that can be used from multiple threads. """
+    def __init__(self, *args, **kwargs):
+        self._lock = threading.RLock()
+        LRUSizeCache.__init__(self, *args, **kwargs)
+
+
+class SharedObjectStore(DiskObjectStore):
+    """
+    A `DiskObjectStore` that may be used by multiple threads at once and that
+    reads packs through `SharedPack`s.  Closing it releases its packs; it can
+    still be used afterwards (which acquires them again).
+    """
+    def __init__(self, path):
+        super(SharedObjectStore, self).__init__(path)
+        self._scan_lock = threading.Lock()
+        self._pack_cache_time = 0
+        self._checked_at = 0
+        # Increased whenever the set of packs changes
+        self._generation = 0
+
+    @property
+    def alternates(self):
+        if self._alternates is None:
+            self._alternates = [SharedObjectStore(path)
+                                for path in self._read_alternate_paths()]
+        return self._alternates
+
+    def get_raw(self, name):
+        generation = self._generation
+        try:
+            type_num, raw = super(SharedObjectStore, self).get_raw(name)
+        except KeyError:
+            if not self._packs_changed(generation):
+                raise
+            type_num, raw = super(SharedObjectStore, self).get_raw(name)
+        timing.count('objects')
+        timing.count('inflated-bytes', len(raw))
+        return type_num, raw
+
+    def __contains__(self, sha):
+        generation = self._generation
+        return super(SharedObjectStore, self).__contains__(sha) or \
+            self._packs_changed(generation) and \
+            super(SharedObjectStore, self).__contains__(sha)
+
+    def _packs_changed(self, generation):
+        """
+        Looks for new and removed packs.  Returns True if the packs changed
+        since `generation` (e.g. because another thread closed the store).
+        """
+        self.rescan()
+        return self._generation != generation
+
+    @property
+    def packs(self):
+        if self._pack_cache_stale():
+            self._update_pack_cache()
+        return list(self._pack_cache.values())
+
+    def rescan(self):
+        """
+        Looks for new and removed packs.  Returns True if there are new ones.
+        """
+        return bool(self._update_pack_cache())
+
+    def _update_pack_cache(self):
+        """ Looks for new and removed packs and returns the new ones. """
+        with self._scan_lock:
+            try:
+                mtime = os.stat(self.pack_dir).st_mtime
+                names = os.listdir(self.pack_dir)
+            except OSError as exc:
+                if exc.errno != errno.ENOENT:
+                    raise
+                mtime, names = 0, []
+
+            old_pack_cache = self._pack_cache
+            pack_cache = {}
+            for name in names:
+                basename, ext = os.path.splitext(name)
+                # Git writes the index last.
+                if name.startswith('pack-') and ext == '.pack' and \
+                   basename + '.idx' in names:
+                    pack = acquire_shared_pack(os.path.join(self.pack_dir,
+                                                            basename))
+                    if pack is not None:
+                        pack_cache[basename] = pack
+
+            # Readers iterate over the old dict's values; don't modify it.
+            self._pack_cache = pack_cache
+            self._pack_cache_time = mtime
+            self._checked_at = time.time()
+            map(release_shared_pack, old_pack_cache.itervalues())
+            new_packs = [new_pack
+                         for new_name, new_pack in pack_cache.iteritems()
+                         if old_pack_cache.get(new_name) is not new_pack]
+            if new_packs or len(pack_cache) != len(old_pack_cache):
+                self._generation += 1
+            return new_packs
+
+    def _pack_cache_stale(self):
+        if time.time() - self._checked_at < PACK_RESCAN_INTERVAL:
+            return False
+        self._checked_at = time.time()
+        try:
+            return os.stat(self.pack_dir).st_mtime != self._pack_cache_time
+        except OSError:
+            return True
+
+    def close(self):
+        with self._scan_lock:
+            pack_cache = self._pack_cache
+            self._pack_cache = {}
+            self._generation += 1
+            # Look for packs again on the next use.
+            self._pack_cache_time = 0
+            self._checked_at = 0
+            map(release_shared_pack, pack_cache.itervalues())
+        for alternate in self._alternates or []:
+            alternate.close()
+
+    def __del__(self):
+        # A store used by a request while its repo was closed acquires packs
+        # again.
+        if getattr(self, '_pack_cache', None):
+            self.close()
+
+
+class SharedPack(Pack):
+    """
+    A pack whose data and index are mapped into memory, for use by any number
+    of threads.  The index and data are loaded right away.
+
+    Use `acquire_shared_pack` and `release_shared_pack` instead of creating
+    and closing `SharedPack`s.  Objects can't be found in closed packs, so
+    stores look for them in other packs (or a new mapping of the same pack).
+    """
+    def __init__(self, basename, identity):
+        super(SharedPack, self).__init__(basename)
+        self.basename = basename
+        self.identity = identity
+        self.users = 0
+        self.closed = False
+        self._data_load = lambda: MappedPackData(self._data_path)
+        self._idx_load = lambda: load_pack_index(self._idx_path)
+        self.index
+        self.data
+
+    def __contains__(self, sha):
+        try:
+            return super(SharedPack, self).__contains__(sha)
+        except (ValueError, PackFileDisappeared):
+            if self.closed:
+                return False
+            raise
+
+    def get_raw(self, sha):
+        try:
+            return super(SharedPack, self).get_raw(sha)
+        except (ValueError, PackFileDisappeared):
+            # Closed by another thread while reading
+            if self.closed:
+                raise KeyError(sha)
+            raise
+
+    def close(self):
+        self.closed = True
+        super(SharedPack, self).close()
+
+
+class MappedPackData(PackData):
+    """
+    `PackData` that reads objects from a memory map of the pack file, without
+    any shared file position, so `get_object_at` is thread-safe.
+    """
+    def __init__(self, filename):
+        with open(filename, 'rb') as fileobj:
+            self._map = mmap.mmap(fileobj.fileno(), 0, access=mmap.ACCESS_READ)
+        super(MappedPackData, self).__init__(
+            filename, file=MapReader(self._map), size=len(self._map))
+        self._offset_cache = SynchronizedLRUSizeCache(
+            DELTA_CACHE_SIZE, compute_size=self._offset_cache._compute_size)
+
+    def get_object_at(self, offset):
+        try:
+            return self._offset_cache[offset]
+        except KeyError:
+            pass
+        assert offset >= self._header_size
+        unpacked, _ = unpack_object(MapReader(self._map, offset).read)
+        return (unpacked.pack_type_num, unpacked._obj())
+
+    def close(self):
+        self._map.close()
+
+
+class MapReader(object):
+    """ A minimal read-only file object over (a part of) a memory map. """
+    def __init__(self, data, pos=0):
+        self._data = data
+        self._pos = pos
+
+    def read(self, size=-1):
+        start = self._pos
+        if size < 0:
+            self._pos = len(self._data)
+        else:
+            self._pos = min(start + size, len(self._data))
+        return self._data[start:self._pos]
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self._pos
+        elif whence == os.SEEK_END:
+            offset += len(self._data)
+        self._pos = offset
+
+    def tell(self):
+        return self._pos
+
+    def close(self):
+        pass
+
+
+_shared_packs = {}                  # basename -> SharedPack
+_shared_packs_lock = threading.Lock()
+
+
+def acquire_shared_pack(basename):
+    """
+    Returns the `SharedPack` for the pack at `basename` (the path without the
+    ``.pack`` and ``.idx`` extensions), which is shared by all stores of the
+    process, or None if the pack can't be read (anymore).  The pack must be
+    passed to `release_shared_pack` once it isn't used anymore.
+    """
+    try:
+        stat = os.stat(basename + '.pack')
+    except OSError:
+        return None
+    identity = (stat.st_ino, stat.st_size, stat.st_mtime)
+    with _shared_packs_lock:
+        pack = _shared_packs.get(basename)
+        if pack is None or pack.identity != identity:
+            try:
+                pack = SharedPack(basename, identity)
+            except (EnvironmentError, ValueError, AssertionError,
+                    ChecksumMismatch):
+                # Removed in the meantime, or not completely written yet
+                return None
+            # Stores still using a replaced pack release it on their next
+            # scan.
+            _shared_packs[basename] = pack
+        pack.users += 1
+        return pack
+
+
+def release_shared_pack(pack):
+    """ Closes `pack` if this was its last user. """
+    with _shared_packs_lock:
+        pack.users -= 1
+        if pack.users:
+            return
+        if _shared_packs.get(pack.basename) is pack:
+            del _shared_packs[pack.basename]
+    pack.close()
@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+"""
+A persistent, incrementally updated index of the commits that changed each
+path (file or directory) of a repository.
+
+Walking the history of a path (`CommitGraph.walk` with a `path`) needs to know
+for each commit whether the path differs from each of the commit's parents.
+Looking that up in the commits' trees means reading trees along the whole
+ancestry.  The index answers it from a set lookup instead: for each path it
+stores the "changes" that touched it, a change being a commit position in the
+`CommitGraph` and the index of the parent compared to.  Root commits are
+compared to the empty tree.
+
+Like the commit graph, the index is extended whenever new commits are added to
+the graph.  That happens in a background thread (see `FancyRepo.get_path_index`)
+while requests keep using the part of the index built so far; see `snapshot`.
+"""
+import marshal
+import stat
+import threading
+import zlib
+from array import array
+
+from dulwich.lru_cache import LRUCache
+
+from klaus.utils import save_cache_file
+
+#: Changes are stored as `position * MAX_PARENTS + parent index`; merges with
+#: more parents than this are not indexed (see `PathIndex.changes`).
+MAX_PARENTS = 64
+
+#: Number of parsed trees to keep while indexing.
+TREE_CACHE_SIZE = 20000
+
+
+class PathIndex(object):
+    """
+    The path index of `repo`, stored in the repo's klaus cache directory (see
+    `FancyRepo.cache_path`), covering the commits of its `CommitGraph`.
+    """
+    FORMAT_VERSION = 1
+    FILENAME = 'path-index'
+
+    def __init__(self, repo):
+        self.repo = repo
+        self.path = repo.cache_path(self.FILENAME)
+        # Held while the index is cleared or newly indexed commits are made
+        # visible to `snapshot`
+        self._lock = threading.Lock()
+        self._clear()
+        self._load()
+
+    def _clear(self):
+        self.count = 0              # number of indexed graph positions
+        self.last_sha = None        # SHA of the last indexed commit
+        self.changes_by_path = {}   # path -> array of changes
+        self.unindexed = set()      # positions of octopus merges
+        self._sets = {}
+
+    def _load(self):
+        try:
+            with open(self.path, 'rb') as fileobj:
+                data = marshal.loads(zlib.decompress(fileobj.read()))
+        except (IOError, EOFError, ValueError, TypeError, zlib.error):
+            return
+
+        if not isinstance(data, tuple) or not data or \
+           data[0] != self.FORMAT_VERSION:
+            # Outdated or corrupt; rebuild from scratch.
+            return
+
+        _, self.count, self.last_sha, changes_by_path, unindexed = data
+        for path, changes in changes_by_path.iteritems():
+            self.changes_by_path[path] = array('l', changes)
+        self.unindexed = set(unindexed)
+
+    def save(self):
+        data = (
+            self.FORMAT_VERSION,
+            self.count,
+            self.last_sha,
+            dict((path, changes.tostring())
+                 for path, changes in self.changes_by_path.iteritems()),
+            tuple(self.unindexed),
+        )
+        save_cache_file(self.path, zlib.compress(marshal.dumps(data)))
+
+    def update(self, graph):
+        """
+        Indexes all commits of `graph` that are not in the index yet and saves
+        the index if anything changed.
+        """
+        if self.count and (self.count > len(graph) or
+                           graph.shas[self.count - 1] != self.last_sha):
+            # The graph was rebuilt; positions have changed.
+            with self._lock:
+                self._clear()
+        # The graph may grow while we're at it.
+        count = len(graph)
+        if self.count == count:
+            return False
+
+        # Most trees are compared twice, with their parents and children.
+        self._trees = LRUCache(TREE_CACHE_SIZE)
+        for pos in xrange(self.count, count):
+            self._index_commit(graph, pos)
+        self._trees = None
+        with self._lock:
+            self.count = count
+            self.last_sha = graph.shas[count - 1]
+            self._sets = {}
+        self.save()
+        return True
+
+    def _index_commit(self, graph, pos):
+        parents = graph.parents(pos)
+        if len(parents) > MAX_PARENTS:
+            self.unindexed.add(pos)
+            return
+        tree = graph.trees[pos]
+        for i, parent_tree in enumerate([graph.trees[parent]
+                                         for parent in parents] or [None]):
+            change = pos * MAX_PARENTS + i
+            paths = []
+            self._diff_trees(parent_tree, tree, '', paths)
+            for path in paths:
+                changes = self.changes_by_path.get(path)
+                if changes is None:
+                    changes = self.changes_by_path[path] = array('l')
+                changes.append(change)
+
+    def _diff_trees(self, old_tree, new_tree, prefix, paths):
+        """
+        Appends the paths of all files and directories that differ between
+        trees `old_tree` and `new_tree` (either may be None) to `paths`.
+        Subtrees with the same SHA are skipped.
+        """
+        old = self._get_entries(old_tree)
+        new = self._get_entries(new_tree)
+        for name in set(old).union(new):
+            old_entry, new_entry = old.get(name), new.get(name)
+            if old_entry == new_entry:
+                continue
+            path = prefix + name
+            paths.append(path)
+            old_subtree = old_entry and stat.S_ISDIR(old_entry[0]) and \
+                old_entry[1] or None
+            new_subtree = new_entry and stat.S_ISDIR(new_entry[0]) and \
+                new_entry[1] or None
+            if old_subtree or new_subtree:
+                self._diff_trees(old_subtree, new_subtree, path + '/', paths)
+
+    def _get_entries(self, sha):
+        """ Returns the entries of tree `sha` as a dict name -> (mode, sha). """
+        if sha is None:
+            return {}
+        entries = self._trees.get(sha)
+        if entries is None:
+            entries = dict((name, (mode, sha)) for name, mode, sha
+                           in self.repo[sha].iteritems())
+            self._trees.add(sha, entries)
+        return entries
+
+    def snapshot(self, path):
+        """
+        Returns `(count, unindexed, changes)`: the number of indexed graph
+        positions, the positions of the commits that are not covered, and the
+        set of changes to `path`.  `position * MAX_PARENTS + i` is in the set
+        if `path` differs between the commit at `position` and its `i`-th
+        parent (or the empty tree, for root commits).
+
+        The three are consistent with each other even while the index is
+        updated by another thread; the set may contain changes of positions
+        past `count`, which must be ignored.
+        """
+        with self._lock:
+            count, unindexed = self.count, self.unindexed
+            changes_by_path, sets = self.changes_by_path, self._sets
+        path = path.strip('/')
+        changes = sets.get(path)
+        if changes is None:
+            changes = sets[path] = frozenset(changes_by_path.get(path, ()))
+        return count, unindexed, changes
@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+"""
+A persistent snapshot of a repository's refs, with the time of the object
+each ref points to already resolved, so that sorting branches and tags by age
+doesn't need to read any objects.
+"""
+import marshal
+
+import dulwich.objects
+
+from klaus.utils import save_cache_file
+
+
+class RefSnapshot(object):
+    """
+    The refs of `repo`, stored in the repo's klaus cache directory (see
+    `FancyRepo.cache_path`).
+
+    `update` re-reads the refs only if the repo's state token (or
+    `klaus.repo.refs_signature`) says that something changed, and only
+    resolves refs whose SHA changed.
+    """
+    FORMAT_VERSION = 1
+    FILENAME = 'refs'
+
+    def __init__(self, repo):
+        self.repo = repo
+        self.path = repo.cache_path(self.FILENAME)
+        self.signature = None
+        # refname -> (sha, time, is_tag)
+        self.refs = {}
+        self._sorted_names = {}
+        self._load()
+
+    def _load(self):
+        try:
+            with open(self.path, 'rb') as fileobj:
+                data = marshal.load(fileobj)
+        except (IOError, EOFError, ValueError, TypeError):
+            return
+        if isinstance(data, tuple) and data and \
+           data[0] == self.FORMAT_VERSION:
+            _, self.signature, self.refs = data
+
+    def save(self):
+        save_cache_file(self.path, marshal.dumps(
+            (self.FORMAT_VERSION, self.signature, self.refs)))
+
+    def update(self, signature):
+        """
+        Brings the snapshot up to date if the repo's refs signature changed
+        since the last update.
+        """
+        if signature == self.signature:
+            return False
+
+        refs = {}
+        for refname, sha in self.repo.get_refs().iteritems():
+            known = self.refs.get(refname)
+            if known is not None and known[0] == sha:
+                refs[refname] = known
+                continue
+            try:
+                obj = self.repo[sha]
+            except KeyError:
+                # Broken ref
+                continue
+            if isinstance(obj, dulwich.objects.Tag):
+                refs[refname] = (sha, obj.tag_time, True)
+            else:
+                refs[refname] = (sha, getattr(obj, 'commit_time', 0), False)
+
+        self.refs = refs
+        self.signature = signature
+        self._sorted_names = {}
+        self.save()
+        return True
+
+    def sorted_names(self, prefix):
+        """
+        Returns the names of all refs below `prefix` (without the prefix),
+        newest first.
+        """
+        if prefix not in self._sorted_names:
+            prefix_slash = prefix.rstrip('/') + '/'
+            refs = [(-time, refname[len(prefix_slash):])
+                    for refname, (_, time, _) in self.refs.iteritems()
+                    if refname.startswith(prefix_slash)]
+            refs.sort()
+            self._sorted_names[prefix] = [name for _, name in refs]
+        return self._sorted_names[prefix]
+
+    def last_commit_time(self):
+        """
+        Returns the newest commit time of all refs that point to commits, or
+        None if there are no such refs.
+        """
+        times = [time for _, time, is_tag in self.refs.itervalues()
+                 if not is_tag]
+        return max(times) if times else None
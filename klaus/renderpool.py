@@ -0,0 +1,192 @@
+# -*- coding: utf-8 -*-
+"""
+A process pool for CPU-heavy rendering (highlighting, markup rendering).
+
+Pathological inputs can make Pygments lexers or markup renderers run for a
+very long time.  Running them in a separate process keeps the web server's
+workers responsive, and allows to stop them: Each job may use at most
+`KLAUS_RENDER_TIMEOUT` seconds of CPU time, after which its worker process is
+killed (and replaced by the pool).  Callers get a `RenderTimeout` and should
+fall back to something cheap, like showing the plain text.
+
+Identical jobs that run at the same time (e.g. many requests for the same
+file) are only run once.  Callers also get a `RenderTimeout` if no worker
+becomes free within `KLAUS_RENDER_TIMEOUT` seconds; unlike jobs that ran out
+of time, those are tried again by the next caller.
+
+Set `KLAUS_RENDER_PROCESSES` to 0 to render in the calling process.
+"""
+import itertools
+import multiprocessing
+import signal
+import threading
+import time
+from multiprocessing.queues import SimpleQueue
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows; jobs are only limited by wall-clock time.
+    resource = None
+
+from django.conf import settings
+
+from dulwich.lru_cache import LRUCache
+
+from klaus import timing
+
+#: Don't retry jobs that timed out for this many seconds.
+RETRY_TIMEOUT_AFTER = 10 * 60
+
+
+class RenderTimeout(Exception):
+    pass
+
+
+_pool = None
+_jobs = {}                          # key -> _Job
+_pending = {}                       # job id -> _Job, until it is done
+_job_ids = itertools.count()
+_timed_out = LRUCache(1000)
+_lock = threading.Lock()
+
+#: Workers put the ids of the jobs they start in here.
+_started = None
+
+
+class _Job(object):
+    """ The outcome of a job, for callers waiting for the same job. """
+    def __init__(self):
+        self.started = threading.Event()
+        self.done = threading.Event()
+        self.value = None
+        self.exception = None
+
+
+def run(func, args, key=None):
+    """
+    Returns `func(*args)`, called in a pool process.  `func` and `args` must
+    be picklable.  Calls with the same `key` that overlap are coalesced.
+
+    Raises `RenderTimeout` if the call takes too long, or did so recently.
+    """
+    processes = getattr(settings, 'KLAUS_RENDER_PROCESSES', 2)
+    if not processes:
+        return func(*args)
+
+    timeout = getattr(settings, 'KLAUS_RENDER_TIMEOUT', 10)
+    # The job's CPU time is limited in the worker; allow for it getting less
+    # than all of the wall-clock time on a busy machine.
+    wait = 2 * timeout + 1
+
+    with _lock:
+        if key is not None:
+            timed_out_at = _timed_out.get(key)
+            if timed_out_at and \
+               time.time() - timed_out_at < RETRY_TIMEOUT_AFTER:
+                raise RenderTimeout()
+
+        job = _jobs.get(key) if key is not None else None
+        if job is not None:
+            is_owner = False
+        else:
+            is_owner = True
+            job = _Job()
+            job_id = next(_job_ids)
+            _pending[job_id] = job
+            if key is not None:
+                _jobs[key] = job
+            result = _get_pool(processes).apply_async(
+                _run_job, (func, args, timeout, job_id, time.time() + timeout))
+            timing.count('render-jobs')
+
+    # `Event.wait` only returns the flag since Python 2.7.
+    if not is_owner:
+        job.done.wait(timeout + wait)
+        if not job.done.is_set():
+            raise RenderTimeout()
+        if job.exception is not None:
+            raise job.exception
+        return job.value
+
+    try:
+        job.started.wait(timeout)
+        if not job.started.is_set():
+            # No free worker; the job is skipped when its turn comes.
+            timing.count('render-queue-timeouts')
+            raise RenderTimeout()
+        job.value = result.get(wait)
+        return job.value
+    except multiprocessing.TimeoutError:
+        # The worker was killed for exceeding the CPU time limit (or hangs).
+        job.exception = RenderTimeout()
+        if key is not None:
+            with _lock:
+                _timed_out.add(key, time.time())
+        raise job.exception
+    except Exception as exc:
+        job.exception = exc
+        raise
+    finally:
+        with _lock:
+            _pending.pop(job_id, None)
+            if key is not None:
+                _jobs.pop(key, None)
+        job.done.set()
+
+
+def _get_pool(processes):
+    global _pool, _started
+    if _pool is None:
+        _started = SimpleQueue()
+        _pool = multiprocessing.Pool(processes, initializer=_init_worker,
+                                     initargs=(_started,))
+        thread = threading.Thread(target=_watch_started, args=(_started,))
+        thread.daemon = True
+        thread.start()
+    return _pool
+
+
+def _watch_started(started):
+    """ Tells the callers of jobs that workers started them. """
+    while True:
+        job_id = started.get()
+        with _lock:
+            job = _pending.get(job_id)
+        if job is not None:
+            job.started.set()
+
+
+def _init_worker(started):
+    global _started
+    _started = started
+    # Leave Ctrl-C handling to the parent process.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    if resource is not None:
+        # Don't dump core when killed for exceeding the CPU time limit.
+        resource.setrlimit(resource.RLIMIT_CORE, (0, 0))
+
+
+def _run_job(func, args, timeout, job_id, start_by):
+    if time.time() > start_by:
+        # The caller stopped waiting for a free worker.
+        return None
+    # Not buffered, so this reaches the caller even if the job hogs the
+    # process from now on.
+    _started.put(job_id)
+
+    if resource is None:
+        return func(*args)
+
+    # The kernel kills the process (SIGXCPU) once it exceeds the soft limit,
+    # even if it is stuck in C code like the regex engine.
+    soft, hard = resource.getrlimit(resource.RLIMIT_CPU)
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    limit = int(usage.ru_utime + usage.ru_stime + timeout) + 1
+    if hard != resource.RLIM_INFINITY:
+        limit = min(limit, hard)
+    resource.setrlimit(resource.RLIMIT_CPU, (limit, hard))
+    try:
+        return func(*args)
+    finally:
+        resource.setrlimit(resource.RLIMIT_CPU, (soft, hard))
@@ -1,6 +1,15 @@
 # -*- coding: utf-8 -*-
 from datetime import datetime
+import collections
+import contextlib
+import hashlib
+import itertools
+import marshal
 import os
+import stat
+import threading
+import time
+import zlib
 import StringIO
 
 from django.conf import settings
@@ -8,9 +17,19 @@ from django.conf import settings
 import dulwich
 import dulwich.patch
 import dulwich.repo
+from dulwich.lru_cache import LRUCache
+from dulwich.refs import DiskRefsContainer
 
-from klaus.utils import check_output, force_unicode, extract_author_name
+from klaus import blame, cache, timing
+from klaus.utils import atomic_write, force_unicode, extract_author_name
 from klaus.diff import prepare_udiff
+from klaus.commitgraph import CommitGraph
+from klaus.messageindex import MessageIndex, commit_matcher
+from klaus.pathindex import PathIndex
+from klaus.refsnapshot import RefSnapshot
+from klaus.objects import LazyBlob, probe_object
+from klaus.objectstore import SharedObjectStore, SynchronizedLRUCache
+from klaus.updater import IndexUpdater
 
 
 class RepoException(Exception):
@@ -45,16 +64,119 @@ class FancyCommit(object):
 
 class FancyRepo(dulwich.repo.Repo):
     # TODO: factor out stuff into dulwich
+    def __init__(self, *args, **kwargs):
+        super(FancyRepo, self).__init__(*args, **kwargs)
+        # Safe to share between threads, see `klaus.objectstore`.
+        self.object_store = SharedObjectStore(self.object_store.path)
+        # Held while updating the indexes below
+        self._lock = threading.RLock()
+        # Held while updating the path or message index, which requests
+        # don't wait for (see `get_path_index`)
+        self._index_lock = threading.Lock()
+        # The repo's state token (see `RepoManager.get_state`), set by
+        # `RepoManager`; None if the repo isn't watched.
+        self.state = None
+        self._updated = {}
+        self._commit_graph = None
+        self._ref_snapshot = None
+        self._path_index = None
+        self._message_index = None
+        self._tree_cache = SynchronizedLRUCache(
+            getattr(settings, 'KLAUS_TREE_CACHE_SIZE', 1000))
+        self._path_cache = SynchronizedLRUCache(
+            getattr(settings, 'KLAUS_PATH_CACHE_SIZE', 10000))
+
     @property
     def name(self):
-        return self.path.rstrip(os.sep).split(os.sep)[-1].replace('.git', '')
+        return repo_name(self.path)
+
+    def cache_path(self, filename):
+        """
+        Returns the path of `filename` in klaus' on-disk cache for this repo.
+        That is `KLAUS_CACHE_DIR/<repo name>/` if `KLAUS_CACHE_DIR` is set and
+        the `klaus` directory inside the repo's control directory otherwise.
+        """
+        return cache_path(self.path, filename)
+
+    def _update(self, name, obj, *args):
+        """
+        Calls `obj.update(*args)` unless `obj` (called `name`) was already
+        updated in the current `state`.  Unwatched repos are always updated.
+        """
+        state = self.state
+        if state is None or self._updated.get(name) != state:
+            with timing.timed('update-' + name):
+                obj.update(*args)
+            self._updated[name] = state
+        return obj
+
+    def get_commit_graph(self):
+        """ Returns the repo's `CommitGraph`, updated to the current refs. """
+        with self._lock:
+            if self._commit_graph is None:
+                self._commit_graph = CommitGraph(self)
+            return self._update('graph', self._commit_graph)
+
+    def get_path_index(self):
+        """
+        Returns the repo's `PathIndex`, or None if `KLAUS_PATH_INDEX` is
+        disabled or the index hasn't been loaded yet.
+
+        The index is loaded and updated to the current refs by a background
+        thread, so it may not cover the newest commits (`CommitGraph.walk`
+        reads their trees instead).
+        """
+        if not getattr(settings, 'KLAUS_PATH_INDEX', True):
+            return None
+        self._schedule_update('path_index', PathIndex)
+        return self._path_index
+
+    def get_message_index(self):
+        """
+        Returns the repo's `MessageIndex`, or None if it hasn't been loaded
+        yet.  Like the path index, it is updated in the background.
+        """
+        self._schedule_update('message_index', MessageIndex)
+        return self._message_index
+
+    def update_indexes(self):
+        """
+        Brings the commit graph and the path and message indexes up to date
+        right away, instead of in the background.
+        """
+        self._update_index('path_index', PathIndex)
+        self._update_index('message_index', MessageIndex)
+
+    def _schedule_update(self, name, cls):
+        state = self.state
+        if state is None or self._updated.get(name) != state:
+            _index_updater.schedule((id(self), name), self._update_index,
+                                    name, cls)
+
+    def _update_index(self, name, cls):
+        with self._index_lock:
+            state = self.state
+            index = getattr(self, '_' + name)
+            if index is None:
+                index = cls(self)
+                setattr(self, '_' + name, index)
+            index.update(self.get_commit_graph())
+            self._updated[name] = state
+
+    def get_metadata(self):
+        """ Returns a `RepoMetadata` snapshot of the repo. """
+        return RepoMetadata(
+            name=self.name,
+            last_updated_at=self.get_last_updated_at(),
+            description=self.get_description(),
+            default_branch=self.get_default_branch(),
+            ref_count=len(self.get_ref_snapshot().refs),
+        )
 
     def get_last_updated_at(self):
-        refs = [self[ref_hash] for ref_hash in self.get_refs().itervalues()]
-        refs.sort(key=lambda obj: getattr(obj, 'commit_time', None),
-                  reverse=True)
-        if refs:
-            return datetime.utcfromtimestamp(refs[0].commit_time)
+        commit_time = self.get_ref_snapshot().last_commit_time()
+        if commit_time is not None:
+            return datetime.utcfromtimestamp(commit_time)
 
         return None
 
@@ -97,18 +219,19 @@ class FancyRepo(dulwich.repo.Repo):
         except IndexError:
             return None
 
-    def get_sorted_ref_names(self, prefix, exclude=None):
-        refs = self.refs.as_dict(prefix)
-        if exclude:
-            refs.pop(prefix + exclude, None)
-
-        def get_commit_time(refname):
-            obj = self[refs[refname]]
-            if isinstance(obj, dulwich.objects.Tag):
-                return obj.tag_time
-            return obj.commit_time
+    def get_ref_snapshot(self):
+        """ Returns the repo's `RefSnapshot`, updated to the current refs. """
+        with self._lock:
+            if self._ref_snapshot is None:
+                self._ref_snapshot = RefSnapshot(self)
+            self._ref_snapshot.update(self.state or refs_signature(self.path))
+            return self._ref_snapshot
 
-        return sorted(refs.iterkeys(), key=get_commit_time, reverse=True)
+    def get_sorted_ref_names(self, prefix, exclude=None):
+        names = self.get_ref_snapshot().sorted_names(prefix)
+        if exclude in names:
+            names = [name for name in names if name != exclude]
+        return names
 
     def get_branch_names(self, exclude=None):
         """ Returns a sorted list of branch names. """
@@ -124,102 +247,675 @@ class FancyRepo(dulwich.repo.Repo):
         or commit `commit`. `skip` can be used for pagination, `max_commits`
         to limit the number of commits returned.
 
-        Similar to `git log [branch/commit] [--skip skip] [-n max_commits]`.
+        Similar to `git log [branch/commit] [--skip skip] [-n max_commits]`,
+        but walks the repo's `CommitGraph` in-process (consulting its
+        `PathIndex` to decide which commits changed `path`).
         """
-        # XXX The pure-Python/dulwich code is very slow compared to `git log`
-        #     at the time of this writing (mid-2012).
-        #     For instance, `git log .tx` in the Django root directory takes
-        #     about 0.15s on my machine whereas the history() method needs 5s.
-        #     Therefore we use `git log` here until dulwich gets faster.
-        #     For the pure-Python implementation, see the 'purepy-hist' branch.
-
-        cmd = ['git', 'log', '--format=%H']
-        if skip:
-            cmd.append('--skip=%d' % skip)
-        if max_commits:
-            cmd.append('--max-count=%d' % max_commits)
-        cmd.append(commit)
-        if path:
-            cmd.extend(['--', path])
+        return self.history_page(commit, path, max_commits, skip)[0]
 
-        sha1_sums = check_output(cmd, cwd=os.path.abspath(self.path))
-        return [FancyCommit(self[sha1], self) for sha1 in
-                sha1_sums.strip().split('\n')]
+    def history_page(self, commit, path=None, max_commits=None, skip=0,
+                     cursor=None, query=None):
+        """
+        Like `history`, but returns a tuple of the list of commits and a
+        cursor for the next page: a tuple of commit SHAs that can be passed
+        as `cursor` to continue the walk after the last commit returned.  The
+        cursor is None if there are no more commits.
+
+        If `cursor` is given (it must be the cursor for `skip`), the walk
+        continues from there.  Otherwise the commits to skip are only walked
+        if there is no cursor for them cached from an earlier call, so paging
+        through the whole history takes linear time either way.
+
+        If a `CommitQuery` `query` is given, only commits that match it are
+        returned (see `MessageIndex`).
+        """
+        graph = self.get_commit_graph()
+        path_index = self.get_path_index() if path else None
+        commit_id = self.get_commit(commit).id
+        if query:
+            message_index = self.get_message_index()
+            if message_index is not None:
+                match = message_index.matcher(graph, query)
+            else:
+                match = commit_matcher(self, graph, query)
+        else:
+            query = None
+            match = lambda pos: True
+        if cursor is not None and all(sha in graph for sha in cursor):
+            walk = graph.resume(cursor, path, path_index)
+        elif skip:
+            cached = cache.get(self._history_cursor_key(commit_id, path, query,
+                                                        skip))
+            if cached is not None and all(sha in graph for sha in cached):
+                walk = graph.resume(cached, path, path_index)
+            else:
+                walk = graph.walk(commit_id, path, path_index)
+                with timing.timed('history'):
+                    for _ in itertools.islice(itertools.ifilter(match, walk),
+                                              skip):
+                        pass
+        else:
+            walk = graph.walk(commit_id, path, path_index)
+
+        # The walk's state is not affected by filtering, so its frontier is
+        # still a valid cursor.
+        matches = itertools.ifilter(match, walk)
+        with timing.timed('history'):
+            positions = list(itertools.islice(matches, max_commits))
+            next_cursor = tuple(walk.frontier)
+            if next(matches, None) is None:
+                # With a `path` or `query`, the commits left might not match.
+                next_cursor = None
+        if next_cursor is not None and max_commits:
+            cache.set(self._history_cursor_key(
+                commit_id, path, query, skip + len(positions)), next_cursor)
+        return ([FancyCommit(self[graph.shas[pos]], self) for pos in positions],
+                next_cursor)
+
+    def _history_cursor_key(self, commit_id, path, query, skip):
+        return cache.make_key('history_cursor', self.path, commit_id, path,
+                              query and tuple(query), skip)
 
     def get_blob_or_tree(self, commit, path=None):
-        """ Returns the Git tree or blob object for `path` at `commit`. """
-        tree_or_blob = self[commit.tree]  # Still a tree here but may turn into
-                                          # a blob somewhere in the loop.
-        path = path or ''
-        for part in path.strip('/').split('/'):
-            if part:
-                if isinstance(tree_or_blob, dulwich.objects.Blob):
-                    # Blobs don't have sub-files/folders.
-                    raise KeyError
-                tree_or_blob = self[tree_or_blob[part][1]]
-        return tree_or_blob
-
-    def commit_diff(self, commit):
-        from klaus.utils import guess_is_binary, force_unicode
+        """
+        Returns the Git tree or blob object for `path` at `commit`.  Blobs are
+        returned as `LazyBlob`s, so their size can be checked before loading.
+        """
+        entry = self.get_path_entry(commit.tree, path or '')
+        if entry is None:
+            raise KeyError(path)
+        mode, sha = entry
+        if stat.S_ISDIR(mode):
+            return self.get_tree(sha)
+        if dulwich.objects.S_ISGITLINK(mode):
+            # Submodule commit, not in this repo
+            raise KeyError(path)
+        return LazyBlob(self.object_store, sha)
+
+    def get_tree(self, sha):
+        """ Like `self[sha]` for trees, but keeps recently used trees parsed. """
+        tree = self._tree_cache.get(sha)
+        if tree is None:
+            tree = self[sha]
+            self._tree_cache.add(sha, tree)
+        return tree
+
+    def get_path_entry(self, tree_sha, path):
+        """
+        Returns the `(mode, sha)` tuple of `path` in tree `tree_sha` or None if
+        there is no such path.
 
-        if commit.parents:
-            parent_tree = self[commit.parents[0]].tree
-        else:
-            parent_tree = None
+        Results are memoized per `(tree_sha, path)`, and lookups of deep paths
+        reuse the memoized entries of their parent directories.
+        """
+        path = path.strip('/')
+        if not path:
+            return stat.S_IFDIR, tree_sha
 
-        changes = self.object_store.tree_changes(parent_tree, commit.tree)
-        for (oldpath, newpath), (oldmode, newmode), (oldsha, newsha) in changes:
+        key = (tree_sha, path)
+        try:
+            return self._path_cache[key]
+        except KeyError:
+            pass
+
+        parent, _, name = path.rpartition('/')
+        entry = self.get_path_entry(tree_sha, parent)
+        if entry is not None:
+            mode, sha = entry
             try:
-                if newsha and guess_is_binary(self[newsha]) or \
-                   oldsha and guess_is_binary(self[oldsha]):
-                    yield {
-                        'is_binary': True,
-                        'old_filename': oldpath or '/dev/null',
-                        'new_filename': newpath or '/dev/null',
-                        'chunks': None
-                    }
-                    continue
+                entry = self.get_tree(sha)[name] if stat.S_ISDIR(mode) else None
             except KeyError:
-                # newsha/oldsha are probably related to submodules.
-                # Dulwich will handle that.
-                pass
+                entry = None
+        self._path_cache.add(key, entry)
+        return entry
+
+    def commit_diff(self, commit, max_lines=None, max_file_lines=None,
+                    max_file_size=None):
+        """
+        Returns a list of per-file diffs of `commit` against its first parent
+        in the format of `klaus.diff.prepare_udiff`.
+
+        To bound the work spent on huge commits, files with more than
+        `max_file_lines` lines of diff, and all files from the one that would
+        exceed `max_lines` lines of diff in total on, are `collapsed`: Their
+        chunks are not computed (see `get_file_diff`).  Text files larger than
+        `max_file_size` bytes are collapsed without even reading them.
+
+        Commits never change, so the diffs are cached per commit SHA in
+        Django's cache framework (see `klaus.cache`).
+        """
+        key = cache.make_key('commit_diff', commit.id, max_lines,
+                             max_file_lines, max_file_size, DIFF_CACHE_VERSION)
+        packed = cache.get_or_create(key, lambda: _pack_diff(self._commit_diff(
+            commit, max_lines, max_file_lines, max_file_size)))
+        return _unpack_diff(packed)
+
+    def get_file_diff(self, commit, path):
+        """
+        Returns the diff of the file at `path` in `commit` against the commit's
+        first parent, in the format of `commit_diff` (but never collapsed).
+        Raises `KeyError` if `commit` didn't change such a file.
+        """
+        parent_tree = self._get_parent_tree(commit)
+        old = new = None
+        if parent_tree is not None:
+            old = self.get_path_entry(parent_tree, path)
+        new = self.get_path_entry(commit.tree, path)
+        if old == new or any(stat.S_ISDIR(entry[0])
+                             for entry in [old, new] if entry is not None):
+            raise KeyError(path)
+
+        oldmode, oldsha = old or (None, None)
+        newmode, newsha = new or (None, None)
+        return self._file_diff((old and path, new and path),
+                               (oldmode, newmode), (oldsha, newsha))
+
+    def get_blame(self, commit, path):
+        """
+        Returns the `Blame` of the file at `path` in `commit`: the commit that
+        last changed each of its lines (see `klaus.blame`).  Raises `KeyError`
+        if there is no such file.
+        """
+        return blame.get_blame(self, commit, path)
+
+    def _get_parent_tree(self, commit):
+        if commit.parents:
+            return self[commit.parents[0]].tree
+        return None
 
-            stringio = StringIO.StringIO()
+    def _commit_diff(self, commit, max_lines, max_file_lines, max_file_size):
+        with timing.timed('tree-changes'):
+            changes = list(self.object_store.tree_changes(
+                self._get_parent_tree(commit), commit.tree))
+        for (oldpath, newpath), modes, shas in changes:
+            # Once the line budget is used up, files are collapsed without
+            # looking at them.
+            if max_lines is None or max_lines > 0:
+                infos = map(self._probe_blob, shas)
+                # Binary files are cheap to "diff", whatever their size.
+                too_large = max_file_size is not None and any(
+                    info.size > max_file_size and not info.is_binary
+                    for info in infos if info)
+            if (max_lines is None or max_lines > 0) and not too_large:
+                file = self._file_diff((oldpath, newpath), modes, shas,
+                                       infos)
+                lines = sum(len(chunk) for chunk in file['chunks'] or [])
+                if max_lines is not None and lines > max_lines:
+                    # Collapse this and all following files.
+                    max_lines = 0
+                elif max_file_lines is None or lines <= max_file_lines:
+                    if max_lines is not None:
+                        max_lines -= lines
+                    yield file
+                    continue
+
+            yield {
+                'path': newpath or oldpath,
+                'old_filename': oldpath or '/dev/null',
+                'new_filename': newpath or '/dev/null',
+                'collapsed': True,
+                'chunks': None,
+            }
+
+    def _file_diff(self, paths, modes, shas, infos=None):
+        from klaus.utils import guess_is_binary
+
+        (oldpath, newpath), (oldmode, newmode), (oldsha, newsha) = \
+            paths, modes, shas
+
+        file = {
+            'path': newpath or oldpath,
+            'old_filename': oldpath or '/dev/null',
+            'new_filename': newpath or '/dev/null',
+            'collapsed': False,
+        }
+        if infos is None:
+            infos = map(self._probe_blob, shas)
+        for sha, info in zip(shas, infos):
+            if info is None:
+                continue
+            is_binary = info.is_binary
+            if is_binary is None:
+                # Too large to probe, need to look at the whole blob.
+                is_binary = guess_is_binary(self[sha])
+            if is_binary:
+                file.update({
+                    'is_binary': True,
+                    'chunks': None
+                })
+                return file
+
+        stringio = StringIO.StringIO()
+        with timing.timed('diff'):
             dulwich.patch.write_object_diff(stringio, self.object_store,
                                             (oldpath, oldmode, oldsha),
                                             (newpath, newmode, newsha))
-            files = prepare_udiff(force_unicode(stringio.getvalue()),
-                                  want_header=False)
-            if not files:
-                # the diff module doesn't handle deletions/additions
-                # of empty files correctly.
-                yield {
-                    'old_filename': oldpath or '/dev/null',
-                    'new_filename': newpath or '/dev/null',
-                    'chunks': []
-                }
-            else:
-                yield files[0]
+        files = prepare_udiff(force_unicode(stringio.getvalue()),
+                              want_header=False)
+        if not files:
+            # the diff module doesn't handle deletions/additions
+            # of empty files correctly.
+            file['chunks'] = []
+        else:
+            file.update(files[0])
+        return file
+
+    def _probe_blob(self, sha):
+        """
+        Returns the `ObjectInfo` of blob `sha` (see `probe_object`), or None
+        if there is no such object (e.g. because `sha` is a submodule commit).
+        """
+        if sha is None:
+            return None
+        try:
+            return probe_object(self.object_store, sha)
+        except KeyError:
+            return None
+
+
+RepoMetadata = collections.namedtuple('RepoMetadata', [
+    'name', 'last_updated_at', 'description', 'default_branch', 'ref_count'
+])
+
+
+#: Part of the commit diff cache key; increase on changes to the diff format.
+DIFF_CACHE_VERSION = 2
+
+
+def _pack_diff(files):
+    """
+    Serializes the per-file diffs yielded by `FancyRepo._commit_diff` into a
+    compact, compressed string of nested tuples.
+    """
+    packed = []
+    for file in files:
+        chunks = file['chunks']
+        if chunks is not None:
+            chunks = tuple(
+                tuple((line['old_lineno'], line['new_lineno'],
+                       line['action'], line['line']) for line in chunk)
+                for chunk in chunks
+            )
+        packed.append((file['path'], file['old_filename'],
+                       file['new_filename'], file.get('is_binary', False),
+                       file['collapsed'], chunks))
+    return zlib.compress(marshal.dumps(tuple(packed)))
+
+
+def _unpack_diff(data):
+    """ Inverse of `_pack_diff`. """
+    files = []
+    for path, old_filename, new_filename, is_binary, collapsed, chunks in \
+            marshal.loads(zlib.decompress(data)):
+        if chunks is not None:
+            chunks = [
+                [{'old_lineno': old_lineno, 'new_lineno': new_lineno,
+                  'action': action, 'line': line}
+                 for old_lineno, new_lineno, action, line in chunk]
+                for chunk in chunks
+            ]
+        files.append({
+            'path': path,
+            'old_filename': old_filename,
+            'new_filename': new_filename,
+            'is_binary': is_binary,
+            'collapsed': collapsed,
+            'chunks': chunks,
+        })
+    return files
 
 
 class RepoManager(object):
-    _repos = []
+    """
+    Keeps an index of all repositories by name.
+
+    Repositories are registered by path, either explicitly (`add_repo`,
+    `KLAUS_REPO_PATHS`) or by discovery below a set of root directories
+    (`discover`, `KLAUS_REPO_ROOTS`). They are only opened on first use and at
+    most `KLAUS_MAX_OPEN_REPOS` of them are kept open at the same time; the
+    least recently used repos are closed (releasing their pack files) when
+    that limit is exceeded.
+
+    For each repository, a state token is kept that changes whenever the repo
+    changes (see `get_state`); functions registered with
+    `add_invalidation_callback` are called when it does.
+    """
+    _repo_paths = {}
+    _roots = []
+    _metadata = {}
+    _open_repos = LRUCache(getattr(settings, 'KLAUS_MAX_OPEN_REPOS', 100))
+    _lock = threading.Lock()
+    _states = {}                # name -> (refs signature, state token)
+    _state_lock = threading.Lock()
+    _callbacks = []
+    _watcher = None
+    _discovered_at = 0
+    _discover_lock = threading.Lock()
 
     @classmethod
     def all_repos(cls):
-        return cls._repos
+        """ Yields all repositories, sorted by name. """
+        for name in cls.repo_names():
+            yield cls.get_repo(name)
+
+    @classmethod
+    def repo_names(cls):
+        return sorted(cls._repo_paths)
+
+    @classmethod
+    def get_metadata(cls, repo_name):
+        """
+        Returns a `RepoMetadata` snapshot of the repo called `repo_name`.
+
+        Snapshots are kept (in memory and in Django's cache) until the repo's
+        state changes, so this usually doesn't even open the repo.
+        """
+        path = cls._repo_paths[repo_name]
+        state = cls.get_state(repo_name)
+        cached = cls._metadata.get(repo_name)
+        if cached is not None and cached[0] == state:
+            return cached[1]
+
+        metadata = cache.get_or_create(
+            cache.make_key('repo_metadata', path, state),
+            lambda: cls.get_repo(repo_name).get_metadata(),
+            size=None,
+        )
+        cls._metadata[repo_name] = (state, metadata)
+        return metadata
+
+    @classmethod
+    def get_state(cls, repo_name):
+        """
+        Returns the state token of the repo called `repo_name`, a string that
+        changes whenever any of its refs (or its description) changes, or the
+        repo is marked as dirty (see `mark_dirty`).
+
+        The token is only recomputed if the `refs_signature` changed.  If
+        `KLAUS_WATCH_INTERVAL` is set, the signatures of all repos are checked
+        by a background thread every that many seconds instead of on every
+        call.
+        """
+        cls._start_watcher()
+        if cls._watcher is not None:
+            known = cls._states.get(repo_name)
+            if known is not None:
+                return known[1]
+        return cls.check_state(repo_name)
+
+    @classmethod
+    def get_known_state(cls, repo_name):
+        """
+        Returns the state token of the repo called `repo_name` as last seen
+        by `get_state` or the watcher, without looking at the repo, or None if
+        it wasn't seen yet.
+        """
+        known = cls._states.get(repo_name)
+        return known and known[1]
+
+    @classmethod
+    def check_state(cls, repo_name):
+        """
+        Updates the state token of the repo called `repo_name` and returns it,
+        calling the invalidation callbacks if it changed.
+        """
+        path = cls._get_path(repo_name)
+        signature = refs_signature(path)
+        known = cls._states.get(repo_name)
+        if known is not None and known[0] == signature:
+            return known[1]
+
+        state = state_token(path)
+        with cls._state_lock:
+            known = cls._states.get(repo_name)
+            cls._states[repo_name] = (signature, state)
+        if known is not None and known[1] != state:
+            for callback in list(cls._callbacks):
+                callback(repo_name, state)
+        return state
+
+    @classmethod
+    def add_invalidation_callback(cls, callback):
+        """
+        Registers `callback` to be called as `callback(repo_name, state)`
+        whenever the state token of a repo changes.  Callbacks may be called
+        from any thread, including the watcher thread.
+        """
+        cls._callbacks.append(callback)
+
+    @classmethod
+    def mark_dirty(cls, repo_name):
+        """
+        Changes the state of the repo called `repo_name` (in all processes) as
+        if its refs had changed.
+        """
+        mark_dirty(cls._get_path(repo_name))
+        cls.check_state(repo_name)
+
+    @classmethod
+    def _start_watcher(cls):
+        interval = getattr(settings, 'KLAUS_WATCH_INTERVAL', 0)
+        if interval and cls._watcher is None:
+            with cls._state_lock:
+                if cls._watcher is None:
+                    cls._watcher = RepoWatcher(interval)
+                    cls._watcher.start()
 
     @classmethod
     def add_repo(cls, path):
-        cls._repos.append(FancyRepo(path))
+        cls._repo_paths[repo_name(path)] = path
+
+    @classmethod
+    def discover(cls, root):
+        """
+        Adds all repositories found in (sub-)directories of `root`. Repos
+        added later on are found on their first lookup by `get_repo`.
+        """
+        if root not in cls._roots:
+            cls._roots.append(root)
+        cls._discovered_at = time.time()
+        for dirpath, dirnames, filenames in os.walk(root):
+            if is_repo(dirpath):
+                cls.add_repo(dirpath)
+                # Don't descend into repos
+                del dirnames[:]
 
     @classmethod
     def get_repo(cls, repo_name):
-        for r in cls._repos:
-            if r.name == repo_name:
-                return r
+        cls.get_state(repo_name)
+        with cls._lock:
+            repo = cls._open_repos.get(repo_name)
+            if repo is None:
+                repo = FancyRepo(cls._get_path(repo_name))
+                # Later changes are passed on by `_update_open_repo`.
+                repo.state = cls._states[repo_name][1]
+                cls._open_repos.add(repo_name, repo, cleanup=_close_repo)
+            return repo
+
+    @classmethod
+    @contextlib.contextmanager
+    def borrow_repo(cls, repo_name):
+        """
+        Yields the repo called `repo_name` like `get_repo`, but doesn't add it
+        to the open repos (pushing out another one) if it isn't open already;
+        it is closed afterwards then.  For occasional use of many repos.
+        """
+        with cls._lock:
+            repo = cls._open_repos.get(repo_name)
+        if repo is not None:
+            yield repo
+            return
+
+        repo = FancyRepo(cls._get_path(repo_name))
+        try:
+            yield repo
+        finally:
+            _close_repo(repo_name, repo)
+
+    @classmethod
+    def cache_path(cls, repo_name, filename):
+        """
+        Returns the path of `filename` in the cache of the repo called
+        `repo_name` (see `FancyRepo.cache_path`), without opening the repo.
+        """
+        return cache_path(cls._get_path(repo_name), filename)
+
+    @classmethod
+    def _get_path(cls, repo_name):
+        path = cls._repo_paths.get(repo_name) or cls._find_new_repo(repo_name)
+        if path is None:
+            raise RepoException("No such repository %s" % repo_name)
+        return path
+
+    @classmethod
+    def _find_new_repo(cls, repo_name):
+        for root in cls._roots:
+            for candidate in [repo_name, repo_name + '.git']:
+                path = os.path.join(root, candidate)
+                if is_repo(path):
+                    cls.add_repo(path)
+                    return path
+
+        # Repos in subdirectories: walk the roots again, but only every
+        # KLAUS_DISCOVER_INTERVAL seconds so that lookups of repos that
+        # don't exist stay cheap.
+        interval = getattr(settings, 'KLAUS_DISCOVER_INTERVAL', 60)
+        with cls._discover_lock:
+            if time.time() - cls._discovered_at >= interval:
+                for root in list(cls._roots):
+                    cls.discover(root)
+        return cls._repo_paths.get(repo_name)
+
+
+def repo_name(path):
+    """ Returns the name of the repository at `path`. """
+    return path.rstrip(os.sep).split(os.sep)[-1].replace('.git', '')
+
+
+def is_repo(path):
+    """ Returns True if `path` looks like a (bare or non-bare) Git repo. """
+    if os.path.isdir(os.path.join(path, '.git')):
+        return True
+    return os.path.isfile(os.path.join(path, 'HEAD')) and \
+        os.path.isdir(os.path.join(path, 'objects')) and \
+        os.path.isdir(os.path.join(path, 'refs'))
+
+
+def get_controldir(path):
+    """ Returns the Git control directory of the repository at `path`. """
+    controldir = os.path.join(path, '.git')
+    if os.path.isdir(controldir):
+        return controldir
+    return path
+
+
+def refs_signature(path):
+    """
+    Returns a value that changes whenever any ref of the repository at `path`
+    changes, without reading any refs or objects.
+
+    Git updates refs by renaming lock files into place, so it is sufficient to
+    look at the modification times of the directories below `refs` plus
+    `HEAD` and `packed-refs` (and `description` for the repo list, and the
+    marker written by `mark_dirty`).
+    """
+    controldir = get_controldir(path)
+    signature = [_stat(os.path.join(controldir, filename))
+                 for filename in ['HEAD', 'packed-refs', 'description']]
+    for dirpath, _, _ in os.walk(os.path.join(controldir, 'refs')):
+        # Directories may be removed while walking (e.g. by `git pack-refs`).
+        signature.append((dirpath, _stat(dirpath)))
+    signature.append(_stat(dirty_marker_path(path)))
+    return tuple(signature)
+
+
+def state_token(path):
+    """
+    Returns a hash of the refs (and their SHAs), the description and the dirty
+    marker of the repository at `path`.  Reads refs but no objects.
+    """
+    controldir = get_controldir(path)
+    refs = DiskRefsContainer(controldir)
+    state = []
+    for refname in sorted(refs.allkeys()):
+        try:
+            state.append((refname, refs.read_ref(refname)))
+        except (IOError, OSError):
+            # Removed in the meantime
+            pass
+    for filename in [os.path.join(controldir, 'description'),
+                     dirty_marker_path(path)]:
+        try:
+            with open(filename, 'rb') as fileobj:
+                state.append(fileobj.read())
+        except IOError:
+            state.append(None)
+    return hashlib.sha1(repr(state)).hexdigest()
+
+
+def cache_path(path, filename):
+    """ Returns the path of `filename` in the cache of the repo at `path`. """
+    cache_dir = getattr(settings, 'KLAUS_CACHE_DIR', None)
+    if cache_dir:
+        return os.path.join(cache_dir, repo_name(path), filename)
+    return os.path.join(get_controldir(path), 'klaus', filename)
+
+
+def dirty_marker_path(path):
+    return cache_path(path, 'dirty')
+
+
+def mark_dirty(path):
+    """
+    Changes the state token of the repo at `path`, so that all derived data
+    is refreshed (see `RepoManager.get_state`).
+    """
+    atomic_write(dirty_marker_path(path), os.urandom(16).encode('hex'))
+
+
+class RepoWatcher(threading.Thread):
+    """ Checks the state of all repos every `interval` seconds. """
+    daemon = True
+
+    def __init__(self, interval):
+        super(RepoWatcher, self).__init__(name='klaus-repo-watcher')
+        self.interval = interval
+
+    def run(self):
+        while True:
+            for name in RepoManager.repo_names():
+                try:
+                    RepoManager.check_state(name)
+                except Exception:
+                    # Removed repos, broken refs or callbacks; keep watching.
+                    pass
+            time.sleep(self.interval)
+
+
+def _stat(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_ino, st.st_mtime, st.st_size)
+
+
+def _close_repo(name, repo):
+    repo.object_store.close()
+
+
+def _update_open_repo(name, state):
+    with RepoManager._lock:
+        repo = RepoManager._open_repos.get(name)
+        if repo is not None:
+            repo.state = state
+
+
+RepoManager.add_invalidation_callback(_update_open_repo)
 
-        raise Exception("No such repository %s".format(repo_name))
+#: Updates the path and message indexes of open repos.
+_index_updater = IndexUpdater('klaus-indexer')
 
 
 map(RepoManager.add_repo, getattr(settings, 'KLAUS_REPO_PATHS', []))
+map(RepoManager.discover, getattr(settings, 'KLAUS_REPO_ROOTS', []))
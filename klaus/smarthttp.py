@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+"""
+Read-only Git smart HTTP, so that repos can be cloned and fetched from the
+URL of their history page (``git clone http://example.com/klaus/<repo>/``).
+
+`advertise_refs` and `upload_pack` answer the two requests of the protocol,
+``info/refs?service=git-upload-pack`` and ``git-upload-pack``, by running
+``git upload-pack --stateless-rpc`` (`KLAUS_GIT_BINARY` is the ``git``
+executable to use).  The pack is sent while Git generates it.
+
+The responses to requests without ``have`` lines (clones, as opposed to
+fetches) only depend on the request and on the repo's refs, so they are
+cached in the directory `KLAUS_PACK_CACHE_DIR`, or the ``packs`` directory in
+each repo's klaus cache directory if that is not set.  Once the packs in the
+directory take up more than `KLAUS_PACK_CACHE_SIZE` bytes (default: 1 GB; 0
+disables the cache), the least recently used ones are removed.
+"""
+import hashlib
+import os
+import subprocess
+import tempfile
+
+from django.conf import settings
+
+from klaus import timing
+from klaus.repo import RepoManager
+from klaus.utils import check_output
+
+SERVICE = 'git-upload-pack'
+
+#: Part of the cache keys; increase on changes to the generated packs.
+PACK_CACHE_VERSION = 1
+
+DEFAULT_CACHE_SIZE = 1024 * 1024 * 1024
+
+#: The pack is read from Git in chunks of at most this size.
+CHUNK_SIZE = 64 * 1024
+
+
+def get_command(repo, *args):
+    git = getattr(settings, 'KLAUS_GIT_BINARY', 'git')
+    return [git, 'upload-pack', '--stateless-rpc'] + list(args) + [repo.path]
+
+
+def advertise_refs(repo):
+    """ Returns the response to ``info/refs?service=git-upload-pack``. """
+    timing.count('subprocesses')
+    with timing.timed('upload-pack'):
+        refs = check_output(get_command(repo, '--advertise-refs'))
+    return pkt_line('# service=%s\n' % SERVICE) + '0000' + refs
+
+
+def upload_pack(repo, request_body):
+    """
+    Yields the response to the ``git-upload-pack`` request `request_body`
+    while Git generates it.  Raises `subprocess.CalledProcessError` at the
+    end if Git fails, so the response is not cached.
+    """
+    # Git may answer before it read all of the request; don't let it block
+    # on a full pipe.
+    stdin = tempfile.TemporaryFile()
+    stdin.write(request_body)
+    stdin.seek(0)
+    stderr = tempfile.TemporaryFile()
+    command = get_command(repo)
+    timing.count('subprocesses')
+    process = subprocess.Popen(command, stdin=stdin, stdout=subprocess.PIPE,
+                               stderr=stderr, close_fds=True)
+    stdin.close()
+    try:
+        while True:
+            # Only the time spent waiting for Git, not for the client
+            with timing.timed('upload-pack'):
+                chunk = os.read(process.stdout.fileno(), CHUNK_SIZE)
+            if not chunk:
+                break
+            yield chunk
+        with timing.timed('upload-pack'):
+            returncode = process.wait()
+        if returncode:
+            stderr.seek(0)
+            raise subprocess.CalledProcessError(process.returncode, command,
+                                                stderr.read())
+    finally:
+        if process.poll() is None:
+            # The client went away.
+            process.kill()
+            process.wait()
+        process.stdout.close()
+        stderr.close()
+
+
+def get_cache_size():
+    return getattr(settings, 'KLAUS_PACK_CACHE_SIZE', DEFAULT_CACHE_SIZE)
+
+
+def get_cache_path(repo, request_body):
+    """
+    Returns the path of the response to `request_body` in the pack cache, or
+    None if the cache is disabled or the response is not to be cached.
+    """
+    if not get_cache_size():
+        return None
+    lines = parse_pkt_lines(request_body)
+    if lines is None or any(line.startswith('have ') for line in lines):
+        return None
+    cache_dir = getattr(settings, 'KLAUS_PACK_CACHE_DIR', None) or \
+        repo.cache_path('packs')
+    key = hashlib.sha1(repr((PACK_CACHE_VERSION,
+                             RepoManager.get_state(repo.name),
+                             lines))).hexdigest()
+    return os.path.join(cache_dir, key + '.pack')
+
+
+def parse_pkt_lines(data):
+    """
+    Returns the pkt-lines in `data` (flush-pkts as empty strings), or None if
+    `data` is not a sequence of pkt-lines.
+
+    >>> parse_pkt_lines('0009done\\n0000')
+    ['done\\n', '']
+    """
+    lines = []
+    pos = 0
+    while pos < len(data):
+        try:
+            size = int(data[pos:pos + 4], 16)
+        except ValueError:
+            return None
+        if size == 0:
+            lines.append('')
+            pos += 4
+        elif 4 < size <= len(data) - pos:
+            lines.append(data[pos + 4:pos + size])
+            pos += size
+        else:
+            return None
+    return lines
+
+
+def pkt_line(data):
+    """
+    Returns `data` as a pkt-line.
+
+    >>> pkt_line('done\\n')
+    '0009done\\n'
+    """
+    return '%04x%s' % (len(data) + 4, data)
@@ -0,0 +1,25 @@
+var load_fragments = function(linksSelector, getTarget) {
+  /* Lazily loaded page parts, like the full list of branches or a large
+     diff: When a link is clicked, replace the contents of `getTarget(link)`
+     with the HTML fetched from the link's URL. */
+  var links = document.querySelectorAll(linksSelector);
+
+  for (var i = 0; i < links.length; ++i) {
+    links[i].onclick = function() {
+      var a = this,
+          target = getTarget(a),
+          request = new XMLHttpRequest();
+
+      request.onload = function() {
+        if (request.status == 200) {
+          target.innerHTML = request.responseText;
+        } else {
+          location.href = a.href;
+        }
+      }
+      request.open('GET', a.href);
+      request.send();
+      return false;
+    }
+  }
+}
@@ -45,3 +45,21 @@ var highlight_linenos = function(opts) {
     }
   };
 }
+
+var follow_line_anchor = function(firstLine, lastLine) {
+  // Large files are shown in windows of lines `firstLine` to `lastLine`.
+  // Load the window that contains the line in the URL ("#L-1234") if it's
+  // not the current one.
+  var follow = function() {
+    var match = /^#L-?(\d+)$/.exec(location.hash);
+    if (match) {
+      var line = parseInt(match[1], 10);
+      if (line < firstLine || line > lastLine) {
+        location.replace('?start=' + line + '#L-' + line);
+      }
+    }
+  }
+
+  follow();
+  window.onhashchange = follow;
+}
@@ -0,0 +1,342 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for the history walks, indexes and blames, checked against Git itself
+on small repositories created with the `git` command line tool.
+
+Run them with ``python manage.py test klaus`` in the test project.
+"""
+import os
+import re
+import shutil
+import tempfile
+
+from django.test import SimpleTestCase
+
+from klaus import cache, timing
+from klaus.blame import get_blame
+from klaus.codesearch import CodeIndex
+from klaus.messageindex import CommitQuery, MessageIndex, commit_matcher
+from klaus.pathindex import PathIndex
+from klaus.repo import FancyRepo
+from klaus.utils import check_output
+from klaus.views import parse_range_header
+
+
+#: Paths whose history is compared with `git log`, see `build_history`.
+PATHS = [None, 'a.txt', 'top.txt', 'dir', 'dir/b.txt', 'dir/c.txt',
+         'missing.txt']
+
+
+class GitRepoTestCase(SimpleTestCase):
+    """
+    Creates an empty repository in a temporary directory for each test.
+    Every Git command is run one minute after the previous one, so commits
+    are ordered by their time the same way in klaus and Git.
+    """
+    def setUp(self):
+        self.path = tempfile.mkdtemp(prefix='klaus-test-')
+        self.time = 1400000000
+        self.git('init', '-q')
+        self.git('symbolic-ref', 'HEAD', 'refs/heads/master')
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def git(self, *args, **kwargs):
+        self.time += 60
+        author = kwargs.pop('author', 'Alice')
+        env = dict(os.environ,
+                   GIT_AUTHOR_NAME=author,
+                   GIT_AUTHOR_EMAIL='%s@example.com' % author.lower(),
+                   GIT_AUTHOR_DATE='%d +0000' % self.time,
+                   GIT_COMMITTER_NAME=author,
+                   GIT_COMMITTER_EMAIL='%s@example.com' % author.lower(),
+                   GIT_COMMITTER_DATE='%d +0000' % self.time)
+        return check_output(['git'] + list(args), cwd=self.path, env=env)
+
+    def commit(self, message, files, author='Alice'):
+        """
+        Commits the changes in `files`, a dict path -> contents (None to
+        delete the file), and returns the SHA of the new commit.
+        """
+        for path, data in files.iteritems():
+            filename = os.path.join(self.path, path)
+            if data is None:
+                os.remove(filename)
+                continue
+            if not os.path.isdir(os.path.dirname(filename)):
+                os.makedirs(os.path.dirname(filename))
+            with open(filename, 'wb') as fileobj:
+                fileobj.write(data)
+        self.git('add', '-A')
+        self.git('commit', '-q', '-m', message, author=author)
+        return self.rev_parse('HEAD')
+
+    def merge(self, branch, message, *options):
+        self.git('merge', '-q', '--no-ff', '-m', message, branch, *options)
+        return self.rev_parse('HEAD')
+
+    def rev_parse(self, rev):
+        return self.git('rev-parse', rev).strip()
+
+    def git_log(self, rev, path=None):
+        args = ['log', '--format=%H', rev]
+        if path is not None:
+            args.extend(['--', path])
+        return self.git(*args).split()
+
+    def build_history(self, part=None):
+        """
+        Creates a history with branches and merges that touch the files and
+        directories in `PATHS`.  Pass `part` 1 or 2 to only create the first
+        or (after the first) the second half.
+        """
+        if part != 2:
+            self.commit('Initial commit', {'a.txt': 'a\n', 'top.txt': 'top\n',
+                                           'dir/b.txt': 'b\n'})
+            self.commit('Change a', {'a.txt': 'a2\n'})
+            self.git('checkout', '-q', '-b', 'feature')
+            self.commit('Change b, add c', {'dir/b.txt': 'b2\n',
+                                            'dir/c.txt': 'c\n'}, author='Bob')
+            self.git('checkout', '-q', 'master')
+            self.commit('Change top', {'top.txt': 'top2\n'})
+            self.git('checkout', '-q', 'feature')
+            self.commit('Change a on feature', {'a.txt': 'a3\n'},
+                        author='Bob')
+            self.git('checkout', '-q', 'master')
+            self.merge('feature', 'Merge feature')
+        if part != 1:
+            self.commit('Remove c', {'dir/c.txt': None})
+            self.git('checkout', '-q', '-b', 'side')
+            self.commit('Add side file', {'side.txt': 'side\n'}, author='Bob')
+            self.commit('Change a on side', {'a.txt': 'a4\n'}, author='Bob')
+            self.git('checkout', '-q', 'master')
+            self.commit('Change top again', {'top.txt': 'top3\n'})
+            # Keeps master's version of all files, so the change to a.txt on
+            # side is not part of its history.
+            self.merge('side', 'Merge side', '-s', 'ours')
+            self.commit('Bring back c', {'dir/c.txt': 'c2\n'})
+
+    def open_repo(self):
+        """
+        Returns a `FancyRepo` for the repository with up to date indexes, so
+        that requests don't queue updates in the background.
+        """
+        repo = FancyRepo(self.path)
+        repo.update_indexes()
+        return repo
+
+    def walk(self, repo, rev, path=None, path_index=None):
+        graph = repo.get_commit_graph()
+        return [graph.shas[pos] for pos
+                in graph.walk(self.rev_parse(rev), path, path_index)]
+
+
+class CommitGraphTest(GitRepoTestCase):
+    def test_walk(self):
+        self.build_history()
+        repo = FancyRepo(self.path)
+        for rev in ['master', 'feature', 'side']:
+            for path in PATHS:
+                self.assertEqual(self.walk(repo, rev, path),
+                                 self.git_log(rev, path), (rev, path))
+
+    def test_walk_with_path_index(self):
+        self.build_history()
+        repo = FancyRepo(self.path)
+        path_index = PathIndex(repo)
+        path_index.update(repo.get_commit_graph())
+        for path in PATHS:
+            self.assertEqual(self.walk(repo, 'master', path, path_index),
+                             self.git_log('master', path), path)
+
+    def test_walk_with_partial_path_index(self):
+        self.build_history(1)
+        repo = FancyRepo(self.path)
+        PathIndex(repo).update(repo.get_commit_graph())
+        self.build_history(2)
+        repo = FancyRepo(self.path)
+        path_index = PathIndex(repo)
+        self.assertTrue(0 < path_index.count < len(repo.get_commit_graph()))
+        for path in PATHS:
+            self.assertEqual(self.walk(repo, 'master', path, path_index),
+                             self.git_log('master', path), path)
+
+    def test_walk_unreachable_commit(self):
+        self.build_history()
+        repo = FancyRepo(self.path)
+        repo.get_commit_graph()
+        self.git('checkout', '-q', 'master~1')
+        sha = self.commit('Detached', {'a.txt': 'detached\n'})
+        self.assertEqual(self.walk(repo, sha, 'a.txt'),
+                         self.git_log(sha, 'a.txt'))
+
+
+class HistoryPaginationTest(GitRepoTestCase):
+    def test_cursor_matches_skip(self):
+        self.build_history()
+        repo = self.open_repo()
+        for path in PATHS:
+            expected = self.git_log('master', path)
+            pages = []
+            skip, cursor = 0, None
+            while True:
+                commits, cursor = repo.history_page('master', path, 2, skip,
+                                                    cursor)
+                pages.append([commit.id for commit in commits])
+                skip += len(commits)
+                if cursor is None:
+                    break
+            self.assertEqual(sum(pages, []), expected, path)
+
+            for i, page in enumerate(pages):
+                # With the cursor cached above, and then without
+                for _ in range(2):
+                    commits = repo.history('master', path, 2, i * 2)
+                    self.assertEqual([commit.id for commit in commits], page,
+                                     path)
+                    cache.get_klaus_cache().clear()
+
+    def test_query(self):
+        self.build_history()
+        repo = self.open_repo()
+        query = CommitQuery.from_strings(message='change', author='bob')
+        expected = self.git('log', '--format=%H', '-i', '--grep=change',
+                            '--author=bob', 'master').split()
+        commits, cursor = repo.history_page('master', max_commits=1,
+                                            query=query)
+        self.assertEqual([commit.id for commit in commits], expected[:1])
+        commits, cursor = repo.history_page('master', max_commits=10, skip=1,
+                                            cursor=cursor, query=query)
+        self.assertEqual([commit.id for commit in commits], expected[1:])
+        self.assertIsNone(cursor)
+
+
+class ParseRangeHeaderTest(SimpleTestCase):
+    def test_ranges(self):
+        self.assertEqual(parse_range_header('bytes=0-99', 1000), (0, 100))
+        self.assertEqual(parse_range_header('bytes=100-', 1000), (100, None))
+        self.assertEqual(parse_range_header('bytes=-100', 1000), (900, 1000))
+        self.assertEqual(parse_range_header('bytes=-2000', 1000), (0, 1000))
+        self.assertEqual(parse_range_header('bytes=990-1999', 1000),
+                         (990, 2000))
+        self.assertEqual(parse_range_header('bytes=2000-', 1000),
+                         (2000, None))
+
+    def test_ignored(self):
+        for header in [None, '', 'bytes=', 'bytes=-', 'bytes=abc-',
+                       'bytes=5', 'bytes=10-5', 'bytes=0-1,5-6',
+                       'items=0-99']:
+            self.assertIsNone(parse_range_header(header, 1000), header)
+
+
+class BlameTest(GitRepoTestCase):
+    def git_blame(self, sha, path):
+        output = self.git('blame', '--porcelain', sha, '--', path)
+        return re.findall(r'^([0-9a-f]{40}) ', output, re.MULTILINE)
+
+    def blame(self, repo, sha, path):
+        with timing.collect() as measurements:
+            blame = get_blame(repo, repo.get_commit(sha), path)
+        return ([blame.commits[index] for index in blame.lines],
+                measurements.counters.get('blame-steps', 0))
+
+    def test_incremental(self):
+        versions = [
+            self.commit('One', {'f.txt': '1\n2\n3\n4\n5\n'}),
+            self.commit('Two', {'f.txt': '1\n2\nthree\n4\n5\n'}),
+        ]
+        self.git('checkout', '-q', '-b', 'feature')
+        versions.append(self.commit('Three', {'f.txt':
+                                              '1\n2\nthree\n4\n5\n6\n'}))
+        self.git('checkout', '-q', 'master')
+        versions.append(self.commit('Four', {'f.txt':
+                                             'one\n2\nthree\n4\n5\n'}))
+        versions.append(self.merge('feature', 'Five'))
+        versions.append(self.commit('Six', {'other.txt': 'other\n'}))
+        versions.append(self.commit('Seven', {'f.txt':
+                                              'one\nthree\n4\n5\n6\n'}))
+        repo = self.open_repo()
+        cache.get_klaus_cache().clear()
+
+        for sha in versions:
+            lines, steps = self.blame(repo, sha, 'f.txt')
+            self.assertEqual(lines, self.git_blame(sha, 'f.txt'), sha)
+            # Only the new version is computed, the others are cached.
+            self.assertTrue(steps <= 1, sha)
+
+        cache.get_klaus_cache().clear()
+        lines, steps = self.blame(repo, versions[-1], 'f.txt')
+        self.assertEqual(lines, self.git_blame(versions[-1], 'f.txt'))
+        self.assertEqual(steps, len(versions) - 1)
+
+
+class IndexUpdateTest(GitRepoTestCase):
+    """
+    Checks that indexes updated after new commits are the same as those
+    built from scratch.
+    """
+    def build_indexes(self, cls):
+        self.build_history(1)
+        repo = FancyRepo(self.path)
+        cls(repo).update(repo.get_commit_graph())
+        self.build_history(2)
+        repo = FancyRepo(self.path)
+        graph = repo.get_commit_graph()
+        updated = cls(repo)
+        self.assertTrue(0 < updated.count < len(graph))
+        updated.update(graph)
+        os.remove(updated.path)
+        fresh = cls(repo)
+        self.assertEqual(fresh.count, 0)
+        fresh.update(graph)
+        return repo, graph, updated, fresh
+
+    def test_path_index(self):
+        _, graph, updated, fresh = self.build_indexes(PathIndex)
+        self.assertEqual(updated.count, len(graph))
+        self.assertEqual(_lists(updated.changes_by_path),
+                         _lists(fresh.changes_by_path))
+
+    def test_message_index(self):
+        repo, graph, updated, fresh = self.build_indexes(MessageIndex)
+        self.assertEqual(_lists(updated.messages), _lists(fresh.messages))
+        self.assertEqual(_lists(updated.authors), _lists(fresh.authors))
+        for query in [CommitQuery('change', None, None, None),
+                      CommitQuery('side', 'bob', None, None),
+                      CommitQuery(None, 'alice', None, None)]:
+            match = commit_matcher(repo, graph, query)
+            expected = [pos for pos in xrange(len(graph)) if match(pos)]
+            self.assertTrue(expected)
+            match = updated.matcher(graph, query)
+            self.assertEqual([pos for pos in xrange(len(graph)) if match(pos)],
+                             expected)
+
+    def test_code_index(self):
+        self.build_history(1)
+        self.commit('Add code', {'code/x.py': 'import os\n',
+                                 'code/y.py': 'import sys\n'})
+        repo = FancyRepo(self.path)
+        path = repo.cache_path(CodeIndex.FILENAME)
+        CodeIndex(path).update(repo)
+        self.build_history(2)
+        self.commit('Change code', {'code/x.py': 'import sys\n',
+                                    'code/y.py': None,
+                                    'code/z.py': 'import os.path\n'})
+        repo = FancyRepo(self.path)
+        updated = CodeIndex(path)
+        self.assertTrue(updated.update(repo))
+        fresh = CodeIndex(repo.cache_path('fresh-code-index'))
+        fresh.update(repo)
+        self.assertEqual(updated.commit, self.rev_parse('master'))
+        for query in ['import os', 'import sys', 'top3', 'c2\n', 'a3\n']:
+            self.assertEqual(updated.candidates(query),
+                             fresh.candidates(query), query)
+        self.assertEqual([path for path, _ in updated.candidates('import os')],
+                         ['code/z.py'])
+        self.assertEqual([path for path, _ in updated.candidates('import')],
+                         ['code/x.py', 'code/z.py'])
+
+
+def _lists(postings):
+    return dict((key, list(values)) for key, values in postings.iteritems())
@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+"""
+Timings and counters of the expensive parts of handling a request (reading
+objects, diffing trees, highlighting, rendering templates, ...).
+
+Code measures the time spent in an operation with `timed` and counts things
+with `count`::
+
+    with timing.timed('highlight'):
+        ...
+    timing.count('objects')
+
+Measurements go to the `Measurements` of the request handled by the current
+thread (see `collect`) and are ignored outside of requests.  At the end of a
+request, they are sent in a ``Server-Timing`` header (unless
+`KLAUS_SERVER_TIMING` is False) and passed to the metrics sink: the object
+named by the dotted path `KLAUS_METRICS_SINK`, which must have a
+``record(view_name, measurements)`` method.  The default sink is `aggregator`,
+a `LocalAggregator` that keeps totals in memory.
+"""
+import contextlib
+import threading
+import time
+from collections import defaultdict
+
+from django.conf import settings
+
+try:
+    from importlib import import_module
+except ImportError:
+    # Python 2.6
+    from django.utils.importlib import import_module
+
+_local = threading.local()
+
+
+class Measurements(object):
+    """ The timings and counters of a request. """
+    def __init__(self):
+        self.timings = {}           # name -> [seconds, calls]
+        self.counters = {}          # name -> count
+
+    def add_time(self, name, seconds):
+        timing = self.timings.get(name)
+        if timing is None:
+            self.timings[name] = [seconds, 1]
+        else:
+            timing[0] += seconds
+            timing[1] += 1
+
+    def add(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def server_timing(self):
+        """ Returns the value of the ``Server-Timing`` header. """
+        metrics = ['%s;dur=%.1f' % (name, seconds * 1000)
+                   for name, (seconds, _) in sorted(self.timings.iteritems())]
+        metrics.extend('%s;desc="%d"' % (name, n)
+                       for name, n in sorted(self.counters.iteritems()))
+        return ', '.join(metrics)
+
+
+class LocalAggregator(object):
+    """
+    A metrics sink that sums up the measurements of all requests, per view,
+    in memory.  `render` returns them in Prometheus' text format.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        with self._lock:
+            self.requests = defaultdict(int)        # view -> requests
+            self.seconds = defaultdict(float)       # (view, name) -> seconds
+            self.calls = defaultdict(int)           # (view, name) -> calls
+            self.max_seconds = defaultdict(float)   # (view, name) -> seconds
+            self.counters = defaultdict(int)        # (view, name) -> count
+
+    def record(self, view_name, measurements):
+        with self._lock:
+            self.requests[view_name] += 1
+            for name, (seconds, calls) in measurements.timings.iteritems():
+                key = (view_name, name)
+                self.seconds[key] += seconds
+                self.calls[key] += calls
+                self.max_seconds[key] = max(self.max_seconds[key], seconds)
+            for name, n in measurements.counters.iteritems():
+                self.counters[(view_name, name)] += n
+
+    def render(self):
+        with self._lock:
+            lines = []
+            for metric, values in [
+                    ('klaus_requests_total', self.requests),
+                    ('klaus_seconds_total', self.seconds),
+                    ('klaus_calls_total', self.calls),
+                    ('klaus_max_seconds', self.max_seconds),
+                    ('klaus_count_total', self.counters)]:
+                lines.append('# TYPE %s %s' % (
+                    metric, 'gauge' if metric.endswith('max_seconds')
+                    else 'counter'))
+                for key, value in sorted(values.iteritems()):
+                    if isinstance(key, tuple):
+                        labels = 'view="%s",name="%s"' % key
+                    else:
+                        labels = 'view="%s"' % key
+                    lines.append('%s{%s} %s' % (metric, labels, value))
+            return '\n'.join(lines) + '\n'
+
+
+#: The default metrics sink.
+aggregator = LocalAggregator()
+
+
+def get_sink():
+    """ Returns the metrics sink named by `KLAUS_METRICS_SINK`. """
+    path = getattr(settings, 'KLAUS_METRICS_SINK', 'klaus.timing.aggregator')
+    module, _, name = path.rpartition('.')
+    return getattr(import_module(module), name)
+
+
+@contextlib.contextmanager
+def collect(measurements=None):
+    """
+    Collects the measurements of the code run by the current thread in the
+    `with` block into `measurements` (a new `Measurements` by default), which
+    is returned.
+    """
+    previous = getattr(_local, 'measurements', None)
+    if measurements is None:
+        measurements = Measurements()
+    _local.measurements = measurements
+    try:
+        yield measurements
+    finally:
+        _local.measurements = previous
+
+
+def collect_iter(iterable, measurements, done):
+    """
+    Yields the items of `iterable`, collecting the measurements of the code
+    that produces them into `measurements`, then calls `done()`.  For
+    responses that are generated while they are sent.
+    """
+    iterator = iter(iterable)
+    try:
+        while True:
+            with collect(measurements):
+                with timed('stream'):
+                    try:
+                        item = next(iterator)
+                    except StopIteration:
+                        break
+            yield item
+    finally:
+        done()
+
+
+class timed(object):
+    """ Context manager that adds the time spent in it to timing `name`. """
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.measurements = getattr(_local, 'measurements', None)
+        if self.measurements is not None:
+            self.start = time.time()
+
+    def __exit__(self, *exc_info):
+        if self.measurements is not None:
+            self.measurements.add_time(self.name, time.time() - self.start)
+
+
+def count(name, n=1):
+    """ Adds `n` to counter `name`. """
+    measurements = getattr(_local, 'measurements', None)
+    if measurements is not None:
+        measurements.add(name, n)
@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+"""
+Background threads that build and update indexes, so that requests don't have
+to wait for them.
+"""
+import Queue
+import threading
+
+
+class IndexUpdater(threading.Thread):
+    """
+    Runs the functions passed to `schedule`, one after another.  The thread is
+    started on the first call to `schedule`.
+    """
+    daemon = True
+
+    def __init__(self, name):
+        super(IndexUpdater, self).__init__(name=name)
+        self.queue = Queue.Queue()
+        self.pending = set()
+        self.lock = threading.Lock()
+
+    def schedule(self, key, func, *args):
+        """
+        Queues the call `func(*args)`, unless a call with the same `key` is
+        queued already.
+        """
+        with self.lock:
+            if self.ident is None:
+                self.start()
+            if key in self.pending:
+                return
+            self.pending.add(key)
+        self.queue.put((key, func, args))
+
+    def run(self):
+        while True:
+            key, func, args = self.queue.get()
+            with self.lock:
+                self.pending.discard(key)
+            try:
+                func(*args)
+            except Exception:
+                # Removed or broken repos; keep going.
+                pass
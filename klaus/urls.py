@@ -8,6 +8,8 @@ from klaus import views
 repo = r'(?P<repo>[\w\.\-_]+)'
 rev = r'(?P<rev>[\w\.\-_]+)'
 path = r'(?P<path>.+)'
+filename = r'(?P<filename>.+)'
+archive_format = r'(?P<format>tar\.gz|zip)'
 
 
 urlpatterns = patterns(
@@ -15,10 +17,17 @@ urlpatterns = patterns(
 
     url(r'^$',
         views.repo_list, name=views.RepoListView.view_name),
+    url(r'^-/search/$',
+        views.search, name=views.SearchView.view_name),
+    url(r'^-/metrics/$',
+        views.metrics, name='metrics'),
 
     url(r'^' + repo + '/$',
         views.history, name=views.HistoryView.view_name),
 
+    url(r'^' + repo + '/search/$',
+        views.search, name=views.SearchView.view_name),
+
     url(r'^' + repo + '/tree/' + rev + '/$',
         views.history, name=views.HistoryView.view_name),
     url(r'^' + repo + '/tree/' + rev + '/' + path + '/$',
@@ -29,11 +38,29 @@ urlpatterns = patterns(
     url(r'^' + repo + '/blob/' + rev + '/' + path + '/$',
         views.blob, name=views.BlobView.view_name),
 
+    url(r'^' + repo + '/blame/' + rev + '/' + path + '/$',
+        views.blame, name=views.BlameView.view_name),
+
     url(r'^' + repo + '/raw/' + rev + '/$',
         views.raw, name=views.RawView.view_name),
     url(r'^' + repo + '/raw/' + rev + '/' + path + '/$',
         views.raw, name=views.RawView.view_name),
 
     url(r'^' + repo + '/commit/' + rev + '/$',
-        views.commit, name=views.CommitView.view_name)
+        views.commit, name=views.CommitView.view_name),
+    url(r'^' + repo + '/commit/' + rev + '/file/' + filename + '/$',
+        views.commit_file, name=views.CommitFileView.view_name),
+
+    url(r'^' + repo + '/archive/' + rev + r'\.' + archive_format + '$',
+        views.archive, name=views.ArchiveView.view_name),
+
+    url(r'^' + repo + '/info/refs$',
+        views.info_refs, name=views.InfoRefsView.view_name),
+    url(r'^' + repo + '/git-upload-pack$',
+        views.upload_pack, name=views.UploadPackView.view_name),
+
+    url(r'^' + repo + '/refs/' + rev + '/$',
+        views.refs, name=views.RefListView.view_name),
+    url(r'^' + repo + '/refs/' + rev + '/' + path + '/$',
+        views.refs, name=views.RefListView.view_name),
 )
@@ -3,22 +3,31 @@ import os
 import re
 import mimetypes
 import locale
+import tempfile
+import copy
 try:
     import chardet
 except ImportError:
     chardet = None
 
+import pygments
 from pygments import highlight
-from pygments.lexers import get_lexer_for_filename, guess_lexer, ClassNotFound
 from pygments.formatters import HtmlFormatter
+from pygments.lexers import TextLexer
 
-from klaus import markup
+from klaus import markup, cache, renderpool, timing
+from klaus.lexers import get_lexer
+from klaus.renderpool import RenderTimeout
+from klaus.objects import PROBE_SIZE
 
 
 class KlausFormatter(HtmlFormatter):
-    def __init__(self):
+    #: Part of the render cache key; increase on changes to the HTML output.
+    version = 1
+
+    def __init__(self, **options):
         HtmlFormatter.__init__(self, linenos='table', lineanchors='L',
-                               anchorlinenos=True)
+                               anchorlinenos=True, **options)
 
     def _format_lines(self, tokensource):
         for tag, line in HtmlFormatter._format_lines(self, tokensource):
@@ -28,24 +37,90 @@ class KlausFormatter(HtmlFormatter):
             yield tag, line
 
 
-def pygmentize(code, filename=None, render_markup=True):
+_formatter = KlausFormatter()
+
+
+def get_formatter(linenostart=1):
+    """
+    Returns a `KlausFormatter`.  Formatters are shared, since setting one up
+    (which includes parsing the Pygments style) is not cheap.
+    """
+    if linenostart == 1:
+        return _formatter
+    formatter = copy.copy(_formatter)
+    formatter.linenostart = linenostart
+    return formatter
+
+
+def pygmentize(code, filename=None, render_markup=True, sha=None):
     """
     Renders code using Pygments, markup (markdown, rst, ...) using the
-    corresponding renderer, if available.
+    corresponding renderer, if available.  `sha` is the blob's SHA, if known
+    (see `klaus.lexers.get_lexer`).
+
+    Rendering happens in `klaus.renderpool`; if it takes too long, the code is
+    shown as plain text.
     """
+    try:
+        return _pygmentize(code, filename, render_markup, sha)
+    except RenderTimeout:
+        return pygmentize_plain(code)
+
+
+def _pygmentize(code, filename, render_markup, sha):
+    key = ('pygmentize', sha, filename, render_markup) if sha else None
     if render_markup and markup.can_render(filename):
-        return markup.render(filename, code)
+        with timing.timed('markup'):
+            return renderpool.run(markup.render, (filename, code), key)
 
-    try:
-        lexer = get_lexer_for_filename(filename)
-    except ClassNotFound:
-        lexer = guess_lexer(code)
+    # Lexers are set up on first use, so pass the lexer's class to the pool.
+    with timing.timed('lexer'):
+        lexer = get_lexer(filename, code, sha)
+    with timing.timed('highlight'):
+        return renderpool.run(_highlight, (code, type(lexer), lexer.options),
+                              key)
+
+
+def _highlight(code, lexer_class, options):
+    return highlight(code, lexer_class(**options), get_formatter())
 
-    return highlight(code, lexer, KlausFormatter())
+
+def pygmentize_plain(code, linenostart=1, **options):
+    """ Renders code like `pygmentize`, but without any highlighting. """
+    return highlight(code, TextLexer(**options), get_formatter(linenostart))
+
+
+def pygmentize_blob(blob, filename=None, render_markup=True):
+    """
+    Like `pygmentize`, but takes a Dulwich blob. Results are cached per blob
+    SHA, so repeated views of a blob skip decoding and highlighting entirely.
+    """
+    key = cache.make_key('pygmentize', blob.id, filename, render_markup,
+                         KlausFormatter.version, pygments.__version__)
+    try:
+        return cache.get_or_create(
+            key,
+            lambda: _pygmentize(force_unicode(blob.data), filename,
+                                render_markup, blob.id)
+        )
+    except RenderTimeout:
+        # Not cached, so that it is retried later.
+        return pygmentize_plain(force_unicode(blob.data))
 
 
 def guess_is_binary(dulwich_blob):
-    return any('\0' in chunk for chunk in dulwich_blob.chunked)
+    """
+    Like Git, considers blobs with a NUL byte in their first `PROBE_SIZE`
+    bytes binary.
+    """
+    remaining = PROBE_SIZE
+    for chunk in dulwich_blob.chunked:
+        if '\0' in chunk[:remaining]:
+            return True
+        remaining -= len(chunk)
+        if remaining <= 0:
+            break
+    return False
 
 
 def guess_is_image(filename):
@@ -96,6 +171,41 @@ def extract_author_name(email):
     return email
 
 
+def atomic_write(path, data):
+    """
+    Writes `data` to `path` (creating parent directories if neccessary) such
+    that concurrent readers see either the old or the new file contents.
+    """
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        try:
+            os.makedirs(directory)
+        except OSError:
+            # Somebody else was faster.
+            pass
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.tmp-')
+    try:
+        with os.fdopen(fd, 'wb') as fileobj:
+            fileobj.write(data)
+        os.chmod(tmp_path, 0o644)
+        os.rename(tmp_path, path)
+    except:
+        os.unlink(tmp_path)
+        raise
+
+
+def save_cache_file(path, data):
+    """
+    Writes `data` to `path` like `atomic_write`, but ignores errors: cache
+    files only save work, and there may be nowhere to write them (e.g. if the
+    repo is read-only for klaus).
+    """
+    try:
+        atomic_write(path, data)
+    except (IOError, OSError):
+        pass
+
+
 def parent_directory(path):
     return os.path.split(path)[0]
 
@@ -113,6 +223,11 @@ def subpaths(path):
         yield part, '/'.join(seen)
 
 
+def trigrams(data):
+    """ Returns the set of all substrings of three bytes of `data`. """
+    return set(data[i:i + 3] for i in xrange(len(data) - 2))
+
+
 try:
     from subprocess import check_output
 except ImportError:
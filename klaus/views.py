@@ -1,17 +1,32 @@
 # -*- coding: utf-8 -*-
+import hashlib
+import mimetypes
 import os
 import stat
+import zlib
 
 from django.conf import settings
-from django.http import HttpResponse
-from django.views.generic import TemplateView
+from django.core.urlresolvers import reverse
+from django.http import Http404, HttpResponse, HttpResponseBadRequest, \
+    HttpResponseForbidden, HttpResponseNotModified, StreamingHttpResponse
+from django.utils.cache import add_never_cache_headers, patch_cache_control
+from django.utils.http import parse_etags, quote_etag, urlencode
+from django.template import Context, loader
+from django.utils.safestring import mark_safe
+from django.views.decorators.csrf import csrf_exempt
+from django.views.generic import TemplateView, View
 
 from dulwich.objects import Blob
 
-from klaus import markup, utils
-from klaus.utils import parent_directory, subpaths, pygmentize, \
-    force_unicode, guess_is_binary, guess_is_image
-from klaus.repo import RepoManager, RepoException
+from klaus import archives, codesearch, filecache, markup, smarthttp, \
+    timing, utils
+from klaus.utils import parent_directory, subpaths, pygmentize_blob, \
+    guess_is_binary, guess_is_image, force_unicode
+from klaus.repo import FancyCommit, RepoManager, RepoException
+from klaus.blame import split_lines
+from klaus.messageindex import CommitQuery
+from klaus.objects import open_object
+from klaus.windowing import BlobWindow
 
 
 class KlausContextMixin(object):
@@ -23,10 +38,53 @@ class KlausContextMixin(object):
         return context
 
 
-class KlausTemplateView(KlausContextMixin, TemplateView):
+class TimingMixin(object):
+    """
+    Collects the `klaus.timing` measurements of each request, sends them in a
+    ``Server-Timing`` header and passes them to the metrics sink.
+    """
+    @classmethod
+    def as_view(cls, **initkwargs):
+        view = super(TimingMixin, cls).as_view(**initkwargs)
+
+        def timed_view(request, *args, **kwargs):
+            with timing.collect() as measurements:
+                with timing.timed('total'):
+                    response = view(request, *args, **kwargs)
+                    if not getattr(response, 'is_rendered', True):
+                        with timing.timed('template'):
+                            response.render()
+            if getattr(settings, 'KLAUS_SERVER_TIMING', True):
+                response['Server-Timing'] = measurements.server_timing()
+
+            def done():
+                timing.get_sink().record(cls.view_name, measurements)
+            if response.streaming:
+                # The rest is measured while the response is sent.
+                response.streaming_content = timing.collect_iter(
+                    response.streaming_content, measurements, done)
+            else:
+                done()
+            return response
+        return timed_view
+
+
+class KlausTemplateView(TimingMixin, KlausContextMixin, TemplateView):
     pass
 
 
+class MetricsView(View):
+    """
+    Shows the totals of `klaus.timing.aggregator` in Prometheus' text format,
+    to clients in `INTERNAL_IPS` only.
+    """
+    def get(self, request):
+        if request.META.get('REMOTE_ADDR') not in settings.INTERNAL_IPS:
+            raise Http404()
+        return HttpResponse(timing.aggregator.render(),
+                            content_type='text/plain; version=0.0.4')
+
+
 class RepoListView(KlausTemplateView):
     """Shows a list of all repos and can be sorted by last update. """
 
@@ -36,15 +94,54 @@ class RepoListView(KlausTemplateView):
     def get_context_data(self, **ctx):
         context = super(RepoListView, self).get_context_data(**ctx)
 
+        repos = [RepoManager.get_metadata(name)
+                 for name in RepoManager.repo_names()]
         if 'by-last-update' in self.request.GET:
-            sort_key = lambda repo: repo.get_last_updated_at()
-            reverse = True
+            repos.sort(key=lambda repo: repo.last_updated_at, reverse=True)
+
+        context['repos'] = repos
+        return context
+
+
+class SearchView(KlausTemplateView):
+    """
+    Searches the default branches of all repos, or of repo `repo`, for the
+    string `q` (see `klaus.codesearch`).
+    """
+
+    template_name = 'klaus/search.html'
+    view_name = 'search'
+
+    def get_context_data(self, **ctx):
+        context = super(SearchView, self).get_context_data(**ctx)
+
+        query = self.request.GET.get('q', '')
+        repo = self.kwargs.get('repo')
+        if repo is not None:
+            repo_names = [repo]
         else:
-            sort_key = lambda repo: repo.name
-            reverse = False
+            repo_names = RepoManager.repo_names()
+
+        too_short = len(query.strip()) < codesearch.MIN_QUERY_LENGTH
+        results = []
+        unindexed = []
+        if not too_short:
+            max_lines = getattr(settings, 'KLAUS_SEARCH_MAX_RESULTS', 100)
+            results, unindexed = codesearch.search(repo_names, query,
+                                                   max_lines + 1)
+            if sum(len(result['lines']) for result in results) > max_lines:
+                context['more_results'] = True
+                results[-1]['lines'].pop()
+                if not results[-1]['lines']:
+                    results.pop()
 
-        context['repos'] = sorted(RepoManager.all_repos(), key=sort_key,
-                                  reverse=reverse)
+        context.update({
+            'repo_name': repo,
+            'query': query,
+            'too_short': too_short and bool(query),
+            'results': results,
+            'unindexed': unindexed,
+        })
         return context
 
 
@@ -65,18 +162,87 @@ class BaseRepoView(KlausTemplateView):
     view_name = None
     "required by templates"
 
+    _repo_context = None
+
+    def dispatch(self, request, *args, **kwargs):
+        """
+        Answers conditional requests (`If-None-Match`) before doing any
+        expensive work and adds `ETag` and `Cache-Control` headers.
+
+        Pages addressed by a full commit SHA never change and may be cached
+        for `KLAUS_IMMUTABLE_MAX_AGE` seconds; all other pages (branches, tags)
+        for `KLAUS_REF_MAX_AGE` seconds.
+        """
+        repo_context = self.get_repo_context()
+        etag = self.get_etag(repo_context)
+        if repo_context['commit'].id == repo_context['rev']:
+            max_age = getattr(settings, 'KLAUS_IMMUTABLE_MAX_AGE',
+                              365 * 24 * 60 * 60)
+        else:
+            max_age = getattr(settings, 'KLAUS_REF_MAX_AGE', 60)
+
+        if etag in parse_etags(request.META.get('HTTP_IF_NONE_MATCH', '')):
+            response = HttpResponseNotModified()
+        else:
+            response = super(BaseRepoView, self).dispatch(
+                request, *args, **kwargs)
+        if response.status_code in (200, 206, 304):
+            response['ETag'] = quote_etag(etag)
+            patch_cache_control(response, public=True, max_age=max_age)
+        return response
+
+    def get_etag(self, repo_context):
+        """
+        Returns a strong ETag for the response, derived from the SHAs of the
+        objects displayed.  Pages of branches and tags also show the repo's
+        other refs, so their ETag changes whenever any ref changes.
+        """
+        parts = [utils.KLAUS_VERSION, self.view_name,
+                 repo_context['commit'].id, repo_context['blob_or_tree'].id,
+                 repo_context['path'], self.request.GET.urlencode()]
+        if repo_context['commit'].id != repo_context['rev']:
+            parts.append(RepoManager.get_state(repo_context['repo'].name))
+        return hashlib.sha1(repr(parts)).hexdigest()
+
     def get_context_data(self, **ctx):
         context = super(BaseRepoView, self).get_context_data(**ctx)
+        context.update(self.get_repo_context())
+
+        repo, rev, path = context['repo'], context['rev'], context['path']
+        # The branch/tag selector only shows the newest refs; all refs can be
+        # loaded from `RefListView` on demand.
+        limit = getattr(settings, 'KLAUS_REF_SELECTOR_LIMIT', 30)
+        branches = repo.get_branch_names(exclude=rev)
+        tags = repo.get_tag_names()
+        context.update({
+            'branches': branches[:limit],
+            'more_branches': len(branches) > limit,
+            'tags': tags[:limit],
+            'more_tags': len(tags) > limit,
+            'subpaths': list(subpaths(path)) if path else None,
+        })
+
+        return context
+
+    def get_repo_context(self):
+        """
+        Resolves the `repo`, `rev` and `path` arguments to repository, commit
+        and blob/tree objects.
+        """
+        if self._repo_context is None:
+            self._repo_context = self._resolve_repo_context()
+        return self._repo_context
 
+    def _resolve_repo_context(self):
         repo = RepoManager.get_repo(self.kwargs['repo'])
         rev = self.kwargs.get('rev')
         path = self.kwargs.get('path')
         if isinstance(path, unicode):
             path = path.encode("utf-8")
-	if isinstance(rev, unicode):
+        if isinstance(rev, unicode):
             rev = rev.encode("utf-8")
-        
-	if rev is None:
+
+        if rev is None:
             rev = repo.get_default_branch()
             if rev is None:
                 raise RepoException("Empty repository")
@@ -90,19 +256,14 @@ class BaseRepoView(KlausTemplateView):
         except KeyError:
             raise RepoException("File not found")
 
-        context.update({
+        return {
             'view': self.view_name,
             'repo': repo,
             'rev': rev,
             'commit': commit,
-            'branches': repo.get_branch_names(exclude=rev),
-            'tags': repo.get_tag_names(),
             'path': path,
             'blob_or_tree': blob_or_tree,
-            'subpaths': list(subpaths(path)) if path else None,
-        })
-
-        return context
+        }
 
 
 class TreeViewMixin(object):
@@ -155,15 +316,32 @@ class HistoryView(TreeViewMixin, BaseRepoView):
     """
     Show commits of a branch + path, just like `git log`. With
     pagination.
+
+    Links to the next page carry a cursor (see `FancyRepo.history_page`) to
+    continue the history walk from, so deep pages don't walk all commits
+    before them.  Plain page numbers work too.
+
+    Commits can be filtered by message (`q`), author and date range (`since`,
+    `until`), see `klaus.messageindex`.
     """
 
     template_name = 'klaus/history.html'
     view_name = 'history'
 
+    #: Longer cursors are left out of the links; pages are then found by
+    #: page number (using a cached cursor, if possible).
+    max_cursor_length = 10
+
+    filter_params = ['q', 'author', 'since', 'until']
+
     def get_context_data(self, **ctx):
         context = super(HistoryView, self).get_context_data(**ctx)
 
-        page = context['page'] = int(self.request.GET.get('page', 0))
+        try:
+            page = max(int(self.request.GET.get('page', 0)), 0)
+        except ValueError:
+            page = 0
+        context['page'] = page
 
         if page:
             history_length = 30
@@ -176,27 +354,59 @@ class HistoryView(TreeViewMixin, BaseRepoView):
             history_length = 10
             skip = 0
 
-        history = context['repo'].history(
+        filter_params = dict(
+            (name, self.request.GET.get(name, '').strip())
+            for name in self.filter_params)
+        query = CommitQuery.from_strings(
+            filter_params['q'], filter_params['author'],
+            filter_params['since'], filter_params['until'])
+
+        history, next_cursor = context['repo'].history_page(
             context['rev'],
             context['path'],
-            history_length + 1,
-            skip
+            history_length,
+            skip,
+            parse_cursor(self.request.GET.get('cursor')) if page else None,
+            query,
         )
-        if len(history) == history_length + 1:
-            # At least one more commit for next page left
-            more_commits = True
-            # We don't want show the additional commit on this page
-            history.pop()
-        else:
-            more_commits = False
+        if next_cursor is not None and \
+           len(next_cursor) <= self.max_cursor_length:
+            context['next_cursor'] = '.'.join(next_cursor)
 
         context.update({
             'history': history,
-            'more_commits': more_commits,
+            'more_commits': next_cursor is not None,
+            'filter': filter_params,
+            'clone_url': self.get_clone_url(context['repo']),
+            # Appended to the pagination links
+            'filter_query': ''.join(
+                '&%s' % urlencode({name: value}) for name, value
+                in sorted(filter_params.iteritems()) if value),
         })
 
         return context
 
+    def get_clone_url(self, repo):
+        """ Returns the URL for Git smart HTTP, or None if it's disabled. """
+        if not getattr(settings, 'KLAUS_SMART_HTTP', True):
+            return None
+        return self.request.build_absolute_uri(
+            reverse('klaus:history', kwargs={'repo': repo.name}))
+
+
+def parse_cursor(cursor):
+    """
+    Returns the SHAs in `cursor`, a history cursor as put into URLs by
+    `HistoryView`, or None if it is missing or malformed.
+    """
+    if not cursor:
+        return None
+    shas = cursor.encode('ascii', 'replace').split('.')
+    if all(len(sha) == 40 and not sha.strip('0123456789abcdef')
+           for sha in shas):
+        return tuple(shas)
+    return None
+
 
 class BlobViewMixin(object):
     def get_context_data(self, **ctx):
@@ -206,7 +416,13 @@ class BlobViewMixin(object):
 
 
 class BlobView(BlobViewMixin, TreeViewMixin, BaseRepoView):
-    """ Shows a file rendered using ``pygmentize`` """
+    """
+    Shows a file rendered using ``pygmentize``.
+
+    Files larger than `KLAUS_BLOB_RENDER_LIMIT` bytes are shown in windows of
+    `KLAUS_BLOB_WINDOW_LINES` lines (see `klaus.windowing`), files larger than
+    `KLAUS_BLOB_MAX_SIZE` bytes are not shown at all.
+    """
 
     template_name = 'klaus/view_blob.html'
     view_name = 'blob'
@@ -217,8 +433,20 @@ class BlobView(BlobViewMixin, TreeViewMixin, BaseRepoView):
         if not isinstance(context['blob_or_tree'], Blob):
             raise RepoException("Not a blob")
 
-        binary = guess_is_binary(context['blob_or_tree'])
-        too_large = sum(map(len, context['blob_or_tree'].chunked)) > 100 * 1024
+        # Decide from the blob's header and first few bytes; only blobs that
+        # are actually rendered are read completely.
+        info = context['blob_or_tree'].info
+        too_large = info.size > getattr(settings, 'KLAUS_BLOB_MAX_SIZE',
+                                        20 * 1024 * 1024)
+        windowed = info.size > getattr(settings, 'KLAUS_BLOB_RENDER_LIMIT',
+                                       100 * 1024)
+        binary = info.is_binary
+        if binary is None:
+            if too_large:
+                # Too large to look at; trust the file extension.
+                binary = guess_is_image(context['filename'])
+            else:
+                binary = guess_is_binary(context['blob_or_tree'])
 
         if binary:
             context.update({
@@ -236,10 +464,25 @@ class BlobView(BlobViewMixin, TreeViewMixin, BaseRepoView):
                 'is_markup': False,
                 'is_binary': False,
             })
+        elif windowed:
+            try:
+                start = int(self.request.GET.get('start', 1))
+            except ValueError:
+                start = 1
+            window = BlobWindow(
+                context['blob_or_tree'], context['filename'], start,
+                getattr(settings, 'KLAUS_BLOB_WINDOW_LINES', 500))
+            context.update({
+                'too_large': False,
+                'is_markup': False,
+                'window': window,
+                'rendered_code': window.render(),
+                'is_binary': False,
+            })
         else:
             render_markup = 'markup' not in self.request.GET
-            rendered_code = pygmentize(
-                force_unicode(context['blob_or_tree'].data),
+            rendered_code = pygmentize_blob(
+                context['blob_or_tree'],
                 context['filename'],
                 render_markup
             )
@@ -254,25 +497,413 @@ class BlobView(BlobViewMixin, TreeViewMixin, BaseRepoView):
         return context
 
 
-class RawView(BlobViewMixin, BaseRepoView):
+class BlameView(BlobViewMixin, TreeViewMixin, BaseRepoView):
+    """
+    Shows the commit that last changed each line of a file (see
+    `klaus.blame`), in windows of `KLAUS_BLOB_WINDOW_LINES` lines.  Like
+    `BlobView`, doesn't show binary files and files larger than
+    `KLAUS_BLOB_MAX_SIZE` bytes.
+    """
+
+    template_name = 'klaus/blame.html'
+    view_name = 'blame'
+
+    def get_context_data(self, **ctx):
+        context = super(BlameView, self).get_context_data(**ctx)
+
+        repo, blob = context['repo'], context['blob_or_tree']
+        if not isinstance(blob, Blob):
+            raise RepoException("Not a blob")
+
+        info = blob.info
+        too_large = info.size > getattr(settings, 'KLAUS_BLOB_MAX_SIZE',
+                                        20 * 1024 * 1024)
+        binary = info.is_binary
+        if binary is None:
+            binary = not too_large and guess_is_binary(blob)
+        context.update({'too_large': too_large, 'is_binary': binary})
+        if too_large or binary:
+            return context
+
+        file_blame = repo.get_blame(context['commit'], context['path'])
+        lines = split_lines(blob.data)
+        window_lines = getattr(settings, 'KLAUS_BLOB_WINDOW_LINES', 500)
+        try:
+            start = int(self.request.GET.get('start', 1))
+        except ValueError:
+            start = 1
+        # Align windows like `BlobWindow` does.
+        start = min(max(start, 1), max(len(lines), 1))
+        start = (start - 1) // window_lines * window_lines + 1
+        stop = min(start + window_lines - 1, len(lines))
+        if len(lines) > window_lines:
+            context['window'] = {
+                'start': start,
+                'stop': stop,
+                'line_count': len(lines),
+                'previous_start': start - window_lines if start > 1 else None,
+                'next_start': stop + 1 if stop < len(lines) else None,
+                'last_start': (len(lines) - 1) // window_lines *
+                window_lines + 1,
+            }
+
+        commits = {}
+        runs = []
+        for sha, run_start, run_stop in file_blame.runs(start - 1, stop):
+            if sha not in commits:
+                commits[sha] = FancyCommit(repo[sha], repo)
+            runs.append({
+                'commit': commits[sha],
+                'lines': [(i + 1, force_unicode(lines[i]))
+                          for i in xrange(run_start, run_stop)],
+            })
+        context['runs'] = runs
+        return context
+
+
+class RawView(BaseRepoView):
     """
     Shows a single file in raw for (as if it were a normal filesystem file
     served through a static file server)
+
+    The file is streamed from the object store and single byte ranges are
+    supported, so downloads of large files can be resumed.
     """
     view_name = 'raw'
 
-    def dispatch(self, *args, **kwargs):
-        context = self.get_context_data()
-        return HttpResponse(context['blob_or_tree'].chunked)
+    #: Types that browsers would execute as active content on our domain.
+    unsafe_content_types = ['text/html', 'application/xhtml+xml',
+                            'image/svg+xml']
+
+    def get(self, request, *args, **kwargs):
+        context = self.get_repo_context()
+        blob = context['blob_or_tree']
+        if not isinstance(blob, Blob):
+            raise RepoException("Not a blob")
+
+        stream = open_object(context['repo'].object_store, blob.id)
+        byte_range = parse_range_header(
+            self.request.META.get('HTTP_RANGE'), stream.size)
+        if byte_range is None:
+            response = StreamingHttpResponse(stream.chunks)
+            response['Content-Length'] = stream.size
+        elif byte_range[0] >= stream.size:
+            stream.close()
+            response = HttpResponse(status=416, content_type='text/plain')
+            response['Content-Range'] = 'bytes */%d' % stream.size
+            return response
+        else:
+            start, stop = byte_range
+            if stop is None or stop > stream.size:
+                stop = stream.size
+            response = StreamingHttpResponse(stream.iter_range(start, stop),
+                                             status=206)
+            response['Content-Length'] = stop - start
+            response['Content-Range'] = 'bytes %d-%d/%d' % (
+                start, stop - 1, stream.size)
+
+        response['Content-Type'] = self.get_content_type(
+            os.path.basename(context['path']))
+        response['Accept-Ranges'] = 'bytes'
+        return response
+
+    def get_content_type(self, filename):
+        content_type, encoding = mimetypes.guess_type(filename)
+        if content_type is None or encoding is not None:
+            return 'application/octet-stream'
+        if content_type in self.unsafe_content_types:
+            return 'text/plain'
+        return content_type
+
+
+class ArchiveView(BaseRepoView):
+    """
+    Sends a tar.gz or zip archive of the tree of a commit (see
+    `klaus.archives`), named and prefixed ``<repo>-<rev>``.  Cached archives
+    are sent with `send_file`.
+    """
+    view_name = 'archive'
+
+    def get(self, request, *args, **kwargs):
+        context = self.get_repo_context()
+        repo, commit = context['repo'], context['commit']
+        format = self.kwargs['format']
+        name = '%s-%s' % (repo.name, context['rev'])
+        prefix = name + '/'
+
+        cache_path = archives.get_cache_path(repo, commit, format, prefix)
+        fileobj = cache_path and filecache.open_cached(cache_path)
+        if fileobj is not None:
+            response = send_file(request, fileobj, cache_path)
+        else:
+            chunks = archives.generate(repo, commit, format, prefix)
+            if cache_path is not None:
+                chunks = filecache.write_through(chunks, cache_path,
+                                                 archives.get_cache_size())
+            response = StreamingHttpResponse(chunks)
+        if response.status_code in (200, 206):
+            response['Content-Type'] = archives.FORMATS[format]
+            response['Content-Disposition'] = \
+                'attachment; filename="%s.%s"' % (name, format)
+        return response
+
+    def get_etag(self, repo_context):
+        etag = super(ArchiveView, self).get_etag(repo_context)
+        return hashlib.sha1(etag + self.kwargs['format']).hexdigest()
+
+
+class SmartHTTPMixin(TimingMixin):
+    """ Base for the views of Git smart HTTP (see `klaus.smarthttp`). """
+    def dispatch(self, request, *args, **kwargs):
+        if not getattr(settings, 'KLAUS_SMART_HTTP', True):
+            raise Http404()
+        self.repo = RepoManager.get_repo(self.kwargs['repo'])
+        response = super(SmartHTTPMixin, self).dispatch(
+            request, *args, **kwargs)
+        add_never_cache_headers(response)
+        return response
+
+
+class InfoRefsView(SmartHTTPMixin, View):
+    """ Lists the repo's refs for ``git-upload-pack``. """
+    view_name = 'info-refs'
+
+    def get(self, request, *args, **kwargs):
+        if request.GET.get('service') != smarthttp.SERVICE:
+            return HttpResponseForbidden('Unsupported service')
+        return HttpResponse(
+            smarthttp.advertise_refs(self.repo),
+            content_type='application/x-git-upload-pack-advertisement')
+
+
+class UploadPackView(SmartHTTPMixin, View):
+    """
+    Sends the pack of objects a client asked for (``git clone``, ``git
+    fetch``).  Cached packs are sent with `send_file`.
+    """
+    view_name = 'upload-pack'
+
+    def post(self, request, *args, **kwargs):
+        body = request.body
+        if request.META.get('HTTP_CONTENT_ENCODING') == 'gzip':
+            try:
+                body = zlib.decompress(body, 16 + zlib.MAX_WBITS)
+            except zlib.error:
+                return HttpResponseBadRequest('Invalid gzip data')
+
+        cache_path = smarthttp.get_cache_path(self.repo, body)
+        fileobj = cache_path and filecache.open_cached(cache_path)
+        if fileobj is not None:
+            response = send_file(request, fileobj, cache_path)
+        else:
+            chunks = smarthttp.upload_pack(self.repo, body)
+            if cache_path is not None:
+                chunks = filecache.write_through(chunks, cache_path,
+                                                 smarthttp.get_cache_size())
+            response = StreamingHttpResponse(chunks)
+        response['Content-Type'] = 'application/x-git-upload-pack-result'
+        return response
+
+
+def send_file(request, fileobj, path):
+    """
+    Returns a response that sends the file `fileobj` (at `path`), with
+    support for single byte ranges.
+
+    If `KLAUS_SENDFILE_HEADER` is set (e.g. to ``'X-Sendfile'``), the web
+    server is asked to send the file instead, by setting that header to its
+    path.
+    """
+    sendfile_header = getattr(settings, 'KLAUS_SENDFILE_HEADER', None)
+    if sendfile_header:
+        fileobj.close()
+        response = HttpResponse()
+        response[sendfile_header] = path
+        return response
+
+    size = os.fstat(fileobj.fileno()).st_size
+    byte_range = parse_range_header(request.META.get('HTTP_RANGE'), size)
+    if byte_range is None:
+        start, stop, status = 0, size, 200
+    elif byte_range[0] >= size:
+        fileobj.close()
+        response = HttpResponse(status=416, content_type='text/plain')
+        response['Content-Range'] = 'bytes */%d' % size
+        return response
+    else:
+        start, stop = byte_range
+        stop = min(stop or size, size)
+        status = 206
+
+    response = StreamingHttpResponse(iter_file(fileobj, start, stop),
+                                     status=status)
+    response['Content-Length'] = stop - start
+    if status == 206:
+        response['Content-Range'] = 'bytes %d-%d/%d' % (start, stop - 1, size)
+    response['Accept-Ranges'] = 'bytes'
+    return response
+
+
+def iter_file(fileobj, start, stop, chunk_size=64 * 1024):
+    """ Yields the bytes `start` to `stop` of `fileobj`, then closes it. """
+    try:
+        fileobj.seek(start)
+        remaining = stop - start
+        while remaining > 0:
+            chunk = fileobj.read(min(chunk_size, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+    finally:
+        fileobj.close()
+
+
+def parse_range_header(header, size):
+    """
+    Parses a HTTP `Range` header for a resource of `size` bytes.
+
+    Returns a `(start, stop)` tuple for a single byte range (`stop` is None
+    for open-ended ranges and may be larger than `size`) and None if the
+    header is missing or is to be ignored (e.g. multiple ranges).
+
+    >>> parse_range_header('bytes=0-99', 1000)
+    (0, 100)
+    >>> parse_range_header('bytes=-100', 1000)
+    (900, 1000)
+    """
+    if not header or not header.startswith('bytes=') or ',' in header:
+        return None
+    start, sep, stop = header[len('bytes='):].strip().partition('-')
+    try:
+        if not start:
+            # Suffix range: the last `stop` bytes
+            start, stop = max(size - int(stop), 0), size
+        else:
+            start, stop = int(start), int(stop) + 1 if stop else None
+    except ValueError:
+        return None
+    if not sep or stop is not None and stop <= start:
+        return None
+    return start, stop
+
+
+class RefListView(BaseRepoView):
+    """
+    Renders the full list of branches or tags (`kind`) for the branch/tag
+    selector of view `view`.
+    """
+    template_name = 'klaus/includes/ref_list.html'
+    view_name = 'refs'
+
+    def get_context_data(self, **ctx):
+        context = super(RefListView, self).get_context_data(**ctx)
+        view = self.request.GET.get('view')
+        if view not in [HistoryView.view_name, BlobView.view_name,
+                        BlameView.view_name]:
+            raise RepoException("Invalid view %r" % view)
+
+        if self.request.GET.get('kind') == 'tags':
+            refs = context['repo'].get_tag_names()
+        else:
+            refs = context['repo'].get_branch_names(exclude=context['rev'])
+        context.update({
+            'view': view,
+            'refs': refs,
+        })
+        return context
 
 
 class CommitView(BaseRepoView):
+    """
+    Shows a commit and its diff.
+
+    The diff is rendered and sent file by file. At most
+    `KLAUS_DIFF_MAX_LINES` lines of diff are shown in total and at most
+    `KLAUS_DIFF_MAX_FILE_LINES` per file; larger files, and text files
+    larger than `KLAUS_DIFF_MAX_FILE_SIZE` bytes, are collapsed and can be
+    loaded from `CommitFileView`.
+    """
     template_name = 'klaus/view_commit.html'
     view_name = 'commit'
 
+    #: Placeholder for the diff in the page template.
+    diff_marker = mark_safe('<!-- klaus:diff -->')
+
+    def render_to_response(self, context, **response_kwargs):
+        context['diff'] = self.diff_marker
+        with timing.timed('template'):
+            page = super(CommitView, self).render_to_response(
+                context, **response_kwargs).rendered_content
+        head, tail = page.split(self.diff_marker, 1)
+        return StreamingHttpResponse(self.iter_page(context, head, tail))
+
+    def iter_page(self, context, head, tail):
+        yield head
+
+        repo = context['repo']
+        files = repo.commit_diff(
+            context['commit'],
+            getattr(settings, 'KLAUS_DIFF_MAX_LINES', 10000),
+            getattr(settings, 'KLAUS_DIFF_MAX_FILE_LINES', 2000),
+            getattr(settings, 'KLAUS_DIFF_MAX_FILE_SIZE', 1024 * 1024),
+        )
+        template = loader.get_template('klaus/includes/diff_file.html')
+        for fileno, file in enumerate(files):
+            with timing.timed('template'):
+                html = template.render(Context({
+                    'repo': repo,
+                    'rev': context['rev'],
+                    'file': file,
+                    'fileno': fileno,
+                }))
+            yield html
+
+        yield tail
+
+
+class CommitFileView(BaseRepoView):
+    """
+    Renders the full diff of a single file of a commit, for diffs that have
+    been collapsed by `CommitView`.
+    """
+    template_name = 'klaus/includes/diff_body.html'
+    view_name = 'commit-file'
+
+    def get_etag(self, repo_context):
+        return hashlib.sha1(repr([
+            super(CommitFileView, self).get_etag(repo_context),
+            self.kwargs['filename'],
+        ])).hexdigest()
+
+    def get_context_data(self, **ctx):
+        context = super(CommitFileView, self).get_context_data(**ctx)
+        filename = self.kwargs['filename']
+        if isinstance(filename, unicode):
+            filename = filename.encode('utf-8')
+
+        try:
+            context['file'] = context['repo'].get_file_diff(
+                context['commit'], filename)
+        except KeyError:
+            raise RepoException("File not found")
+        try:
+            context['fileno'] = int(self.request.GET.get('fileno', 0))
+        except ValueError:
+            context['fileno'] = 0
+        return context
+
 
 repo_list = RepoListView.as_view()
+metrics = MetricsView.as_view()
+search = SearchView.as_view()
 history = HistoryView.as_view()
 commit = CommitView.as_view()
 blob = BlobView.as_view()
+blame = BlameView.as_view()
 raw = RawView.as_view()
+commit_file = CommitFileView.as_view()
+archive = ArchiveView.as_view()
+info_refs = InfoRefsView.as_view()
+upload_pack = csrf_exempt(UploadPackView.as_view())
+refs = RefListView.as_view()
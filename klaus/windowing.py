@@ -0,0 +1,303 @@
+# -*- coding: utf-8 -*-
+"""
+Rendering of line windows of large blobs, e.g. lines 5001-5500 of a generated
+file, instead of highlighting the whole file.
+
+For each blob a `LineIndex` is built once and cached per blob SHA: the offsets
+of all lines plus lexer "checkpoints", the state of the lexer at every
+`CHECKPOINT_LINES`-th line.  A window is then highlighted by resuming the lexer
+at the nearest checkpoint before it, so the result is the same as if the file
+had been highlighted from the start.  Checkpoints can only be taken for
+Pygments lexers that are plain `RegexLexer`s; other lexers start lexing at the
+start of the window, so e.g. a multi-line comment open at the start of the
+window may be highlighted wrongly.
+"""
+import bisect
+import marshal
+import zlib
+from array import array
+
+import pygments
+from pygments.lexer import RegexLexer
+
+from klaus import cache, renderpool, timing
+from klaus.lexers import get_lexer
+from klaus.renderpool import RenderTimeout
+from klaus.utils import KlausFormatter, force_unicode, get_formatter, \
+    pygmentize_plain
+
+#: Take a lexer checkpoint every this many lines.
+CHECKPOINT_LINES = 100
+
+#: Lex this many characters past the end of a window, so that tokens spanning
+#: multiple lines (like docstrings) at the end of the window are recognized.
+LOOKAHEAD_CHARS = 64 * 1024
+
+#: Part of the cache keys; increase on changes to the index format.
+INDEX_VERSION = 1
+
+
+class LineIndex(object):
+    """
+    Offsets of the lines of a blob's (decoded) text and lexer checkpoints:
+    the lexer's state stack at each of `checkpoint_offsets`.
+    """
+    def __init__(self, offsets, checkpoint_offsets, checkpoint_stacks):
+        self.offsets = offsets
+        self.checkpoint_offsets = checkpoint_offsets
+        self.checkpoint_stacks = checkpoint_stacks
+
+    @property
+    def line_count(self):
+        return len(self.offsets) - 1
+
+    def checkpoint_before(self, offset):
+        """
+        Returns the last checkpoint at or before `offset`, or None if there
+        is no such checkpoint.
+        """
+        pos = bisect.bisect_right(self.checkpoint_offsets, offset)
+        if pos:
+            return (self.checkpoint_offsets[pos - 1],
+                    self.checkpoint_stacks[pos - 1])
+        return None
+
+    def pack(self):
+        return zlib.compress(marshal.dumps((
+            self.offsets.tostring(),
+            self.checkpoint_offsets.tostring(),
+            tuple(self.checkpoint_stacks),
+        )))
+
+    @classmethod
+    def unpack(cls, data):
+        offsets, checkpoint_offsets, checkpoint_stacks = \
+            marshal.loads(zlib.decompress(data))
+        return cls(array('l', offsets), array('l', checkpoint_offsets),
+                   list(checkpoint_stacks))
+
+    @classmethod
+    def build(cls, text, lexer=None):
+        """
+        Indexes `text`.  Checkpoints are only taken if a `lexer` is given and
+        it can be resumed.
+        """
+        offsets = array('l', [0])
+        pos = text.find(u'\n')
+        while pos != -1:
+            offsets.append(pos + 1)
+            pos = text.find(u'\n', pos + 1)
+
+        checkpoint_offsets = array('l')
+        checkpoint_stacks = []
+        if lexer is not None and can_resume(lexer):
+            try:
+                _take_checkpoints(lexer, text, offsets, checkpoint_offsets,
+                                  checkpoint_stacks)
+            except (KeyError, AttributeError, TypeError):
+                # The lexer's generator doesn't look like `RegexLexer`'s
+                # (e.g. another Pygments version); lex windows from the
+                # start of the text instead.
+                del checkpoint_offsets[:], checkpoint_stacks[:]
+
+        return cls(offsets, checkpoint_offsets, checkpoint_stacks)
+
+
+def _take_checkpoints(lexer, text, offsets, checkpoint_offsets,
+                      checkpoint_stacks):
+    # Reads the lexer's state from the local variables of
+    # `RegexLexer.get_tokens_unprocessed`, which is a generator.
+    tokens = lexer.get_tokens_unprocessed(text)
+    try:
+        line = CHECKPOINT_LINES
+        for index, _, _ in tokens:
+            if line >= len(offsets) - 1:
+                break
+            if index < offsets[line]:
+                continue
+            # Only resume at the start of lines, where patterns like `^`
+            # match the same as when lexing the whole text.
+            line = bisect.bisect_left(offsets, index)
+            if offsets[line] != index:
+                continue
+            # The lexer yields tokens before the state transitions they
+            # cause, so this is the state to lex from `index` on -- unless
+            # the token is one of many yielded for a single match.
+            local_vars = tokens.gi_frame.f_locals
+            if local_vars['pos'] == index:
+                checkpoint_offsets.append(index)
+                checkpoint_stacks.append(tuple(local_vars['statestack']))
+                line += CHECKPOINT_LINES
+    finally:
+        tokens.close()
+
+
+class BlobWindow(object):
+    """
+    Lines `start` to `stop` (1-based, inclusive) of `blob`, rendered.
+
+    Windows are aligned to multiples of `size` lines, so that they can be
+    cached; `start` is rounded down accordingly.
+
+    If indexing the blob takes too long (see `klaus.renderpool`), the window
+    is shown as plain text.
+    """
+    def __init__(self, blob, filename, start, size):
+        self.blob = blob
+        self.filename = filename
+        self.size = size
+        self._text = None
+        self._lexer = None
+
+        try:
+            self.index = get_line_index(blob, filename, self.get_text,
+                                        self.get_lexer)
+            self.plain = False
+        except RenderTimeout:
+            self.index = LineIndex.build(self.get_text())
+            self.plain = True
+        start = min(max(start, 1), max(self.index.line_count, 1))
+        self.start = (start - 1) // size * size + 1
+        self.stop = min(self.start + size - 1, self.index.line_count)
+
+    @property
+    def line_count(self):
+        return self.index.line_count
+
+    @property
+    def previous_start(self):
+        if self.start > 1:
+            return self.start - self.size
+        return None
+
+    @property
+    def next_start(self):
+        if self.stop < self.line_count:
+            return self.stop + 1
+        return None
+
+    @property
+    def last_start(self):
+        return (max(self.line_count, 1) - 1) // self.size * self.size + 1
+
+    def get_text(self):
+        if self._text is None:
+            self._text = decode_text(self.blob.data)
+        return self._text
+
+    def get_lexer(self):
+        if self._lexer is None:
+            # Don't strip leading and trailing newlines, so that line
+            # numbers match the blob's lines.
+            self._lexer = get_lexer(self.filename, self.get_text(),
+                                    self.blob.id, stripnl=False)
+        return self._lexer
+
+    def render(self):
+        """ Returns the window's lines highlighted by `KlausFormatter`. """
+        key = cache.make_key('window', self.blob.id, self.filename,
+                             self.start, self.size, INDEX_VERSION,
+                             KlausFormatter.version, pygments.__version__)
+        if not self.plain:
+            try:
+                return cache.get_or_create(key, lambda: self._render(key))
+            except RenderTimeout:
+                pass
+        return self._render_plain()
+
+    def _render(self, key):
+        start = self.index.offsets[self.start - 1]
+        stop = self.index.offsets[self.stop]
+        lexer = self.get_lexer()
+        if can_resume(lexer):
+            offset, stack = self.index.checkpoint_before(start) or \
+                (0, ('root',))
+        else:
+            offset, stack = start, None
+        text = self.get_text()[offset:stop + LOOKAHEAD_CHARS]
+        with timing.timed('highlight'):
+            return renderpool.run(render_window, (
+                type(lexer), lexer.options, text, start - offset,
+                stop - offset, stack, self.start
+            ), key)
+
+    def _render_plain(self):
+        start = self.index.offsets[self.start - 1]
+        stop = self.index.offsets[self.stop]
+        return pygmentize_plain(self.get_text()[start:stop], self.start,
+                                stripnl=False)
+
+
+def get_line_index(blob, filename, get_text, get_lexer):
+    """
+    Returns the `LineIndex` of `blob`, cached per blob SHA.  `get_text` and
+    `get_lexer` are only called if the index isn't cached.
+    """
+    key = cache.make_key('line_index', blob.id, filename, INDEX_VERSION,
+                         pygments.__version__)
+    def build():
+        with timing.timed('lexer'):
+            lexer = get_lexer()
+        with timing.timed('line-index'):
+            return renderpool.run(build_line_index,
+                                  (get_text(), type(lexer), lexer.options),
+                                  key)
+    return LineIndex.unpack(cache.get_or_create(key, build))
+
+
+# The following functions run in `klaus.renderpool`.  Lexers are set up on
+# first use, so they take the lexer's class and options instead of a lexer.
+
+def build_line_index(text, lexer_class, options):
+    """ Returns the packed `LineIndex` of `text`. """
+    return LineIndex.build(text, lexer_class(**options)).pack()
+
+
+def render_window(lexer_class, options, text, start, stop, stack,
+                  linenostart):
+    """
+    Highlights `text[start:stop]` (whose first line is line `linenostart` of
+    the file), lexing `text` from its beginning, resuming the lexer with state
+    `stack` unless that is None.
+    """
+    lexer = lexer_class(**options)
+    if stack is None:
+        tokens = lexer.get_tokens_unprocessed(text)
+    else:
+        tokens = lexer.get_tokens_unprocessed(text, stack)
+    return pygments.format(clip_tokens(tokens, start, stop),
+                           get_formatter(linenostart))
+
+
+def clip_tokens(tokens, start, stop):
+    """
+    Yields the `(tokentype, value)` pairs of the part from `start` to `stop`
+    of the text lexed into `tokens` (as yielded by `get_tokens_unprocessed`).
+    """
+    for pos, tokentype, value in tokens:
+        if pos >= stop:
+            break
+        if pos + len(value) <= start:
+            continue
+        yield tokentype, value[max(start - pos, 0):stop - pos]
+
+
+def can_resume(lexer):
+    """ True if `lexer` can be resumed with a given state stack. """
+    return isinstance(lexer, RegexLexer) and \
+        type(lexer).get_tokens_unprocessed.im_func is \
+        RegexLexer.get_tokens_unprocessed.im_func
+
+
+def decode_text(data):
+    """
+    Decodes `data` and normalizes newlines the way Pygments does it before
+    lexing, so that offsets into the result can be passed to lexers.
+    """
+    text = force_unicode(data)
+    if text.startswith(u'\ufeff'):
+        text = text[1:]
+    text = text.replace(u'\r\n', u'\n').replace(u'\r', u'\n')
+    if not text.endswith(u'\n'):
+        text += u'\n'
+    return text
@@ -14,7 +14,7 @@ def install_data_files_hack():
 
 install_data_files_hack()
 
-requires = ['pygments', 'dulwich>=0.8.6', 'Django>=1.4']
+requires = ['pygments', 'dulwich>=0.9.9,<0.20', 'Django>=1.5']
 
 try:
     import argparse  # not available for Python 2.6
@@ -27,7 +27,7 @@ setup(
     version='0.1.1',
     author='Marcin Biernat, Jonas Haag',
     author_email='mb@marcinbiernat.pl, jonas@lophus.org',
-    packages=['klaus'],
+    packages=['klaus', 'klaus.management', 'klaus.management.commands'],
     include_package_data=True,
     zip_safe=False,
     url='https://github.com/biern/django-klaus',